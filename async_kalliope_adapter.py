@@ -0,0 +1,336 @@
+import asyncio
+import hashlib
+import json
+import os
+import ssl
+import tempfile
+import time
+import aiohttp
+import magic
+import requests
+import helpers
+from helpers import log
+from .kalliope_adapter import CERT_BUNDLE_PATH, BIJLAGEN_FOLDER_PATH, TMP_FILE_PREFIX
+from .kalliope_adapter import DOWNLOAD_CHUNK_SIZE, MIMETYPE_SNIFF_SIZE, PAGE_ATTEMPTS
+from .kalliope_adapter import RETRY_STATUSES, THROTTLED_STATUSES
+from .kalliope_adapter import ENDPOINT_POSTSTUKKEN_UIT, ENDPOINT_BIJLAGEN, ENDPOINT_POSTSTUK_IN
+from .kalliope_adapter import ENDPOINT_CONFIRMATIONS, ENDPOINT_INZENDINGEN
+from .kalliope_adapter import KALLIOPE_POOL_SIZE, KALLIOPE_CONNECT_TIMEOUT, KALLIOPE_READ_TIMEOUT, KALLIOPE_PAGE_TIMEOUT
+from .kalliope_adapter import KALLIOPE_RETRIES, KALLIOPE_RETRY_BACKOFF
+from .kalliope_adapter import kalliope_circuit, kalliope_rate_limiter, page_sizer
+from .kalliope_adapter import pause_throttled_endpoint, with_page_size, new_bijlage
+from .job_scheduler import current_job
+from .event_loop import run_blocking
+
+# Errors of a failed Kalliope request, whether raised by aiohttp or by the functions below
+KALLIOPE_ERRORS = (requests.exceptions.RequestException, aiohttp.ClientError, asyncio.TimeoutError)
+
+kalliope_session = None
+
+
+def open_kalliope_api_session():
+    """
+    Get the Kalliope session shared by the async tasks, created on first use. Keeps up to KALLIOPE_POOL_SIZE
+    connections alive. Must be called from within the event loop, see event_loop.
+    """
+    global kalliope_session
+    if kalliope_session is None:
+        kalliope_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=KALLIOPE_POOL_SIZE,
+                                           ssl=ssl.create_default_context(cafile=CERT_BUNDLE_PATH)),
+            auth=aiohttp.BasicAuth(os.environ.get('KALLIOPE_API_USERNAME', ''),
+                                   os.environ.get('KALLIOPE_API_PASSWORD', '')),
+            headers={'Accept-Encoding': 'gzip, deflate'},
+            timeout=aiohttp.ClientTimeout(sock_connect=KALLIOPE_CONNECT_TIMEOUT, sock_read=KALLIOPE_READ_TIMEOUT))
+    return kalliope_session
+
+
+async def kalliope_request(session, method, url, endpoint, idempotent=False, **kwargs):
+    """
+    Async counterpart of kalliope_adapter.kalliope_request(), sharing its rate limits and circuit breaker.
+    GETs and idempotent POSTs are retried on connection errors and 429/502/503/504 responses, GETs aren't retried
+    on read timeouts (see get_kalliope_poststukken_uit_page()).
+    The response isn't read: use it as an async context manager to release the connection.
+
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param method: HTTP method
+    :param url: url of the request
+    :param endpoint: name of the endpoint (ENDPOINT_*) of which the rate limit applies
+    :param idempotent: True for a POST that is safe to send again
+    :param kwargs: passed on to session.request()
+    :returns: the response
+    """
+    attempts = 1 + (KALLIOPE_RETRIES if idempotent or method == 'GET' else 0)
+    for attempt in range(1, attempts + 1):
+        kalliope_circuit.before_request()
+        await kalliope_rate_limiter.acquire_async(endpoint, current_job.get())
+        try:
+            r = await session.request(method, url, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            kalliope_circuit.record_failure()
+            if attempt == attempts or (isinstance(e, asyncio.TimeoutError) and not idempotent):
+                raise e
+            log("Kalliope request {} {} failed, retrying: {}".format(method, url, e))
+        else:
+            if r.status >= 500:
+                kalliope_circuit.record_failure()
+            else:
+                kalliope_circuit.record_success()
+            if r.status in THROTTLED_STATUSES:
+                pause_throttled_endpoint(endpoint, r.headers.get('Retry-After'))
+            if r.status not in RETRY_STATUSES or attempt == attempts:
+                return r
+            r.release()
+            log("Kalliope request {} {} failed (statuscode {}), retrying".format(method, url, r.status))
+        await asyncio.sleep(KALLIOPE_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+
+async def error_description(r):
+    try:
+        return await r.json(content_type=None)
+    except Exception:
+        return r
+
+
+async def get_kalliope_bijlage(path, session):
+    """
+    Perform the API-call to get a poststuk-uit bijlage.
+    The bijlage is streamed to a temporary file in BIJLAGEN_FOLDER_PATH, its size, SHA-256 and mimetype
+    are determined along the way.
+
+    :param path: url of the api endpoint that we want to fetch
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :returns: dict with the path of the temporary file, its size, sha256 and mimetype
+    """
+    r = await kalliope_request(session, 'GET', path, ENDPOINT_BIJLAGEN)
+    async with r:
+        if r.status != requests.codes.ok:
+            raise requests.\
+                  exceptions.HTTPError('Failed to get Kalliope poststuk bijlage (statuscode {})'.format(r.status))
+
+        sha256 = hashlib.sha256()
+        size = 0
+        head = b''
+        (fd, tmp_filepath) = tempfile.mkstemp(dir=BIJLAGEN_FOLDER_PATH, prefix=TMP_FILE_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    if len(head) < MIMETYPE_SNIFF_SIZE:
+                        head += chunk[:MIMETYPE_SNIFF_SIZE - len(head)]
+            os.chmod(tmp_filepath, 0o644)  # mkstemp only grants access to the owner
+        except (Exception, asyncio.CancelledError) as e:  # Also clean up a cancelled download
+            os.remove(tmp_filepath)
+            raise e
+
+    return {
+        'tmp_filepath': tmp_filepath,
+        'size': size,
+        'sha256': sha256.hexdigest(),
+        'mimetype': magic.from_buffer(head, mime=True),
+    }
+
+
+async def parse_kalliope_bijlage(ps_bijlage, session):
+    """
+    Parse the bijlage response from the Kalliope API into our bijlage format
+
+    :param bijlage: The bijlage deserialized JSON
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :returns: a dict of bijlage properties including the path of the downloaded (temporary) file
+    """
+    bijlage = new_bijlage(ps_bijlage)
+    download = await get_kalliope_bijlage(ps_bijlage['url'], session)
+    bijlage['tmp_filepath'] = download['tmp_filepath']
+    bijlage['sha256'] = download['sha256']
+    bijlage['mimetype'] = download['mimetype']
+    bijlage['size'] = download['size']
+    return bijlage
+
+
+def discard_kalliope_bijlagen(bijlagen_downloads):
+    """
+    Cancel pending bijlage downloads and remove the temporary files of the finished ones.
+
+    :param bijlagen_downloads: list of tasks, each resolving to a bijlage as returned by parse_kalliope_bijlage()
+    """
+    for download in bijlagen_downloads:
+        if download.cancel():
+            continue
+        try:
+            tmp_filepath = download.result().get('tmp_filepath')
+        except (Exception, asyncio.CancelledError):
+            continue
+        if tmp_filepath and os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+
+async def get_kalliope_poststukken_uit(path, session, from_,
+                                       to=None,
+                                       dossier_types=None):
+    """
+    Perform the API-call to get all poststukken-uit that are ready to be processed.
+
+    :param path: url of the api endpoint that we want to fetch
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param from_: start boundary of timerange for which messages are requested
+    :param to: end boundary of timerange for which messages are requested
+    :param dossier_types: Only return messages associated to these types of dossier
+    :returns: tuple of poststukken
+    """
+    poststukken = []
+    async for page in get_kalliope_poststukken_uit_pages(path, session, from_, to, dossier_types):
+        poststukken += page
+    return poststukken
+
+
+async def get_kalliope_poststukken_uit_pages(path, session, from_,
+                                             to=None,
+                                             dossier_types=None):
+    """
+    Perform the API-calls to get all poststukken-uit that are ready to be processed, page by page.
+    The next page is requested while the current one is being processed. The page size set by the page sizer
+    applies from the first page on, the next pages are requested through the 'volgende' links as returned by Kalliope.
+
+    :param path: url of the api endpoint that we want to fetch
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param from_: start boundary of timerange for which messages are requested
+    :param to: end boundary of timerange for which messages are requested
+    :param dossier_types: Only return messages associated to these types of dossier
+    :returns: async generator yielding lists of poststukken
+    """
+    params = {
+        'vanaf': from_.replace(microsecond=0).isoformat(),
+        'aantal': page_sizer.size()
+    }
+    if to:
+        params['tot'] = to.replace(microsecond=0).isoformat()
+    if dossier_types:
+        params['dossierTypes'] = ','.join(dossier_types)
+
+    req_url = requests.Request('GET', path, params=params).prepare().url
+    next_page = asyncio.ensure_future(get_kalliope_poststukken_uit_page(req_url, session))
+    try:
+        while next_page:
+            (poststukken, req_url, size) = await next_page
+            next_page = (asyncio.ensure_future(get_kalliope_poststukken_uit_page(req_url, session, size))
+                         if req_url else None)
+            yield poststukken
+    finally:
+        if next_page:
+            next_page.cancel()
+
+
+async def get_kalliope_poststukken_uit_page(req_url, session, size=None):
+    """
+    Async counterpart of kalliope_adapter.get_kalliope_poststukken_uit_page(). kalliope_request() already retried
+    the 502/503/504 responses.
+
+    :param req_url: url of the page, including the query parameters
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param size: page size of the listing for a next page, None for the first page
+    :returns: tuple of the form (poststukken, url of the next page or None, page size of the listing)
+    """
+    timeout = aiohttp.ClientTimeout(sock_connect=KALLIOPE_CONNECT_TIMEOUT, sock_read=KALLIOPE_PAGE_TIMEOUT)
+    first_page = size is None
+    for attempt in range(1, PAGE_ATTEMPTS + 1):
+        if first_page:
+            size = page_sizer.size()
+            req_url = with_page_size(req_url, size)
+        helpers.log("literally requesting: {}".format(req_url))
+        started_at = time.monotonic()
+        try:
+            r = await kalliope_request(session, 'GET', req_url, ENDPOINT_POSTSTUKKEN_UIT, timeout=timeout)
+            async with r:
+                if r.status >= 500:
+                    page_sizer.record(size, 0, time.monotonic() - started_at, True)
+                    if r.status not in RETRY_STATUSES and attempt < PAGE_ATTEMPTS:
+                        continue
+                if r.status == requests.codes.ok:
+                    r_content = await r.json(content_type=None)
+                    page_sizer.record(size, len(r_content['poststukken']), time.monotonic() - started_at, False)
+                    return (r_content['poststukken'], r_content['volgende'], size)
+                raise requests.exceptions.HTTPError('Failed to get Kalliope poststuk uit (statuscode {}): {}'
+                                                    .format(r.status, await error_description(r)))
+        except asyncio.TimeoutError as e:
+            page_sizer.record(size, 0, time.monotonic() - started_at, True)
+            if attempt == PAGE_ATTEMPTS:
+                raise e
+
+
+async def multipart_body(params):
+    """
+    Stream a MultipartStream as the body of an aiohttp request. The chunks are read on a thread,
+    reading the file parts on the event loop would block it.
+    """
+    chunks = iter(params)
+    try:
+        while True:
+            chunk = await run_blocking(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        chunks.close()  # Closes the file being read when the request is aborted
+
+
+async def post_kalliope_poststuk_in(path, session, params):
+    """
+    Perform the API-call to send a new poststuk to Kalliope.
+    :param path: url of the api endpoint that we want to send to
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param params: poststuk_in body, as returned by kalliope_adapter.construct_kalliope_poststuk_in()
+    :returns: response dict
+    """
+    r = await kalliope_request(session, 'POST', path, ENDPOINT_POSTSTUK_IN,
+                               data=multipart_body(params),
+                               headers={'Content-Type': params.content_type, 'Content-Length': str(len(params))})
+    async with r:
+        if r.status == requests.codes.ok:
+            return await r.json(content_type=None)
+        raise requests.exceptions.HTTPError('Failed to post Kalliope poststuk-in (statuscode {}): {}'
+                                            .format(r.status, await error_description(r)))
+
+
+async def post_kalliope_poststuk_uit_confirmation(path, session, data):
+    """
+    Perform the API-call to send information around the berichtencentrum to Kalliope.
+
+    :param path: url of the api endpoint that we want to send to
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param data: object of parameters for the api call
+    :returns: True when we get a 204 response
+    """
+    headers = {
+        "Accept": "application/json",
+    }
+    # Sending the same confirmation twice does no harm
+    r = await kalliope_request(session, 'POST', path, ENDPOINT_CONFIRMATIONS, idempotent=True, json=data, headers=headers)
+    async with r:
+        if r.status == requests.codes.no_content:
+            return True
+        raise requests.exceptions.HTTPError('Failed to post Kalliope poststuck-uit-confirmation (statuscode {}): {}'
+                                            .format(r.status, await error_description(r)))
+
+
+async def post_kalliope_inzending_in(path, session, inzending):
+    """
+    Perform the API-call to send a new inzending to Kalliope.
+
+    :param path: url of the api endpoint that we want to send to
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param inzending: inzending dict, as returned by parse_inzending_sparql_response()
+    :returns: response dict
+    """
+    # NOTE: API expects a 'Content-Type'-header for each parameter
+    params = aiohttp.FormData()
+    params.add_field('data', json.dumps(inzending), content_type='application/json')
+    log("Posting inzending <{}>. Payload: {}".format(inzending['uri'], inzending))
+    r = await kalliope_request(session, 'POST', path, ENDPOINT_INZENDINGEN, data=params)
+    async with r:
+        if r.status == requests.codes.ok:
+            return await r.json(content_type=None)
+        raise requests.exceptions.HTTPError('Failed to post Kalliope inzending-in (statuscode {}): {}'
+                                            .format(r.status, await error_description(r)))
@@ -0,0 +1,73 @@
+import aiohttp
+from helpers import log
+from .sudo_query_helpers import is_update_query
+from .sudo_query_helpers import SPARQL_QUERY_ENDPOINT, SPARQL_UPDATE_ENDPOINT, SPARQL_RESULTS_JSON
+from .sudo_query_helpers import SPARQL_POOL_SIZE, SPARQL_CONNECT_TIMEOUT, SPARQL_READ_TIMEOUT
+
+sparql_session = None
+
+
+def open_sparql_session():
+    """
+    Get the session towards the triple store shared by the async tasks, created on first use.
+    Must be called from within the event loop, see event_loop.
+    """
+    global sparql_session
+    if sparql_session is None:
+        sparql_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=SPARQL_POOL_SIZE),
+            headers={
+                'mu-auth-sudo': 'true',
+                'Accept': SPARQL_RESULTS_JSON,
+                'Accept-Encoding': 'gzip',
+            })
+    return sparql_session
+
+
+def client_timeout(timeout):
+    (connect, read) = timeout or (SPARQL_CONNECT_TIMEOUT, SPARQL_READ_TIMEOUT)
+    return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+
+async def query(the_query, timeout=None):
+    """Execute the given SPARQL query (select/ask/construct) on the triple store and returns the results
+    in the SPARQL JSON results format. Async counterpart of sudo_query_helpers.query().
+
+    :param timeout: optional (connect, read) timeout in seconds, SPARQL_CONNECT_TIMEOUT/SPARQL_READ_TIMEOUT by default
+    """
+    log("execute query: \n" + the_query)
+    async with open_sparql_session().post(SPARQL_QUERY_ENDPOINT,
+                                          data={'query': the_query},
+                                          timeout=client_timeout(timeout)) as r:
+        r.raise_for_status()
+        return await r.json(content_type=None)
+
+
+async def update(the_query, timeout=None):
+    """Execute the given update SPARQL query on the triple store,
+    if the given query is no update query, nothing happens. Async counterpart of sudo_query_helpers.update().
+
+    :param timeout: optional (connect, read) timeout in seconds, SPARQL_CONNECT_TIMEOUT/SPARQL_READ_TIMEOUT by default
+    """
+    if is_update_query(the_query):
+        log("execute query: \n" + the_query)
+        async with open_sparql_session().post(SPARQL_UPDATE_ENDPOINT,
+                                              data={'update': the_query},
+                                              timeout=client_timeout(timeout)) as r:
+            r.raise_for_status()
+
+
+async def update_with_suppressed_fail(query_string):
+    """
+    A last resort update, if the potential error of an update needs supression.
+
+    :param query_string: string
+    """
+    try:
+        await update(query_string)
+    except Exception as e:
+        log("""
+              WARNING: an error occured during the update_with_suppressed_fail.
+                       Message {}
+                       Query {}
+            """.format(e, query_string))
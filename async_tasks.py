@@ -0,0 +1,523 @@
+import asyncio
+import os
+from datetime import datetime
+
+from helpers import log
+from .event_loop import run_blocking, hold_lock, gather_bounded
+from .async_sudo_query_helpers import query, update, update_with_suppressed_fail
+from .async_kalliope_adapter import open_kalliope_api_session
+from .async_kalliope_adapter import get_kalliope_poststukken_uit_pages
+from .async_kalliope_adapter import parse_kalliope_bijlage
+from .async_kalliope_adapter import discard_kalliope_bijlagen
+from .async_kalliope_adapter import post_kalliope_poststuk_in
+from .async_kalliope_adapter import post_kalliope_poststuk_uit_confirmation
+from .async_kalliope_adapter import post_kalliope_inzending_in
+from .async_kalliope_adapter import KALLIOPE_ERRORS
+from .kalliope_adapter import construct_kalliope_poststuk_in
+from .kalliope_adapter import kalliope_circuit
+from .circuit_breaker import CircuitOpenError
+from .bestuurseenheden_cache import bestuurseenheden_cache
+from .bestuurseenheden_cache import organization_graph
+from .bestuurseenheden_cache import BERICHTEN_GEBRUIKER
+from .bestuurseenheden_cache import TOEZICHT_GEBRUIKER
+from .queries import STATUS_DELIVERED_CONFIRMED, STATUS_DELIVERED_CONFIRMATION_FAILED, STATUS_DELIVERED_UNCONFIRMED
+from .queries import construct_get_messages_by_status, construct_update_berichten_status_query
+from .queries import construct_increment_confirmation_attempts_query
+from .queries import construct_unsent_berichten_query
+from .queries import construct_select_berichten_bijlagen_query
+from .queries import construct_select_original_berichten_query
+from .queries import construct_bericht_sent_query
+from .queries import construct_unsent_inzendingen_query
+from .queries import construct_inzending_sent_query
+from .queries import construct_existing_berichten_query
+from .queries import construct_conversatie_exists_query
+from .queries import construct_update_last_bericht_query
+from .queries import construct_dossierbehandelaar_exists_query
+from .queries import construct_combined_update_query
+from .queries import construct_select_sync_cursor_query
+from .queries import construct_update_sync_cursor_query
+from .task_process_berichten_in import TIMEZONE, PUBLIC_GRAPH
+from .task_process_berichten_in import PS_UIT_PATH, SYNC_CURSOR_URI
+from .task_process_berichten_in import BIJLAGEN_DOWNLOAD_CONCURRENCY, BIJLAGEN_PREFETCH_POSTSTUKKEN
+from .task_process_berichten_in import determine_sync_window, report_aborted_run
+from .task_process_berichten_in import parse_poststukken, select_known_poststukken, exclude_existing_poststukken
+from .task_process_berichten_in import report_poststuk_error, report_poststukken_error
+from .task_process_berichten_in import claim_bericht, release_bericht, find_downloaded_bijlage
+from .task_process_berichten_in import report_bijlage_error, prepare_conversatie, report_insert_error
+from .task_process_berichten_in import link_dossierbehandelaar
+from .task_process_berichten_in import parse_sync_cursor, determine_processed_until, save_bijlagen
+from .bijlagen_store import remove_stale_downloads
+from .task_process_berichten_in_confirmation import MAX_CONFIRMATION_ATTEMPTS, PS_UIT_CONFIRMATION_PATH
+from .task_process_berichten_in_confirmation import CONFIRMATIONS_CONCURRENCY
+from .task_process_berichten_in_confirmation import CONFIRMATION_ATTEMPT_FAILED, CONFIRMATION_SHORT_CIRCUITED
+from .task_process_berichten_in_confirmation import confirmations_lock, confirmations_queue
+from .task_process_berichten_in_confirmation import enqueue_confirmation, report_unsaved_outcomes
+from .task_process_berichten_in_confirmation import confirmation_graph_batches, select_due_confirmations
+from .task_process_berichten_in_confirmation import record_confirmation_outcomes, confirmation_outcome_batches
+from .task_process_berichten_in_confirmation import new_confirmation, report_confirmation_error
+from .task_process_berichten_in_confirmation import report_confirmations_error
+from .task_process_berichten_out import ABB_URI, MAX_SENDING_ATTEMPTS, PS_IN_PATH
+from .task_process_berichten_out import BERICHTEN_OUT_CONCURRENCY, ENRICHMENT_BATCH_SIZE
+from .task_process_berichten_out import berichten_out_lock, berichten_out_queue
+from .task_process_berichten_out import prepare_message_and_conversation, collect_enrichment
+from .task_process_berichten_out import select_due_berichten_out, record_berichten_out_outcomes
+from .task_process_berichten_out import report_enrichment_error, report_failed_attempt, report_bericht_out_error
+from .task_process_berichten_out import report_berichten_out_selection_error
+from .task_process_inzendingen_voor_toezicht import INZENDING_IN_PATH
+from .task_process_inzendingen_voor_toezicht import inzendingen_lock, inzendingen_queue
+from .task_process_inzendingen_voor_toezicht import select_due_inzendingen, record_inzendingen_outcomes
+from .task_process_inzendingen_voor_toezicht import prepare_inzendingen, report_inzendingen_selection_error
+from .task_process_inzendingen_voor_toezicht import report_failed_inzending_attempt, report_inzending_error
+from .task_process_inzendingen_voor_toezicht import excluded_submissions_queries, without_excluded_submissions
+
+INZENDINGEN_CONCURRENCY = int(os.environ.get('INZENDINGEN_CONCURRENCY', 4))
+WORK_QUEUE_BATCH_SIZE = 50
+
+# Async counterparts of the process_* and dispatch_* jobs, run on the shared event loop (see event_loop).
+# They share the locks, work queues, rate limit and circuit breaker of the synchronous jobs, only the waiting
+# on Kalliope and the triple store is done without holding a thread.
+
+
+async def async_process_berichten_in():
+    """
+    Async counterpart of task_process_berichten_in.process_berichten_in().
+
+    :returns: None
+    """
+    await run_blocking(remove_stale_downloads)
+    started_at = datetime.now(tz=TIMEZONE)
+    (vanaf, last_full_sweep) = determine_sync_window(started_at, *(await get_sync_cursor()))
+    try:
+        (_, failed_poststukken) = await import_window(open_kalliope_api_session(), vanaf)
+    except KALLIOPE_ERRORS as e:
+        await run_blocking(report_aborted_run, e)
+        return
+
+    await update_sync_cursor(determine_processed_until(started_at, vanaf, failed_poststukken), last_full_sweep)
+
+
+async def import_window(session, vanaf, tot=None):
+    """
+    :returns: tuple of the form (number of poststukken retrieved, poststukken that failed and should be retried)
+    """
+    count = 0
+    failed_poststukken = []
+    bijlagen_semaphore = asyncio.Semaphore(BIJLAGEN_DOWNLOAD_CONCURRENCY)
+    async for poststukken in get_kalliope_poststukken_uit_pages(PS_UIT_PATH, session, vanaf, tot):
+        log('Retrieved a page of {} poststukken uit from Kalliope'.format(len(poststukken)))
+        count += len(poststukken)
+        (new_poststukken, failed) = await select_new_poststukken(poststukken)
+        failed_poststukken += failed
+        failed_poststukken += await import_poststukken(new_poststukken, session, bijlagen_semaphore)
+    return (count, failed_poststukken)
+
+
+async def select_new_poststukken(poststukken):
+    """
+    :returns: tuple of the form (new_poststukken, failed_poststukken), see task_process_berichten_in
+    """
+    (parsed_poststukken, failed_poststukken) = await run_blocking(parse_poststukken, poststukken)
+    if not parsed_poststukken:
+        return ([], failed_poststukken)
+
+    try:
+        known_poststukken = await run_blocking(select_known_poststukken, parsed_poststukken)
+        if not known_poststukken:
+            return ([], failed_poststukken)
+
+        q_berichten = construct_existing_berichten_query([(graph, bericht['uri'])
+                                                          for (_, _, bericht, graph) in known_poststukken])
+        existing_berichten = (await query(q_berichten))['results']['bindings']
+    except Exception as e:
+        return ([], failed_poststukken + await run_blocking(report_poststukken_error, parsed_poststukken, e))
+
+    return (exclude_existing_poststukken(known_poststukken, existing_berichten), failed_poststukken)
+
+
+async def import_poststukken(new_poststukken, session, bijlagen_semaphore):
+    """
+    Import new poststukken into the triple store, downloading the bijlagen of the next BIJLAGEN_PREFETCH_POSTSTUKKEN
+    poststukken meanwhile. At most BIJLAGEN_DOWNLOAD_CONCURRENCY bijlagen are downloaded at the same time.
+
+    :returns: list of poststukken that failed to be imported and should be retried
+    """
+    async def download(ps_bijlage):
+        async with bijlagen_semaphore:
+            return await fetch_bijlage(ps_bijlage, session)
+
+    failed_poststukken = []
+    downloads = {}
+    for i, (poststuk, conversatie, bericht, graph) in enumerate(new_poststukken):
+        for j in range(i, min(i + 1 + BIJLAGEN_PREFETCH_POSTSTUKKEN, len(new_poststukken))):
+            if j not in downloads:
+                downloads[j] = [asyncio.ensure_future(download(ps_bijlage))
+                                for ps_bijlage in new_poststukken[j][2]['bijlagen_refs']]
+        bijlagen_downloads = downloads.pop(i)
+        if not claim_bericht(bericht['uri']):  # Being imported by a concurrent run (e.g. a backfill), retry it later
+            discard_kalliope_bijlagen(bijlagen_downloads)
+            failed_poststukken.append(poststuk)
+            continue
+        try:
+            # A concurrent run may have imported it since select_new_poststukken() checked
+            if (await query(construct_existing_berichten_query([(graph, bericht['uri'])])))['results']['bindings']:
+                log("Bericht {} was imported meanwhile, skipping ...".format(bericht['uri']))
+                discard_kalliope_bijlagen(bijlagen_downloads)
+                continue
+            await insert_message_in_db(conversatie, bericht, poststuk, bijlagen_downloads, graph)
+            await run_blocking(enqueue_confirmation, graph, bericht['uri'])
+        except Exception as e:
+            discard_kalliope_bijlagen(bijlagen_downloads)
+            if isinstance(e, CircuitOpenError):
+                for prefetched_downloads in downloads.values():
+                    discard_kalliope_bijlagen(prefetched_downloads)
+                raise e
+            if not await run_blocking(report_poststuk_error, poststuk, e):
+                failed_poststukken.append(poststuk)
+        finally:
+            release_bericht(bericht['uri'])
+    return failed_poststukken
+
+
+async def fetch_bijlage(ps_bijlage, session):
+    return await run_blocking(find_downloaded_bijlage, ps_bijlage) or \
+        await parse_kalliope_bijlage(ps_bijlage, session)
+
+
+async def insert_message_in_db(conversatie, bericht, poststuk, bijlagen_downloads, graph):
+    bericht['bijlagen'] = []
+    try:
+        for download in bijlagen_downloads:
+            bericht['bijlagen'].append(await download)
+    except Exception as e:
+        await run_blocking(report_bijlage_error, conversatie, bericht, poststuk, e)
+        raise e
+
+    delivery_timestamp = datetime.now(tz=TIMEZONE).replace(microsecond=0).isoformat()
+
+    q_conversatie = construct_conversatie_exists_query(graph, conversatie['referentieABB'])
+    existing_conversaties = (await query(q_conversatie))['results']['bindings']
+    updates = prepare_conversatie(graph, conversatie, bericht, existing_conversaties, delivery_timestamp)
+
+    try:
+        updates += await run_blocking(save_bijlagen, graph, bericht, bericht['bijlagen'])
+        updates.append(construct_update_last_bericht_query(conversatie['uri']))
+        updates += await prepare_dossierbehandelaar(graph, bericht)
+        await update(construct_combined_update_query(updates))
+    except Exception as e:
+        await run_blocking(report_insert_error, graph, bericht, poststuk, e)
+        raise e
+
+
+async def prepare_dossierbehandelaar(graph, bericht):
+    q_exists = construct_dossierbehandelaar_exists_query(graph, bericht['dossierbehandelaar'])
+    return link_dossierbehandelaar(graph, bericht, (await query(q_exists))['results']['bindings'])
+
+
+async def get_sync_cursor():
+    try:
+        bindings = (await query(construct_select_sync_cursor_query(PUBLIC_GRAPH, SYNC_CURSOR_URI)))['results']['bindings']
+    except Exception as e:
+        log("Failed to retrieve the sync cursor, falling back to a full sweep: {}".format(e))
+        return (None, None)
+    return parse_sync_cursor(bindings)
+
+
+async def update_sync_cursor(processed_until, last_full_sweep):
+    q = construct_update_sync_cursor_query(PUBLIC_GRAPH,
+                                           SYNC_CURSOR_URI,
+                                           processed_until.replace(microsecond=0).isoformat(),
+                                           last_full_sweep.replace(microsecond=0).isoformat())
+    await update_with_suppressed_fail(q)
+    log("Sync cursor set to {}".format(processed_until.isoformat()))
+
+
+async def async_process_berichten_out():
+    """
+    Async counterpart of task_process_berichten_out.process_berichten_out().
+
+    :returns: None
+    """
+    await send_berichten_out(open_kalliope_api_session())
+
+
+async def async_dispatch_berichten_out():
+    """
+    Async counterpart of task_process_berichten_out.dispatch_berichten_out().
+
+    :returns: None
+    """
+    if kalliope_circuit.is_open():
+        return
+    bericht_uris = await run_blocking(berichten_out_queue.due, WORK_QUEUE_BATCH_SIZE)
+    if bericht_uris:
+        await send_berichten_out(open_kalliope_api_session(), bericht_uris)
+
+
+async def send_berichten_out(session, bericht_uris=None):
+    """
+    Send the unsent berichten to Kalliope, at most BERICHTEN_OUT_CONCURRENCY at the same time,
+    and record the outcomes in the berichten out queue.
+    """
+    graph_batches = [None] if bericht_uris else \
+        await run_blocking(bestuurseenheden_cache.organization_graph_batches, BERICHTEN_GEBRUIKER)
+    async with hold_lock(berichten_out_lock):
+        berichten = []
+        try:
+            for graph_uris in graph_batches:
+                q = construct_unsent_berichten_query(ABB_URI, MAX_SENDING_ATTEMPTS, graph_uris, bericht_uris)
+                berichten.extend((await query(q))['results']['bindings'])
+        except Exception as e:
+            await run_blocking(report_berichten_out_selection_error, bericht_uris, e)
+            return
+        berichten = await run_blocking(select_due_berichten_out, berichten, bericht_uris)
+        if len(berichten) == 0:
+            return
+        uris = [bericht_res['bericht']['value'] for bericht_res in berichten]
+        try:
+            (origineel_bericht_uris, bijlagen) = await get_berichten_enrichment(uris)
+        except Exception as e:
+            await run_blocking(report_enrichment_error, uris, bericht_uris, e)
+            return
+
+        errors = await gather_bounded(BERICHTEN_OUT_CONCURRENCY,
+                                      [process_bericht_out(session,
+                                                           bericht_res,
+                                                           origineel_bericht_uris.get(uri),
+                                                           bijlagen.get(uri, []))
+                                       for (uri, bericht_res) in zip(uris, berichten)])
+        await run_blocking(record_berichten_out_outcomes, uris, errors)
+
+
+async def get_berichten_enrichment(bericht_uris):
+    """
+    :returns: tuple of the form (origineel_bericht_uris, bijlagen), see task_process_berichten_out
+    """
+    origineel_bericht_uris = {}
+    bijlagen = {}
+    for i in range(0, len(bericht_uris), ENRICHMENT_BATCH_SIZE):
+        batch = bericht_uris[i:i + ENRICHMENT_BATCH_SIZE]
+        (originelen, batch_bijlagen) = await asyncio.gather(query(construct_select_original_berichten_query(batch)),
+                                                            query(construct_select_berichten_bijlagen_query(batch)))
+        collect_enrichment(originelen, batch_bijlagen, origineel_bericht_uris, bijlagen)
+    return (origineel_bericht_uris, bijlagen)
+
+
+async def process_bericht_out(session, bericht_res, origineel_bericht_uri, bijlagen):
+    """
+    :returns: None when the bericht was sent, the error otherwise
+    """
+    try:
+        (bericht, conversatie, bijlagen) = prepare_message_and_conversation(bericht_res, origineel_bericht_uri, bijlagen)
+        poststuk_in = construct_kalliope_poststuk_in(conversatie, bericht)
+        graph = organization_graph(bericht['van'], BERICHTEN_GEBRUIKER)
+        log("Posting bericht <{}>. Payload: {}".format(bericht['uri'], poststuk_in))
+
+        try:
+            post_result = await post_kalliope_poststuk_in(PS_IN_PATH, session, poststuk_in)
+        except CircuitOpenError as e:
+            raise e  # The bericht wasn't sent, so this isn't a failed attempt
+        except Exception as e:
+            await run_blocking(report_failed_attempt, poststuk_in, bericht, graph, e)
+            raise e
+
+        if post_result:
+            # We consider the moment when the api-call succeeded the 'ontvangen'-time
+            ontvangen = datetime.now(tz=TIMEZONE).replace(microsecond=0).isoformat()
+            await update(construct_bericht_sent_query(graph, bericht['uri'], ontvangen))
+            log("successfully sent bericht {} with {} bijlagen to Kalliope".format(bericht['uri'], len(bijlagen)))
+            return None
+        return ValueError("Kalliope didn't return a result for bericht {}".format(bericht['uri']))
+
+    except CircuitOpenError as e:
+        return e  # Reported once for the whole run
+    except Exception as e:
+        await run_blocking(report_bericht_out_error, bericht_res, e)
+        return e
+
+
+async def async_process_inzendingen():
+    """
+    Async counterpart of task_process_inzendingen_voor_toezicht.process_inzendingen().
+
+    :returns: None
+    """
+    await send_inzendingen(open_kalliope_api_session())
+
+
+async def async_dispatch_inzendingen():
+    """
+    Async counterpart of task_process_inzendingen_voor_toezicht.dispatch_inzendingen().
+
+    :returns: None
+    """
+    if kalliope_circuit.is_open():
+        return
+    inzending_uris = await run_blocking(inzendingen_queue.due, WORK_QUEUE_BATCH_SIZE)
+    if inzending_uris:
+        await send_inzendingen(open_kalliope_api_session(), inzending_uris)
+
+
+async def send_inzendingen(session, inzending_uris=None):
+    """
+    Send the unsent submissions to Kalliope, at most INZENDINGEN_CONCURRENCY at the same time,
+    and record the outcomes in the inzendingen queue.
+    """
+    graph_batches = [None] if inzending_uris else \
+        await run_blocking(bestuurseenheden_cache.organization_graph_batches, TOEZICHT_GEBRUIKER)
+    async with hold_lock(inzendingen_lock):
+        inzendingen = []
+        try:
+            for graph_uris in graph_batches:
+                q = construct_unsent_inzendingen_query(MAX_SENDING_ATTEMPTS, graph_uris, inzending_uris)
+                inzendingen.extend((await query(q))['results']['bindings'])
+        except Exception as e:
+            await run_blocking(report_inzendingen_selection_error, inzending_uris, inzending_uris, e)
+            return
+        inzendingen = await run_blocking(select_due_inzendingen, inzendingen, inzending_uris)
+        try:
+            included = await exclude_inzendingen_from_rules(inzendingen)
+        except Exception as e:
+            uris = [inzending['inzending']['value'] for inzending in inzendingen]
+            await run_blocking(report_inzendingen_selection_error, uris, inzending_uris, e)
+            return
+        errors = await send_unsent_inzendingen(session, included)
+        await run_blocking(record_inzendingen_outcomes, inzendingen, errors)
+
+
+async def send_unsent_inzendingen(session, inzendingen):
+    """
+    :returns: dict of the errors of the submissions that failed to be sent, keyed by submission URI
+    """
+    inzendingen = prepare_inzendingen(inzendingen)
+    errors = await gather_bounded(INZENDINGEN_CONCURRENCY,
+                                  [send_inzending(session, inzending) for inzending in inzendingen])
+    return {inzending['uri']: error for (inzending, error) in zip(inzendingen, errors) if error is not None}
+
+
+async def send_inzending(session, inzending):
+    """
+    :returns: None when the submission was sent, the error otherwise
+    """
+    try:
+        graph = organization_graph(inzending['afzenderUri'], TOEZICHT_GEBRUIKER)
+        try:
+            post_result = await post_kalliope_inzending_in(INZENDING_IN_PATH, session, inzending)
+        except CircuitOpenError as e:
+            return e  # Not sent, so not a failed attempt. Reported once for the whole run
+        except Exception as e:
+            await run_blocking(report_failed_inzending_attempt, inzending, graph, e)
+            return e
+
+        if post_result:
+            #  We consider the moment when the api-call succeeded the 'ontvangen'-time
+            ontvangen = datetime.now(tz=TIMEZONE).replace(microsecond=0).isoformat()
+            await update(construct_inzending_sent_query(graph, inzending['uri'], ontvangen))
+            log("successfully sent submission {} to Kalliope".format(inzending['uri']))
+            return None
+        return ValueError("Kalliope didn't return a result for submission {}".format(inzending['uri']))
+
+    except Exception as e:
+        await run_blocking(report_inzending_error, inzending, e)
+        return e
+
+
+async def exclude_inzendingen_from_rules(inzendingen):
+    """
+    Async counterpart of task_process_inzendingen_voor_toezicht.exclude_inzendingen_from_rules(),
+    the batches of rules are evaluated concurrently.
+    """
+    results = await asyncio.gather(*[query(q) for q in excluded_submissions_queries(inzendingen)])
+    excluded_submissions = set(binding['submission']['value']
+                               for result in results for binding in result['results']['bindings'])
+    return without_excluded_submissions(inzendingen, excluded_submissions)
+
+
+async def async_process_confirmations():
+    """
+    Async counterpart of task_process_berichten_in_confirmation.process_confirmations().
+
+    :returns: None
+    """
+    try:
+        log("Checking for new delivery confirmations to process")
+        await confirm_berichten(open_kalliope_api_session())
+    except Exception as e:
+        await run_blocking(report_confirmations_error, e)
+
+
+async def async_dispatch_confirmations():
+    """
+    Async counterpart of task_process_berichten_in_confirmation.dispatch_confirmations().
+
+    :returns: None
+    """
+    if kalliope_circuit.is_open():
+        return
+    graph_bericht_uris = await run_blocking(confirmations_queue.due, WORK_QUEUE_BATCH_SIZE)
+    if not graph_bericht_uris:
+        return
+    try:
+        await confirm_berichten(open_kalliope_api_session(), graph_bericht_uris)
+    except Exception as e:
+        await run_blocking(report_confirmations_error, e, graph_bericht_uris)
+
+
+async def confirm_berichten(session, graph_bericht_uris=None):
+    """
+    Send the confirmations of the unconfirmed berichten, at most CONFIRMATIONS_CONCURRENCY at the same time,
+    save the outcomes and record them in the confirmations queue.
+    """
+    (graph_batches, bericht_uris) = await run_blocking(confirmation_graph_batches, graph_bericht_uris)
+    async with hold_lock(confirmations_lock):
+        berichten = []
+        for graph_uris in graph_batches:
+            query_string = construct_get_messages_by_status(STATUS_DELIVERED_UNCONFIRMED,
+                                                            MAX_CONFIRMATION_ATTEMPTS,
+                                                            graph_uris,
+                                                            bericht_uris)
+            berichten.extend((await query(query_string)).get('results', {}).get('bindings', []))
+
+        berichten = await run_blocking(select_due_confirmations, berichten, graph_bericht_uris)
+        if len(berichten) == 0:
+            return
+        outcomes = await gather_bounded(CONFIRMATIONS_CONCURRENCY,
+                                        [process_confirmation(session, bericht) for bericht in berichten])
+        unsaved = await save_confirmation_outcomes(berichten, outcomes)
+        await run_blocking(record_confirmation_outcomes, berichten, outcomes, unsaved)
+
+
+async def process_confirmation(session, bericht):
+    """
+    :returns: the new status of the bericht or one of the outcomes of
+              task_process_berichten_in_confirmation.process_confirmation()
+    """
+    try:
+        poststuk_uit_confirmation = new_confirmation(bericht)
+        if poststuk_uit_confirmation is None:
+            return STATUS_DELIVERED_CONFIRMATION_FAILED
+        if await post_kalliope_poststuk_uit_confirmation(PS_UIT_CONFIRMATION_PATH, session, poststuk_uit_confirmation):
+            log("successfully sent confirmation to Kalliope for message {}".format(bericht["bericht"]["value"]))
+            return STATUS_DELIVERED_CONFIRMED
+        return None
+
+    except CircuitOpenError:
+        return CONFIRMATION_SHORT_CIRCUITED
+    except Exception as e:
+        await run_blocking(report_confirmation_error, bericht, e)
+        return CONFIRMATION_ATTEMPT_FAILED
+
+
+async def save_confirmation_outcomes(berichten, outcomes):
+    """
+    Async counterpart of task_process_berichten_in_confirmation.save_confirmation_outcomes().
+    """
+    unsaved = []
+    for (outcome, batch) in confirmation_outcome_batches(berichten, outcomes):
+        if outcome == CONFIRMATION_ATTEMPT_FAILED:
+            await update_with_suppressed_fail(construct_increment_confirmation_attempts_query(batch))
+            continue
+        try:
+            await update(construct_update_berichten_status_query(batch, outcome))
+        except Exception as e:
+            unsaved.extend(await run_blocking(report_unsaved_outcomes, batch, outcome, e))
+    return unsaved
@@ -0,0 +1,163 @@
+"""
+Benchmark of the ways the unsent berichten query can be scoped to the organization graphs:
+the REGEX filter on the graph name used before, VALUES ?g in batches of ORGANIZATION_GRAPHS_BATCH_SIZE graphs
+(the periodic jobs) and VALUES ?bericht in any organization graph (berichten queued by delta notifications),
+together with the count of the bestuurseenheden that precedes every periodic run.
+
+Run it in the service container against a scratch triple store, never against a production one,
+as it inserts thousands of graphs:
+
+    BENCHMARK_SPARQL_ENDPOINT=http://virtuoso:8890/sparql python benchmarks/graph_scoping.py setup
+    BENCHMARK_SPARQL_ENDPOINT=http://virtuoso:8890/sparql python benchmarks/graph_scoping.py run
+    BENCHMARK_SPARQL_ENDPOINT=http://virtuoso:8890/sparql python benchmarks/graph_scoping.py teardown
+"""
+import os
+import statistics
+import sys
+import time
+import types
+
+import requests
+
+# The service modules use relative imports, they're loaded as a package the way the mu-python-template does
+if "service" not in sys.modules:
+    package = types.ModuleType("service")
+    package.__path__ = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    sys.modules["service"] = package
+
+from service import queries  # noqa: E402
+
+SPARQL_ENDPOINT = os.environ.get('BENCHMARK_SPARQL_ENDPOINT', 'http://localhost:8890/sparql')
+ORGANIZATIONS = int(os.environ.get('BENCHMARK_ORGANIZATIONS', 2000))
+OTHER_GRAPHS = int(os.environ.get('BENCHMARK_OTHER_GRAPHS', 5000))
+RUNS = int(os.environ.get('BENCHMARK_RUNS', 5))
+BATCH_SIZE = int(os.environ.get('ORGANIZATION_GRAPHS_BATCH_SIZE', 500))
+QUEUED_BERICHTEN = 50
+INSERT_BATCH_SIZE = 100
+
+ABB_URI = "http://data.lblod.info/id/bestuurseenheden/141d9d6b-54af-4d17-b313-8d1c30bc3f5b"
+BENCH_PREFIX = "http://data.lblod.info/id/benchmark/"
+REGEX_FILTER = 'FILTER(REGEX(STR(?g), "http://mu.semte.ch/graphs/organizations/.*/LoketLB-berichtenGebruiker"))'
+
+
+def organization_graph(i, gebruiker="LoketLB-berichtenGebruiker"):
+    return "{}benchmark-{}/{}".format(queries.ORGANIZATION_GRAPHS_PREFIX, i, gebruiker)
+
+
+def other_graph(j):
+    return "http://mu.semte.ch/graphs/benchmark-{}".format(j)
+
+
+def bericht_uri(i):
+    return "{}berichten/{}".format(BENCH_PREFIX, i)
+
+
+def organization_data(i):
+    return """
+        GRAPH <{graph}> {{
+            <{bench}conversaties/{i}> a schema:Conversation ;
+                schema:identifier "BENCH-{i}" ;
+                schema:about "Benchmark {i}" ;
+                schema:hasPart <{bericht}> .
+            <{bericht}> a schema:Message ;
+                mu:uuid "benchmark-bericht-{i}" ;
+                schema:dateSent "2020-05-05T11:32:52+02:00"^^xsd:dateTime ;
+                schema:text "Benchmark" ;
+                schema:sender <{bench}bestuurseenheden/{i}> ;
+                schema:recipient <{abb}> .
+            <{bench}bestuurseenheden/{i}> a besluit:Bestuurseenheid .
+        }}
+        GRAPH <{toezicht}> {{
+            <{bench}toezicht/{i}> a schema:Thing .
+        }}
+    """.format(graph=organization_graph(i), toezicht=organization_graph(i, "LoketLB-toezichtGebruiker"),
+               bench=BENCH_PREFIX, bericht=bericht_uri(i), abb=ABB_URI, i=i)
+
+
+def other_data(j):
+    return "GRAPH <{}> {{ <{}other/{}> a schema:Thing . }}".format(other_graph(j), BENCH_PREFIX, j)
+
+
+def sparql_update(q):
+    r = requests.post(SPARQL_ENDPOINT, data={'update': q})
+    r.raise_for_status()
+
+
+def sparql_query(q):
+    r = requests.post(SPARQL_ENDPOINT, data={'query': q}, headers={'Accept': 'application/sparql-results+json'})
+    r.raise_for_status()
+    return r.json()['results']['bindings']
+
+
+def insert(data):
+    for i in range(0, len(data), INSERT_BATCH_SIZE):
+        sparql_update("""
+            PREFIX schema: <http://schema.org/>
+            PREFIX mu: <http://mu.semte.ch/vocabularies/core/>
+            PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+            PREFIX besluit: <http://data.vlaanderen.be/ns/besluit#>
+            INSERT DATA {{ {} }}
+        """.format("\n".join(data[i:i + INSERT_BATCH_SIZE])))
+
+
+def setup():
+    insert([organization_data(i) for i in range(ORGANIZATIONS)])
+    insert([other_data(j) for j in range(OTHER_GRAPHS)])
+    print("Inserted {} organizations ({} graphs) and {} other graphs".format(ORGANIZATIONS, 2 * ORGANIZATIONS,
+                                                                          OTHER_GRAPHS))
+
+
+def teardown():
+    graphs = [organization_graph(i) for i in range(ORGANIZATIONS)] + \
+        [organization_graph(i, "LoketLB-toezichtGebruiker") for i in range(ORGANIZATIONS)] + \
+        [other_graph(j) for j in range(OTHER_GRAPHS)]
+    for i in range(0, len(graphs), INSERT_BATCH_SIZE):
+        sparql_update(";\n".join("CLEAR SILENT GRAPH <{}>".format(graph) for graph in graphs[i:i + INSERT_BATCH_SIZE]))
+    print("Cleared {} graphs".format(len(graphs)))
+
+
+def measure(name, queries_to_run):
+    """
+    :param queries_to_run: list of queries, together making up one run
+    :returns: number of rows found per run
+    """
+    durations = []
+    for _ in range(RUNS):
+        started_at = time.perf_counter()
+        rows = sum(len(sparql_query(q)) for q in queries_to_run)
+        durations.append(time.perf_counter() - started_at)
+    print("{:<45} {:>3} queries {:>6} rows  median {:8.3f}s  min {:8.3f}s  max {:8.3f}s".format(
+        name, len(queries_to_run), rows, statistics.median(durations), min(durations), max(durations)))
+    return rows
+
+
+def run():
+    any_graph = queries.construct_unsent_berichten_query(ABB_URI, 3, None)
+    scope = queries.construct_graph_scope_statement(None, "LoketLB-berichtenGebruiker")
+    regex = any_graph.replace(scope, REGEX_FILTER)
+    graphs = [organization_graph(i) for i in range(ORGANIZATIONS)]
+    batches = [queries.construct_unsent_berichten_query(ABB_URI, 3, graphs[i:i + BATCH_SIZE])
+               for i in range(0, len(graphs), BATCH_SIZE)]
+    queued = [bericht_uri(i) for i in range(0, ORGANIZATIONS, max(1, ORGANIZATIONS // QUEUED_BERICHTEN))]
+
+    print("{} runs, {} organizations, {} other graphs".format(RUNS, ORGANIZATIONS, OTHER_GRAPHS))
+    sweep_rows = [
+        measure("REGEX on the graph name (before)", [regex]),
+        measure("VALUES ?g, {} graphs per query".format(BATCH_SIZE), batches),
+    ]
+    measure("count of the bestuurseenheden", [queries.construct_count_bestuurseenheden_query()])
+    queued_rows = [
+        measure("REGEX, {} queued berichten (before)".format(len(queued)),
+                [queries.construct_unsent_berichten_query(ABB_URI, 3, None, queued).replace(scope, REGEX_FILTER)]),
+        measure("any organization graph, {} queued berichten".format(len(queued)),
+                [queries.construct_unsent_berichten_query(ABB_URI, 3, None, queued)]),
+    ]
+    if len(set(sweep_rows)) != 1 or len(set(queued_rows)) != 1:
+        sys.exit("The ways of scoping found different numbers of berichten: {} {}".format(sweep_rows, queued_rows))
+
+
+if __name__ == '__main__':
+    commands = {'setup': setup, 'run': run, 'teardown': teardown}
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        sys.exit("Usage: {} setup|run|teardown".format(sys.argv[0]))
+    commands[sys.argv[1]]()
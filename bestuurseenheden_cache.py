@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from helpers import log
+from .sudo_query_helpers import query
+from .queries import construct_select_bestuurseenheden_query
+from .queries import construct_bestuurseenheid_exists_query
+from .queries import construct_count_bestuurseenheden_query
+
+BESTUURSEENHEDEN_CACHE_TTL = int(os.environ.get('BESTUURSEENHEDEN_CACHE_TTL', 3600))  # in seconds
+BESTUURSEENHEDEN_MISS_TTL = int(os.environ.get('BESTUURSEENHEDEN_MISS_TTL', 300))  # in seconds
+BESTUURSEENHEDEN_PAGE_SIZE = 5000
+ORGANIZATION_GRAPHS_BATCH_SIZE = int(os.environ.get('ORGANIZATION_GRAPHS_BATCH_SIZE', 500))
+BERICHTEN_GEBRUIKER = "LoketLB-berichtenGebruiker"
+TOEZICHT_GEBRUIKER = "LoketLB-toezichtGebruiker"
+
+
+def organization_graph(bestuurseenheid_uri, gebruiker):
+    """
+    Determine the organization graph of a bestuurseenheid for the given type of user.
+
+    :param bestuurseenheid_uri: string
+    :param gebruiker: BERICHTEN_GEBRUIKER or TOEZICHT_GEBRUIKER
+    :returns: string containing the graph URI
+    """
+    bestuurseenheid_uuid = bestuurseenheid_uri.split('/')[-1]
+    return "http://mu.semte.ch/graphs/organizations/{}/{}".format(bestuurseenheid_uuid, gebruiker)
+
+
+class BestuurseenhedenCache:
+    """
+    In-process cache of the bestuurseenheden known in our database. The whole set is (re)loaded with one
+    bulk query once the TTL expired, a bestuurseenheid that isn't cached is checked with a single targeted query.
+    A bestuurseenheid that wasn't found by that check is taken as unknown for miss_ttl.
+    """
+
+    def __init__(self, ttl, miss_ttl):
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.lock = threading.Lock()
+        self.bestuurseenheden = set()
+        self.misses = {}  # bestuurseenheid URI -> time at which it wasn't found in our database
+        self.loaded_at = None
+
+    def load(self):
+        bestuurseenheden = set()
+        offset = 0
+        while True:
+            q = construct_select_bestuurseenheden_query(BESTUURSEENHEDEN_PAGE_SIZE, offset)
+            bindings = query(q)['results']['bindings']
+            bestuurseenheden.update(binding['bestuurseenheid']['value'] for binding in bindings)
+            if len(bindings) < BESTUURSEENHEDEN_PAGE_SIZE:
+                break
+            offset += BESTUURSEENHEDEN_PAGE_SIZE
+        self.bestuurseenheden = bestuurseenheden
+        self.misses = {}
+        self.loaded_at = time.monotonic()
+        log("Loaded {} bestuurseenheden in cache".format(len(bestuurseenheden)))
+
+    def refresh_if_expired(self):
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+                self.load()
+
+    def refresh_if_changed(self):
+        """
+        Reload the cache when our database holds another number of bestuurseenheden than the cache,
+        e.g. because an organization was added since the last load.
+        """
+        bindings = query(construct_count_bestuurseenheden_query())['results']['bindings']
+        count = int(bindings[0]['count']['value'])
+        with self.lock:
+            if self.loaded_at is None or count != len(self.bestuurseenheden):
+                log("Found {} bestuurseenheden in our database, {} in cache".format(count, len(self.bestuurseenheden)))
+                self.load()
+
+    def is_known(self, bestuurseenheid_uri):
+        """
+        Check if a bestuurseenheid exists in our database.
+
+        :param bestuurseenheid_uri: string
+        :returns: boolean
+        """
+        self.refresh_if_expired()
+        if bestuurseenheid_uri in self.bestuurseenheden:
+            return True
+        with self.lock:
+            missed_at = self.misses.get(bestuurseenheid_uri)
+        if missed_at is not None and time.monotonic() - missed_at < self.miss_ttl:
+            return False
+        if query(construct_bestuurseenheid_exists_query(bestuurseenheid_uri))['boolean']:
+            log("Bestuurseenheid {} was missing in cache, adding it".format(bestuurseenheid_uri))
+            with self.lock:
+                self.bestuurseenheden.add(bestuurseenheid_uri)
+                self.misses.pop(bestuurseenheid_uri, None)
+            return True
+        with self.lock:
+            self.misses[bestuurseenheid_uri] = time.monotonic()
+        return False
+
+    def organization_graphs(self, gebruiker):
+        """
+        List the organization graphs of all known bestuurseenheden for the given type of user.
+
+        :param gebruiker: BERICHTEN_GEBRUIKER or TOEZICHT_GEBRUIKER
+        :returns: list of graph URIs
+        """
+        self.refresh_if_expired()
+        return [organization_graph(uri, gebruiker) for uri in sorted(self.bestuurseenheden)]
+
+    def organization_graph_batches(self, gebruiker):
+        """
+        Split the organization graphs of all known bestuurseenheden in batches of ORGANIZATION_GRAPHS_BATCH_SIZE,
+        to be used as VALUES ?g in queries that would otherwise have to match every graph in the triple store.
+        The cache is brought up to date first, so the graphs of a new organization are included right away.
+
+        :param gebruiker: BERICHTEN_GEBRUIKER or TOEZICHT_GEBRUIKER
+        :returns: list of lists of graph URIs
+        """
+        self.refresh_if_changed()
+        graphs = self.organization_graphs(gebruiker)
+        return [graphs[i:i + ORGANIZATION_GRAPHS_BATCH_SIZE] for i in range(0, len(graphs), ORGANIZATION_GRAPHS_BATCH_SIZE)]
+
+
+bestuurseenheden_cache = BestuurseenhedenCache(BESTUURSEENHEDEN_CACHE_TTL, BESTUURSEENHEDEN_MISS_TTL)
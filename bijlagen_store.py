@@ -0,0 +1,125 @@
+import os
+import shutil
+import threading
+import time
+import magic
+from helpers import log
+from .kalliope_adapter import BIJLAGEN_FOLDER_PATH
+from .kalliope_adapter import MIMETYPE_SNIFF_SIZE
+from .kalliope_adapter import TMP_FILE_PREFIX
+
+STALE_DOWNLOAD_MAX_AGE = int(os.environ.get('STALE_DOWNLOAD_MAX_AGE', 24))  # in hours
+
+# Content-addressed store: every distinct content is kept once, under its SHA-256.
+# The files referenced from the triple store (<kalliope-id>.<extension>) are hardlinks to these objects.
+OBJECTS_FOLDER_PATH = os.path.join(BIJLAGEN_FOLDER_PATH, ".objects")
+
+objects_lock = threading.Lock()  # Keeps an object from being removed while it's being linked
+
+
+def stored_file_name(bijlage):
+    """
+    Name of the (logical) file of a bijlage in BIJLAGEN_FOLDER_PATH.
+
+    :param bijlage: dict of bijlage properties as returned by new_bijlage()
+    :returns: string
+    """
+    return bijlage['id'] + "." + bijlage['extension']
+
+
+def find_stored_bijlage(file_name):
+    """
+    Look up a bijlage that was downloaded before.
+
+    :param file_name: name of the file as returned by stored_file_name()
+    :returns: dict with the size and mimetype of the stored file, None if it isn't stored yet
+    """
+    filepath = os.path.join(BIJLAGEN_FOLDER_PATH, file_name)
+    try:
+        with open(filepath, 'rb') as f:
+            head = f.read(MIMETYPE_SNIFF_SIZE)
+            size = os.fstat(f.fileno()).st_size
+    except FileNotFoundError:
+        return None
+    return {
+        'size': size,
+        'mimetype': magic.from_buffer(head, mime=True),
+    }
+
+
+def store_bijlage(tmp_filepath, sha256, file_name):
+    """
+    Store a downloaded bijlage under the given file name. If the same content is already stored,
+    the download is dropped and the file becomes another link to the existing content.
+
+    :param tmp_filepath: path of the downloaded file, as returned by get_kalliope_bijlage()
+    :param sha256: SHA-256 hex digest of the downloaded content
+    :param file_name: name of the file as returned by stored_file_name()
+    """
+    object_path = stored_object_path(sha256)
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    with objects_lock:
+        if os.path.exists(object_path):
+            log("Content of {} is already stored as {}, not storing it again".format(file_name, sha256))
+            os.remove(tmp_filepath)
+        else:
+            os.replace(tmp_filepath, object_path)
+
+        filepath = os.path.join(BIJLAGEN_FOLDER_PATH, file_name)
+        tmp_link = object_path + "." + file_name
+        try:
+            os.link(object_path, tmp_link)
+        except OSError as e:  # e.g. the maximum number of links is reached
+            log("Failed to link {} to {}, storing a copy instead: {}".format(file_name, sha256, e))
+            shutil.copyfile(object_path, tmp_link)
+            os.chmod(tmp_link, 0o644)
+        os.replace(tmp_link, filepath)
+
+
+def remove_stored_bijlage(sha256, file_name):
+    """
+    Remove a bijlage stored by store_bijlage(). Its content is removed as well, unless other files still link to it.
+
+    :param sha256: SHA-256 hex digest of the content
+    :param file_name: name of the file as returned by stored_file_name()
+    """
+    object_path = stored_object_path(sha256)
+    with objects_lock:
+        try:
+            os.remove(os.path.join(BIJLAGEN_FOLDER_PATH, file_name))
+        except FileNotFoundError:
+            pass
+        try:
+            if os.stat(object_path).st_nlink == 1:
+                os.remove(object_path)
+        except FileNotFoundError:
+            pass
+    log("Removed stored bijlage {}".format(file_name))
+
+
+def remove_stale_downloads():
+    """
+    Remove the temporary files of bijlage downloads that were interrupted without cleaning up (e.g. by a crash),
+    once they haven't been written to for STALE_DOWNLOAD_MAX_AGE.
+
+    :returns: number of files removed
+    """
+    removed_before = time.time() - STALE_DOWNLOAD_MAX_AGE * 3600
+    count = 0
+    with os.scandir(BIJLAGEN_FOLDER_PATH) as entries:
+        for entry in entries:
+            if not entry.name.startswith(TMP_FILE_PREFIX) or not entry.is_file(follow_symlinks=False):
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < removed_before:
+                    os.remove(entry.path)
+                    count += 1
+            except FileNotFoundError:
+                pass
+    if count:
+        log("Removed {} stale bijlage download(s) from {}".format(count, BIJLAGEN_FOLDER_PATH))
+    return count
+
+
+def stored_object_path(sha256):
+    return os.path.join(OBJECTS_FOLDER_PATH, sha256[:2], sha256)
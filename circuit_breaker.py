@@ -0,0 +1,77 @@
+import threading
+import time
+import requests.exceptions
+from helpers import log
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised instead of sending a request while the circuit is open. Being a ConnectionError, it's handled like
+    any other transport failure by code that doesn't know about the circuit breaker.
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker shared by all threads calling a remote service.
+    After failure_threshold consecutive failures the circuit opens: requests are rejected with CircuitOpenError
+    without being sent. Once reset_timeout passed, a single probe request is let through (half-open):
+    if it succeeds the circuit closes again, if it fails the circuit stays open for another reset_timeout.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        """
+        :param name: name of the remote service, used for logging
+        :param failure_threshold: number of consecutive failures after which the circuit opens
+        :param reset_timeout: time (in seconds) the circuit stays open before a probe request is let through
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def is_open(self):
+        """
+        :returns: True when requests are currently being rejected, i.e. the circuit is open and no probe is due yet
+        """
+        with self.lock:
+            return self.state != CLOSED and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def before_request(self):
+        """
+        Check whether a request may be sent, raises CircuitOpenError otherwise.
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            # A new probe is also let through when the previous one never reported back
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.opened_at = time.monotonic()
+                log("Circuit of {} is half-open, sending a probe request".format(self.name))
+                return
+            raise CircuitOpenError("Circuit of {} is open after {} consecutive failures, request not sent"
+                                   .format(self.name, self.consecutive_failures))
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                log("Circuit of {} is closed again".format(self.name))
+            self.state = CLOSED
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or \
+                    (self.state == CLOSED and self.consecutive_failures >= self.failure_threshold):
+                log("Circuit of {} opened after {} consecutive failures".format(self.name, self.consecutive_failures))
+                self.state = OPEN
+                self.opened_at = time.monotonic()
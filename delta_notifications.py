@@ -0,0 +1,34 @@
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+ADMS_STATUS = "http://www.w3.org/ns/adms#status"
+SCHEMA_MESSAGE = "http://schema.org/Message"
+SCHEMA_HAS_PART = "http://schema.org/hasPart"
+MEB_SUBMISSION = "http://rdf.myexperiment.org/ontologies/base/Submission"
+SUBMISSION_STATUS_SENT = "http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c"
+
+
+def extract_outbound_subjects(changesets):
+    """
+    Extract the berichten and inzendingen that might have become ready to be sent from a delta notification.
+    Only inserted triples are considered: a new schema:Message or a bericht added to a conversatie
+    (schema:hasPart, often written in a later request than the bericht), or a meb:Submission
+    (or a submission status) that was inserted.
+    The objects of schema:hasPart aren't necessarily berichten, the unsent berichten query only finds those that are.
+
+    :param changesets: the delta notification body, as sent by the mu-delta-notifier (v0.0.1 format)
+    :returns: tuple of the form (bericht_uris, inzending_uris)
+    """
+    bericht_uris = []
+    inzending_uris = []
+    for changeset in changesets:
+        for triple in changeset.get('inserts', []):
+            subject = triple['subject']['value']
+            predicate = triple['predicate']['value']
+            obj = triple['object']['value']
+            if predicate == RDF_TYPE and obj == SCHEMA_MESSAGE:
+                bericht_uris.append(subject)
+            elif predicate == SCHEMA_HAS_PART:
+                bericht_uris.append(obj)
+            elif (predicate == RDF_TYPE and obj == MEB_SUBMISSION) or \
+                    (predicate == ADMS_STATUS and obj == SUBMISSION_STATUS_SENT):
+                inzending_uris.append(subject)
+    return (list(dict.fromkeys(bericht_uris)), list(dict.fromkeys(inzending_uris)))
@@ -0,0 +1,71 @@
+import asyncio
+import functools
+import threading
+from contextlib import asynccontextmanager
+from .job_scheduler import current_job
+
+loop = None
+loop_lock = threading.Lock()
+
+
+def event_loop():
+    """
+    Start (once) the event loop on which the async tasks run, on a thread of its own.
+    All async tasks share this loop, and with it their HTTP sessions and connection pools.
+    """
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="event-loop", daemon=True).start()
+    return loop
+
+
+def in_event_loop(coroutine_function):
+    """
+    Wrap a coroutine function into a regular function running it on the shared event loop, so it can be scheduled
+    like any other job. The calling thread blocks until the coroutine is done.
+    """
+    @functools.wraps(coroutine_function)
+    def run(*args, **kwargs):
+        job = current_job.get()
+
+        async def run_as_job():
+            current_job.set(job)  # Inherited by the tasks the coroutine starts
+            return await coroutine_function(*args, **kwargs)
+        return asyncio.run_coroutine_threadsafe(run_as_job(), event_loop()).result()
+    return run
+
+
+async def run_blocking(func, *args):
+    """
+    Run a blocking call (local database, disk, synchronous queries) on a thread, without blocking the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+@asynccontextmanager
+async def hold_lock(lock):
+    """
+    Hold a threading lock from within the event loop, e.g. to keep an async task from running concurrently
+    with its synchronous counterpart.
+    """
+    await run_blocking(lock.acquire)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+async def gather_bounded(concurrency, coroutines):
+    """
+    Await the given coroutines with at most concurrency of them running at the same time.
+
+    :returns: list of their results, in the same order as the coroutines
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+    return await asyncio.gather(*[bounded(coroutine) for coroutine in coroutines])
@@ -0,0 +1,138 @@
+import contextvars
+import functools
+import threading
+import time
+from concurrent import futures
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.schedulers.background import BackgroundScheduler
+from helpers import log
+
+MISFIRE_GRACE_TIME = 5 * 60  # in seconds
+
+# Name of the job on behalf of which the current thread (or async task) runs, e.g. to share rate limits fairly
+current_job = contextvars.ContextVar('current_job', default=None)
+
+
+def job_executor(max_workers):
+    """
+    Create a thread pool of which the workers run on behalf of the current job, see current_job.
+    """
+    return futures.ThreadPoolExecutor(max_workers=max_workers,
+                                      initializer=current_job.set,
+                                      initargs=(current_job.get(),))
+
+
+class JobStats:
+    """
+    Run statistics of a scheduled job.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.running_since = None
+        self.last_started_at = None
+        self.last_duration = None
+        self.max_duration = 0
+        self.total_duration = 0
+
+    def started(self):
+        with self.lock:
+            self.running_since = time.monotonic()
+            self.last_started_at = time.time()
+
+    def finished(self, failed):
+        with self.lock:
+            duration = time.monotonic() - self.running_since
+            self.running_since = None
+            self.runs += 1
+            self.failures += int(failed)
+            self.last_duration = duration
+            self.max_duration = max(self.max_duration, duration)
+            self.total_duration += duration
+        return duration
+
+    def skip(self):
+        with self.lock:
+            self.skipped += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'runs': self.runs,
+                'failures': self.failures,
+                'skipped': self.skipped,
+                'running': self.running_since is not None,
+                'last-started-at': self.last_started_at,
+                'last-duration': self.last_duration,
+                'max-duration': self.max_duration,
+                'average-duration': self.total_duration / self.runs if self.runs else None,
+            }
+
+
+class JobScheduler:
+    """
+    Background scheduler on which every job runs on its own executor, with its own thread budget.
+    A job never overlaps with itself: a tick that fires while the previous run is still busy is skipped,
+    missed ticks (e.g. while the scheduler was blocked) are coalesced into a single run.
+    """
+
+    def __init__(self):
+        self.scheduler = BackgroundScheduler(job_defaults={
+            'coalesce': True,
+            'max_instances': 1,
+            'misfire_grace_time': MISFIRE_GRACE_TIME,
+        })
+        self.stats = {}
+        self.scheduler.add_listener(self.on_skipped, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
+
+    def add_job(self, func, trigger, threads=1, name=None):
+        """
+        Register a job on its own executor, so it can't be starved by the other jobs.
+
+        :param func: the function to run
+        :param trigger: an APScheduler trigger, e.g. CronTrigger.from_crontab(pattern)
+        :param threads: number of threads of the executor of the job
+        :param name: name of the job, defaults to the name of the function
+        """
+        name = name or func.__name__
+        self.stats[name] = JobStats()
+        self.scheduler.add_executor(ThreadPoolExecutor(threads), alias=name)
+        self.scheduler.add_job(self.measured(name, func), trigger, id=name, name=name, executor=name)
+
+    def measured(self, name, func):
+        stats = self.stats[name]
+
+        @functools.wraps(func)
+        def run():
+            current_job.set(name)
+            stats.started()
+            failed = True
+            try:
+                func()
+                failed = False
+            finally:
+                duration = stats.finished(failed)
+                log("Job {} finished in {:.1f}s".format(name, duration))
+        return run
+
+    def on_skipped(self, event):
+        stats = self.stats.get(event.job_id)
+        if stats:
+            stats.skip()
+            # EVENT_JOB_MAX_INSTANCES carries scheduled_run_times, EVENT_JOB_MISSED a single scheduled_run_time
+            run_times = getattr(event, 'scheduled_run_times', None) or [event.scheduled_run_time]
+            log("Skipped a run of job {} scheduled at {}, the previous run is still busy or the tick was missed"
+                .format(event.job_id, ", ".join(str(run_time) for run_time in run_times)))
+
+    def job_stats(self):
+        """
+        :returns: dict of run statistics per job name
+        """
+        return {name: stats.as_dict() for (name, stats) in self.stats.items()}
+
+    def start(self):
+        self.scheduler.start()
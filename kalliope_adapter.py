@@ -1,20 +1,78 @@
 #!/usr/bin/python3
 from datetime import datetime
+from contextlib import contextmanager
 from pytz import timezone
+import hashlib
 import json
 import os
 import re
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse, urlencode, parse_qsl
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import magic
 import helpers
 from helpers import log
+from .multipart_stream import MultipartStream
+from .circuit_breaker import CircuitBreaker
+from .page_sizer import PageSizer
+from .rate_limiter import RateLimiter, parse_retry_after
+from .job_scheduler import current_job, job_executor
 
 TIMEZONE = timezone('Europe/Brussels')
 ABB_URI = "http://data.lblod.info/id/bestuurseenheden/141d9d6b-54af-4d17-b313-8d1c30bc3f5b"
 BIJLAGEN_FOLDER_PATH = "/data/files"
 CERT_BUNDLE_PATH = "/etc/ssl/certs/ca-certificates.crt"
 
-MAX_REQ_CHUNK_SIZE = 10
+MIN_PAGE_SIZE = 10
+KALLIOPE_MAX_PAGE_SIZE = int(os.environ.get('KALLIOPE_MAX_PAGE_SIZE', 200))
+KALLIOPE_PAGE_LATENCY_TARGET = float(os.environ.get('KALLIOPE_PAGE_LATENCY_TARGET', 10))  # in seconds
+KALLIOPE_PAGE_TIMEOUT = float(os.environ.get('KALLIOPE_PAGE_TIMEOUT', 60))  # in seconds
+PAGE_ATTEMPTS = 3
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MIMETYPE_SNIFF_SIZE = 8 * 1024
+TMP_FILE_PREFIX = ".download-"
+# Rate over all endpoints of the host, 0: no limit
+KALLIOPE_MAX_REQUESTS_PER_SECOND = float(os.environ.get('KALLIOPE_MAX_REQUESTS_PER_SECOND', 0))
+# Rates per endpoint on top of the host rate, e.g. "poststuk-in=1,bijlagen=10"
+KALLIOPE_ENDPOINT_RATE_LIMITS = {endpoint.strip(): float(rate) for (endpoint, rate) in
+                                 (limit.split('=') for limit in
+                                  os.environ.get('KALLIOPE_ENDPOINT_RATE_LIMITS', '').split(',') if limit.strip())}
+KALLIOPE_RATE_LIMIT_BURST = int(os.environ.get('KALLIOPE_RATE_LIMIT_BURST', 1))
+
+ENDPOINT_POSTSTUKKEN_UIT = "poststukken-uit"
+ENDPOINT_BIJLAGEN = "bijlagen"
+ENDPOINT_POSTSTUK_IN = "poststuk-in"
+ENDPOINT_CONFIRMATIONS = "confirmations"
+ENDPOINT_INZENDINGEN = "inzendingen"
+
+KALLIOPE_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('KALLIOPE_CIRCUIT_FAILURE_THRESHOLD', 5))
+KALLIOPE_CIRCUIT_RESET_TIMEOUT = float(os.environ.get('KALLIOPE_CIRCUIT_RESET_TIMEOUT', 120))  # in seconds
+
+KALLIOPE_POOL_SIZE = int(os.environ.get('KALLIOPE_POOL_SIZE', 32))
+KALLIOPE_CONNECT_TIMEOUT = float(os.environ.get('KALLIOPE_CONNECT_TIMEOUT', 10))  # in seconds
+KALLIOPE_READ_TIMEOUT = float(os.environ.get('KALLIOPE_READ_TIMEOUT', 120))  # in seconds
+KALLIOPE_RETRIES = int(os.environ.get('KALLIOPE_RETRIES', 3))
+KALLIOPE_RETRY_BACKOFF = float(os.environ.get('KALLIOPE_RETRY_BACKOFF', 1))  # in seconds
+RETRY_STATUSES = (429, 502, 503, 504)
+THROTTLED_STATUSES = (429, 503)
+
+kalliope_rate_limiter = RateLimiter('Kalliope API',
+                                    KALLIOPE_MAX_REQUESTS_PER_SECOND,
+                                    KALLIOPE_ENDPOINT_RATE_LIMITS,
+                                    KALLIOPE_RATE_LIMIT_BURST)
+page_sizer = PageSizer(MIN_PAGE_SIZE, KALLIOPE_MAX_PAGE_SIZE, KALLIOPE_PAGE_LATENCY_TARGET)
+kalliope_circuit = CircuitBreaker('Kalliope API', KALLIOPE_CIRCUIT_FAILURE_THRESHOLD, KALLIOPE_CIRCUIT_RESET_TIMEOUT)
+kalliope_sessions = {}  # per certificate bundle
+kalliope_sessions_lock = threading.Lock()
+
+
+class KalliopeParseError(ValueError):
+    """Raised when a poststuk we received from the Kalliope API lacks data we need or holds invalid data."""
+    pass
 
 
 def new_conversatie(referentieABB,
@@ -51,54 +109,184 @@ def new_bericht(verzonden,
     return bericht
 
 
-def open_kalliope_api_session(verify=CERT_BUNDLE_PATH):
+def new_kalliope_api_session(verify):
+    """
+    Create a Kalliope session keeping up to KALLIOPE_POOL_SIZE connections alive per host.
+    Only GETs are retried by the transport, on connection errors and 429/502/503/504 responses (honouring Retry-After).
+    POSTs aren't: a poststuk-in that timed out might have been created already.
+    Read timeouts aren't retried either, a page that times out is retried with a smaller page size instead.
+    """
     s = requests.Session()
     s.auth = (os.environ.get('KALLIOPE_API_USERNAME'), os.environ.get('KALLIOPE_API_PASSWORD'))
     s.verify = verify
+    s.headers['Accept-Encoding'] = 'gzip, deflate'
+    retry = Retry(total=KALLIOPE_RETRIES,
+                  read=False,
+                  backoff_factor=KALLIOPE_RETRY_BACKOFF,
+                  status_forcelist=RETRY_STATUSES,
+                  allowed_methods=frozenset(['GET']),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=KALLIOPE_POOL_SIZE, max_retries=retry)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
     return s
 
 
+@contextmanager
+def open_kalliope_api_session(verify=CERT_BUNDLE_PATH):
+    """
+    Context manager providing the Kalliope session shared by all jobs, so connections are kept alive across runs.
+    The session isn't closed when the context exits.
+    """
+    with kalliope_sessions_lock:
+        if verify not in kalliope_sessions:
+            kalliope_sessions[verify] = new_kalliope_api_session(verify)
+        session = kalliope_sessions[verify]
+    yield session
+
+
+def kalliope_request(session, method, url, endpoint, idempotent=False, **kwargs):
+    """
+    Send a request to the Kalliope API, within the rate limits of the endpoint and the host and through the Kalliope
+    circuit breaker: transport failures and 5xx responses count as failures, while the circuit is open
+    CircuitOpenError is raised without sending the request. A throttled response (429, 503) with a Retry-After
+    pauses the endpoint.
+    Unless a timeout is given, KALLIOPE_CONNECT_TIMEOUT and KALLIOPE_READ_TIMEOUT apply.
+
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param method: HTTP method
+    :param url: url of the request
+    :param endpoint: name of the endpoint (ENDPOINT_*) of which the rate limit applies
+    :param idempotent: True for a POST that is safe to send again, it's retried like the GETs are
+    :param kwargs: passed on to session.request()
+    :returns: the response
+    """
+    kwargs.setdefault('timeout', (KALLIOPE_CONNECT_TIMEOUT, KALLIOPE_READ_TIMEOUT))
+    attempts = 1 + (KALLIOPE_RETRIES if idempotent and method != 'GET' else 0)  # GETs are retried by the transport
+    for attempt in range(1, attempts + 1):
+        kalliope_circuit.before_request()
+        kalliope_rate_limiter.acquire(endpoint, current_job.get())
+        try:
+            r = session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            kalliope_circuit.record_failure()
+            if attempt == attempts:
+                raise e
+            log("Kalliope request {} {} failed, retrying: {}".format(method, url, e))
+        else:
+            if r.status_code >= 500:
+                kalliope_circuit.record_failure()
+            else:
+                kalliope_circuit.record_success()
+            if r.status_code in THROTTLED_STATUSES:
+                pause_throttled_endpoint(endpoint, r.headers.get('Retry-After'))
+            if r.status_code not in RETRY_STATUSES or attempt == attempts:
+                return r
+            log("Kalliope request {} {} failed (statuscode {}), retrying".format(method, url, r.status_code))
+        time.sleep(KALLIOPE_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+
+def pause_throttled_endpoint(endpoint, retry_after):
+    """
+    Pause the requests to an endpoint for as long as asked by the Retry-After header of a throttled response.
+    """
+    seconds = parse_retry_after(retry_after)
+    if seconds:
+        kalliope_rate_limiter.pause(endpoint, seconds)
+
+
 def get_kalliope_bijlage(path, session):
     """
     Perform the API-call to get a poststuk-uit bijlage.
+    The bijlage is streamed to a temporary file in BIJLAGEN_FOLDER_PATH, its size, SHA-256 and mimetype
+    are determined along the way.
 
     :param path: url of the api endpoint that we want to fetch
     :param session: a Kalliope session, as returned by open_kalliope_api_session()
-    :returns: buffer with bijlage
+    :returns: dict with the path of the temporary file, its size, sha256 and mimetype
     """
-    r = session.get(path)
-    if r.status_code == requests.codes.ok:
-        return r.content
-    else:
-        raise requests.\
-              exceptions.HTTPError('Failed to get Kalliope poststuk bijlage (statuscode {})'.format(r.status_code))
+    with kalliope_request(session, 'GET', path, ENDPOINT_BIJLAGEN, stream=True) as r:
+        if r.status_code != requests.codes.ok:
+            raise requests.\
+                  exceptions.HTTPError('Failed to get Kalliope poststuk bijlage (statuscode {})'.format(r.status_code))
+
+        sha256 = hashlib.sha256()
+        size = 0
+        head = b''
+        (fd, tmp_filepath) = tempfile.mkstemp(dir=BIJLAGEN_FOLDER_PATH, prefix=TMP_FILE_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    if len(head) < MIMETYPE_SNIFF_SIZE:
+                        head += chunk[:MIMETYPE_SNIFF_SIZE - len(head)]
+            os.chmod(tmp_filepath, 0o644)  # mkstemp only grants access to the owner
+        except Exception as e:
+            os.remove(tmp_filepath)
+            raise e
+
+    return {
+        'tmp_filepath': tmp_filepath,
+        'size': size,
+        'sha256': sha256.hexdigest(),
+        'mimetype': magic.from_buffer(head, mime=True),
+    }
 
 
-def parse_kalliope_bijlage(ps_bijlage, session):
+def new_bijlage(ps_bijlage):
     """
-    Parse the bijlage response from the Kalliope API into our bijlage format
+    Parse the bijlage properties that are known upfront from the Kalliope API into our bijlage format
 
-    :param bijlage: The bijlage deserialized JSON
-    :param session: a Kalliope session, as returned by open_kalliope_api_session()
-    :returns: a dict of bijlage properties including the binary buffer
+    :param ps_bijlage: The bijlage deserialized JSON, as found in a poststuk
+    :returns: a dict of bijlage properties, without those of the downloaded file
     """
-    buffer = get_kalliope_bijlage(ps_bijlage['url'], session)
-    m_type = magic.Magic(mime=True)
-    filesize = len(buffer)
     bijlage = {
         'uuid': helpers.generate_uuid(),
-        'buffer': buffer,
         'url': ps_bijlage['url'],
         'id': ps_bijlage['url'].split('/')[-1],
         'name': ps_bijlage['naam'],
         'extension': os.path.splitext(ps_bijlage['naam'])[1].lstrip("."),
-        'mimetype': m_type.from_buffer(buffer),
-        'size': filesize,
         'created': datetime.now(tz=TIMEZONE).replace(microsecond=0).isoformat(),
     }
     return bijlage
 
 
+def parse_kalliope_bijlage(ps_bijlage, session):
+    """
+    Parse the bijlage response from the Kalliope API into our bijlage format
+
+    :param bijlage: The bijlage deserialized JSON
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :returns: a dict of bijlage properties including the path of the downloaded (temporary) file
+    """
+    bijlage = new_bijlage(ps_bijlage)
+    download = get_kalliope_bijlage(ps_bijlage['url'], session)
+    bijlage['tmp_filepath'] = download['tmp_filepath']
+    bijlage['sha256'] = download['sha256']
+    bijlage['mimetype'] = download['mimetype']
+    bijlage['size'] = download['size']
+    return bijlage
+
+
+def discard_kalliope_bijlagen(bijlagen_downloads):
+    """
+    Cancel pending bijlage downloads and remove the temporary files of the finished ones.
+
+    :param bijlagen_downloads: list of futures, each resolving to a bijlage as returned by parse_kalliope_bijlage()
+    """
+    for download in bijlagen_downloads:
+        if download.cancel():
+            continue
+        try:
+            tmp_filepath = download.result().get('tmp_filepath')
+        except Exception:
+            continue
+        if tmp_filepath and os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+
 def get_kalliope_poststukken_uit(path, session, from_,
                                  to=None,
                                  dossier_types=None):
@@ -112,32 +300,128 @@ def get_kalliope_poststukken_uit(path, session, from_,
     :param dossier_types: Only return messages associated to these types of dossier
     :returns: tuple of poststukken
     """
+    poststukken = []
+    for page in get_kalliope_poststukken_uit_pages(path, session, from_, to, dossier_types):
+        poststukken += page
+    return poststukken
+
+
+def get_kalliope_poststukken_uit_pages(path, session, from_,
+                                       to=None,
+                                       dossier_types=None):
+    """
+    Perform the API-calls to get all poststukken-uit that are ready to be processed, page by page.
+    The next page is requested in the background while the current one is being processed,
+    so at most two pages are held in memory. The page size set by the page sizer applies from the first page on,
+    the next pages are requested through the 'volgende' links as returned by Kalliope.
+
+    :param path: url of the api endpoint that we want to fetch
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param from_: start boundary of timerange for which messages are requested
+    :param to: end boundary of timerange for which messages are requested
+    :param dossier_types: Only return messages associated to these types of dossier
+    :returns: generator yielding lists of poststukken
+    """
     params = {
         'vanaf': from_.replace(microsecond=0).isoformat(),
-        'aantal': MAX_REQ_CHUNK_SIZE
+        'aantal': page_sizer.size()
     }
     if to:
         params['tot'] = to.replace(microsecond=0).isoformat()
     if dossier_types:
         params['dossierTypes'] = ','.join(dossier_types)
 
-    poststukken = []
     req_url = requests.Request('GET', path, params=params).prepare().url
-    while req_url:
+    with job_executor(1) as executor:
+        next_page = executor.submit(get_kalliope_poststukken_uit_page, req_url, session)
+        while next_page:
+            (poststukken, req_url, size) = next_page.result()
+            next_page = executor.submit(get_kalliope_poststukken_uit_page, req_url, session, size) if req_url else None
+            yield poststukken
+
+
+def with_page_size(url, size):
+    """
+    Set the 'aantal' query parameter of the url of a first page. The 'volgende' links are left as they are,
+    as their paging might depend on it.
+    """
+    parts = urlparse(url)
+    params = [(key, value) for (key, value) in parse_qsl(parts.query, keep_blank_values=True) if key != 'aantal']
+    params.append(('aantal', size))
+    return parts._replace(query=urlencode(params)).geturl()
+
+
+def get_kalliope_poststukken_uit_page(req_url, session, size=None):
+    """
+    Perform the API-call to get a single page of poststukken-uit. Every page is recorded by the page sizer.
+    A page that times out or fails with a 500 is retried, up to PAGE_ATTEMPTS times: the first page with the
+    smaller size set by the page sizer, a next page as it is. The transport already retried the 502/503/504 responses.
+
+    :param req_url: url of the page, including the query parameters
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param size: page size of the listing for a next page, None for the first page
+    :returns: tuple of the form (poststukken, url of the next page or None, page size of the listing)
+    """
+    first_page = size is None
+    for attempt in range(1, PAGE_ATTEMPTS + 1):
+        if first_page:
+            size = page_sizer.size()
+            req_url = with_page_size(req_url, size)
         helpers.log("literally requesting: {}".format(req_url))
-        r = session.get(req_url)
-        if r.status_code == requests.codes.ok:
-            r_content = r.json()
-            poststukken += r_content['poststukken']
-            req_url = r_content['volgende']
-        else:
-            try:
-                errorDescription = r.json()
-            except Exception as e:
-                errorDescription = r
-            raise requests.exceptions.HTTPError('Failed to get Kalliope poststuk uit (statuscode {}): {}'.format(r.status_code,
-                                                                                                                 errorDescription))
-    return poststukken
+        started_at = time.monotonic()
+        try:
+            r = kalliope_request(session, 'GET', req_url, ENDPOINT_POSTSTUKKEN_UIT,
+                                 timeout=(KALLIOPE_CONNECT_TIMEOUT, KALLIOPE_PAGE_TIMEOUT))
+        except requests.exceptions.ReadTimeout as e:
+            page_sizer.record(size, 0, time.monotonic() - started_at, True)
+            if attempt == PAGE_ATTEMPTS:
+                raise e
+            continue
+        if r.status_code >= 500:
+            page_sizer.record(size, 0, time.monotonic() - started_at, True)
+            if r.status_code not in RETRY_STATUSES and attempt < PAGE_ATTEMPTS:
+                continue
+        break
+
+    if r.status_code == requests.codes.ok:
+        r_content = r.json()
+        page_sizer.record(size, len(r_content['poststukken']), time.monotonic() - started_at, False)
+        return (r_content['poststukken'], r_content['volgende'], size)
+    else:
+        try:
+            errorDescription = r.json()
+        except Exception as e:
+            errorDescription = r
+        raise requests.exceptions.HTTPError('Failed to get Kalliope poststuk uit (statuscode {}): {}'.format(r.status_code,
+                                                                                                             errorDescription))
+
+
+def pythonize_iso_timestamp(timestamp):
+    """ Convert ISO 8601 timestamp to python .fromisoformat()-compliant format """
+    # 'Z'-timezone to '+00:00'-timezone
+    timestamp = timestamp.replace('Z', '+00:00')
+    # '+0000'-timezone to '+00:00'-timezone
+    def repl(matchobj):
+        hh, mm = matchobj.group(1)[0:2], matchobj.group(1)[2:4]
+        return "+{}:{}".format(hh, mm)
+    timestamp = re.sub(r'\+(\d{4})', repl, timestamp)
+    # '.39' microseconds to '.390000' microseconds
+    def repl2(matchobj):
+        ms = matchobj.group(1)
+        sign = matchobj.group(2)
+        return ".{}{}".format(ms.ljust(6, '0'), sign)
+    timestamp = re.sub(r'\.(\d{0,5})($|\+|-)', repl2, timestamp)
+    return timestamp
+
+
+def parse_kalliope_timestamp(timestamp):
+    """
+    Parse a timestamp as returned by the Kalliope API (e.g. 'datumBeschikbaar')
+
+    :param timestamp: ISO 8601 string
+    :returns: timezone-aware datetime in our TIMEZONE
+    """
+    return datetime.fromisoformat(pythonize_iso_timestamp(timestamp)).astimezone(TIMEZONE)
 
 
 def parse_kalliope_poststuk_uit(ps_uit, session):
@@ -147,31 +431,24 @@ def parse_kalliope_poststuk_uit(ps_uit, session):
     :param ps_uit: The poststuk uit deserialized JSON
     :param session: a Kalliope session, as returned by open_kalliope_api_session(), needed for fetching bijlages
     :returns: a tuple of the form (conversatie, bericht)
+    :raises KalliopeParseError: when the poststuk can't be parsed, which will happen again on every run
     """
+    try:
+        return parse_poststuk_uit_fields(ps_uit)
+    except KalliopeParseError as e:
+        raise e
+    except (KeyError, TypeError, ValueError) as e:
+        raise KalliopeParseError("Failed to parse poststuk uit {}: {!r}".format(
+            ps_uit.get('uri') if isinstance(ps_uit, dict) else None, e)) from e
+
+
+def parse_poststuk_uit_fields(ps_uit):
     van = ABB_URI
     if ps_uit['bestemmeling']['uri']:
         naar = ps_uit['bestemmeling']['uri']
     else:
-        raise ValueError("The bestemmeling from message {} has no URI. Probably this message isn't intended for Loket".format(ps_uit['uri']))
-    def pythonize_iso_timestamp(timestamp):
-        """ Convert ISO 8601 timestamp to python .fromisoformat()-compliant format """
-        # 'Z'-timezone to '+00:00'-timezone
-        timestamp = timestamp.replace('Z', '+00:00')
-        # '+0000'-timezone to '+00:00'-timezone
-        def repl(matchobj):
-            hh, mm = matchobj.group(1)[0:2], matchobj.group(1)[2:4]
-            return "+{}:{}".format(hh, mm)
-        timestamp = re.sub(r'\+(\d{4})', repl, timestamp)
-        # '.39' microseconds to '.390000' microseconds
-        def repl2(matchobj):
-            ms = matchobj.group(1)
-            sign = matchobj.group(2)
-            return ".{}{}".format(ms.ljust(6, '0'), sign)
-        timestamp = re.sub(r'\.(\d{0,5})($|\+|-)', repl2, timestamp)
-        return timestamp
-    verzonden = datetime.fromisoformat(pythonize_iso_timestamp(ps_uit['datumBeschikbaar'])) \
-                        .astimezone(TIMEZONE).replace(microsecond=0)                    \
-                        .isoformat()
+        raise KalliopeParseError("The bestemmeling from message {} has no URI. Probably this message isn't intended for Loket".format(ps_uit['uri']))
+    verzonden = parse_kalliope_timestamp(ps_uit['datumBeschikbaar']).replace(microsecond=0).isoformat()
     ontvangen = datetime.now(tz=TIMEZONE).replace(microsecond=0).isoformat()
     inhoud = ps_uit['inhoud'] if ps_uit['inhoud'] else ""
     referentieABB = ps_uit['referentieABB']
@@ -201,15 +478,8 @@ def construct_kalliope_poststuk_in(conversatie, bericht):
 
     :param conversatie: conversatie object of the poststuk_in we want to send
     :param bericht: bericht object of the poststuk_in we want to send
-    :returns: poststuk_in parameters object as consumed by requests
+    :returns: poststuk_in body, a MultipartStream
     """
-    files = []
-    for bijlage in bericht['bijlagen']:
-        filepath = os.path.join(BIJLAGEN_FOLDER_PATH, bijlage['filepath'])
-        buffer = open(filepath, 'rb')
-        # See: http://docs.python-requests.org/en/master/user/advanced/#post-multiple-multipart-encoded-files
-        files.append(('files', (bijlage['name'], buffer, bijlage['type'])))
-
     data = {
         'uri': bericht['uri'],
         'afzenderUri': bericht['van'],
@@ -222,10 +492,12 @@ def construct_kalliope_poststuk_in(conversatie, bericht):
         data['dossierUri'] = conversatie['dossierUri']
 
     # NOTE: Parameters are sent as file-like objects, API expects a 'Content-Type'-header for each parameter
-    poststuk_in = [
-        ('data', (None, json.dumps(data), 'application/json')),
-    ]
-    poststuk_in.extend(files)
+    poststuk_in = MultipartStream()
+    poststuk_in.add_field('data', json.dumps(data), 'application/json')
+    for bijlage in bericht['bijlagen']:
+        # The bijlagen are only opened and read in chunks while the request body is being sent
+        filepath = os.path.join(BIJLAGEN_FOLDER_PATH, bijlage['filepath'])
+        poststuk_in.add_file('files', bijlage['name'], filepath, bijlage['type'])
     return poststuk_in
 
 
@@ -234,10 +506,10 @@ def post_kalliope_poststuk_in(path, session, params):
     Perform the API-call to send a new poststuk to Kalliope.
     :param path: url of the api endpoint that we want to send to
     :param session: a Kalliope session, as returned by open_kalliope_api_session()
-    :param url_params: dict of url parameters for the api call
+    :param params: poststuk_in body, as returned by construct_kalliope_poststuk_in()
     :returns: response dict
     """
-    r = session.post(path, files=params)
+    r = kalliope_request(session, 'POST', path, ENDPOINT_POSTSTUK_IN, data=params, headers={'Content-Type': params.content_type})
     if r.status_code == requests.codes.ok:
         return r.json()
     else:
@@ -264,7 +536,8 @@ def post_kalliope_poststuk_uit_confirmation(path, session, data):
         "Accept": "application/json",
     }
 
-    r = session.post(path, json=data, headers=headers)
+    # Sending the same confirmation twice does no harm
+    r = kalliope_request(session, 'POST', path, ENDPOINT_CONFIRMATIONS, idempotent=True, json=data, headers=headers)
     if r.status_code == requests.codes.no_content:
         return True
     else:
@@ -289,7 +562,7 @@ def post_kalliope_inzending_in(path, session, inzending):
         ('data', (None, json.dumps(inzending), 'application/json')),
     ]
     log("Posting inzending <{}>. Payload: {}".format(inzending['uri'], params))
-    r = session.post(path, files=params)
+    r = kalliope_request(session, 'POST', path, ENDPOINT_INZENDINGEN, files=params)
     if r.status_code == requests.codes.ok:
         return r.json()
     else:
@@ -0,0 +1,80 @@
+import os
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class MultipartStream:
+    """
+    A multipart/form-data body that is streamed instead of being built in memory.
+    File parts are referenced by path: they are only opened while their content is being sent and
+    are read in chunks of READ_CHUNK_SIZE. The total length is known up front from the file sizes, so
+    requests sends it as Content-Length.
+
+    Usage: session.post(url, data=stream, headers={'Content-Type': stream.content_type})
+    """
+
+    def __init__(self):
+        self.boundary = choose_boundary()
+        self.parts = []  # tuples of the form (headers, data, filepath, size)
+
+    def add_field(self, name, value, content_type=None):
+        """
+        Add a part with an in-memory value.
+
+        :param name: name of the form field
+        :param value: str or bytes
+        :param content_type: optional Content-Type header of the part
+        """
+        data = value.encode('utf-8') if isinstance(value, str) else value
+        self.parts.append((self.render_headers(name, None, content_type), data, None, len(data)))
+
+    def add_file(self, name, filename, filepath, content_type=None):
+        """
+        Add a part with the content of a file on disk.
+
+        :param name: name of the form field
+        :param filename: file name that is sent along with the part
+        :param filepath: path of the file to send
+        :param content_type: optional Content-Type header of the part
+        """
+        size = os.path.getsize(filepath)  # Also fails early if the file doesn't exist
+        self.parts.append((self.render_headers(name, filename, content_type), None, filepath, size))
+
+    def render_headers(self, name, filename, content_type):
+        # Same part headers as requests/urllib3 generate for the 'files' argument
+        field = RequestField(name=name, data=b'', filename=filename)
+        field.make_multipart(content_type=content_type)
+        return field.render_headers().encode('utf-8')
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        delimiter_size = len(self.delimiter())
+        return sum(delimiter_size + len(headers) + size + 2 for (headers, _, _, size) in self.parts) \
+            + len(self.closing_delimiter())
+
+    def __iter__(self):
+        for (headers, data, filepath, _) in self.parts:
+            yield self.delimiter() + headers
+            if filepath is None:
+                yield data
+            else:
+                with open(filepath, 'rb') as f:
+                    for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                        yield chunk
+            yield b'\r\n'
+        yield self.closing_delimiter()
+
+    def delimiter(self):
+        return '--{}\r\n'.format(self.boundary).encode('utf-8')
+
+    def closing_delimiter(self):
+        return '--{}--\r\n'.format(self.boundary).encode('utf-8')
+
+    def __repr__(self):
+        return '<MultipartStream [{}]>'.format(', '.join(
+            filepath if filepath else data.decode('utf-8', 'replace') for (_, data, filepath, _) in self.parts))
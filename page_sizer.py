@@ -0,0 +1,73 @@
+import collections
+import threading
+from helpers import log
+
+PAGE_METRICS_KEPT = 100
+
+
+class PageSizer:
+    """
+    Adaptive page size for list calls, shared by all threads.
+    Starts at the upper bound, is halved when a page fails (timeout, 5xx), shrinks when a page is slower than the
+    latency target and grows back while pages stay well below it. Stays between min_size and max_size.
+    """
+
+    def __init__(self, min_size, max_size, latency_target):
+        """
+        :param min_size: smallest page size
+        :param max_size: largest page size, the initial size
+        :param latency_target: time (in seconds) a single page is allowed to take
+        """
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.latency_target = latency_target
+        self.lock = threading.Lock()
+        self.current = self.max_size
+        self.pages = collections.deque(maxlen=PAGE_METRICS_KEPT)  # metrics of the most recent pages
+
+    def size(self):
+        with self.lock:
+            return self.current
+
+    def record(self, size, count, latency, failed):
+        """
+        Record the outcome of a page and adapt the page size to it.
+
+        :param size: page size that was requested
+        :param count: number of items that were returned
+        :param latency: duration of the request (in seconds)
+        :param failed: True when the page failed because of a timeout or 5xx
+        """
+        with self.lock:
+            if failed:
+                self.current = max(self.min_size, min(self.current, size) // 2)
+            elif latency > self.latency_target:
+                self.current = max(self.min_size, int(min(self.current, size) * 0.75))
+            elif latency < self.latency_target / 2 and count >= size:  # Only a full page tells us about larger ones
+                self.current = min(self.max_size, int(self.current * 1.5) + 1)
+            self.pages.append({
+                'size': size,
+                'count': count,
+                'latency': latency,
+                'failed': failed,
+                'next-size': self.current,
+            })
+            next_size = self.current
+        log("Page of {} (requested {}) {} in {:.2f}s, next page size {}".format(
+            count, size, "failed" if failed else "retrieved", latency, next_size))
+
+    def stats(self):
+        with self.lock:
+            pages = list(self.pages)
+        succeeded = [page for page in pages if not page['failed']]
+        return {
+            'current-size': self.size(),
+            'min-size': self.min_size,
+            'max-size': self.max_size,
+            'latency-target': self.latency_target,
+            'recent-pages': len(pages),
+            'recent-failures': len(pages) - len(succeeded),
+            'average-latency': sum(page['latency'] for page in succeeded) / len(succeeded) if succeeded else None,
+            'average-count': sum(page['count'] for page in succeeded) / len(succeeded) if succeeded else None,
+            'pages': pages,
+        }
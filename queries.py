@@ -9,6 +9,7 @@ import re
 import json
 
 CONFIG_FILE_PATH = '/config/config.json'
+ORGANIZATION_GRAPHS_PREFIX = "http://mu.semte.ch/graphs/organizations/"
 TIMEZONE = timezone('Europe/Brussels')
 STATUS_DELIVERED_UNCONFIRMED = \
     "http://data.lblod.info/id/status/berichtencentrum/sync-with-kalliope/delivered/unconfirmed"
@@ -69,6 +70,33 @@ def sparql_escape_string(obj):
 escape_helpers.sparql_escape_string = sparql_escape_string
 
 
+def construct_graph_scope_statement(graph_uris, gebruiker):
+    """
+    Construct the statement restricting ?g to the given organization graphs. Without graphs, ?g can be any
+    organization graph of the given type of user. Only do that when the results are bound by other means
+    (e.g. VALUES ?bericht), because the triple store then has to match the name of every graph.
+
+    :param graph_uris: list of graph URIs, None for any organization graph
+    :param gebruiker: type of user of the organization graphs, e.g. "LoketLB-berichtenGebruiker"
+    :returns: string containing a SPARQL statement
+    """
+    if graph_uris is None:
+        return 'FILTER(STRSTARTS(STR(?g), "{0}") && STRENDS(STR(?g), "/{1}"))'.format(ORGANIZATION_GRAPHS_PREFIX,
+                                                                                     gebruiker)
+    return "VALUES ?g {{ {0} }}".format(" ".join("<{}>".format(uri) for uri in graph_uris))
+
+
+def construct_combined_update_query(update_queries):
+    """
+    Combine several SPARQL update queries into a single update request, to save round trips.
+    Note that the triple store (through mu-auth) doesn't guarantee the request is applied atomically.
+
+    :param update_queries: list of strings containing SPARQL update queries
+    :returns: string containing SPARQL query
+    """
+    return ";\n".join(update_queries)
+
+
 def construct_conversatie_exists_query(graph_uri, referentieABB):
     """
     Construct a query for selecting a conversatie based on referentieABB
@@ -110,27 +138,67 @@ def construct_bestuurseenheid_exists_query(bestuurseeheid_uri):
     return q
 
 
-def construct_bericht_exists_query(graph_uri, bericht_uri):
+def construct_select_bestuurseenheden_query(limit, offset):
     """
-    Construct a query for selecting a bericht based on its URI, retrieving the conversatie & referentieABB at the same time.
+    Construct a query for selecting (a page of) all bestuurseenheden in our database.
 
-    :param graph_uri: string
-    :param bericht_uri: string
+    :param limit: int
+    :param offset: int
+    :returns: string containing SPARQL query
+    """
+    q = """
+        PREFIX besluit: <http://data.vlaanderen.be/ns/besluit#>
+
+        SELECT DISTINCT ?bestuurseenheid
+        WHERE {{
+            ?bestuurseenheid a besluit:Bestuurseenheid .
+        }}
+        ORDER BY ?bestuurseenheid
+        LIMIT {0}
+        OFFSET {1}
+        """.format(limit, offset)
+    return q
+
+
+def construct_count_bestuurseenheden_query():
+    """
+    Construct a query for counting the bestuurseenheden in our database.
+
+    :returns: string containing SPARQL query
+    """
+    q = """
+        PREFIX besluit: <http://data.vlaanderen.be/ns/besluit#>
+
+        SELECT (COUNT(DISTINCT ?bestuurseenheid) AS ?count)
+        WHERE {
+            ?bestuurseenheid a besluit:Bestuurseenheid .
+        }
+        """
+    return q
+
+
+def construct_existing_berichten_query(graph_bericht_uris):
+    """
+    Construct a query for selecting which of the given berichten already exist (in a conversatie) in their graph.
+
+    :param graph_bericht_uris: list of tuples of the form (graph_uri, bericht_uri)
     :returns: string containing SPARQL query
     """
     q = """
         PREFIX schema: <http://schema.org/>
 
-        SELECT DISTINCT ?conversatie ?referentieABB
+        SELECT DISTINCT ?g ?bericht
         WHERE {{
-            GRAPH <{0}> {{
-                <{1}> a schema:Message.
+            VALUES (?g ?bericht) {{ {0} }}
+            GRAPH ?g {{
+                ?bericht a schema:Message.
                 ?conversatie a schema:Conversation;
-                    schema:hasPart <{1}>;
+                    schema:hasPart ?bericht;
                     schema:identifier ?referentieABB.
             }}
         }}
-        """.format(graph_uri, bericht_uri)
+        """.format(" ".join("(<{}> <{}>)".format(graph_uri, bericht_uri)
+                            for (graph_uri, bericht_uri) in graph_bericht_uris))
     return q
 
 
@@ -351,19 +419,28 @@ def construct_update_last_bericht_query(conversatie_uri):
     return q
 
 
-def construct_unsent_berichten_query(naar_uri, max_sending_attempts):
+def construct_unsent_berichten_query(naar_uri, max_sending_attempts, graph_uris, bericht_uris=None):
     """
     Construct a SPARQL query for retrieving all messages for a given recipient that haven't been received yet by the other party.
 
     :param naar_uri: URI of the recipient for which we want to retrieve messages that have yet to be sent.
+    :param max_sending_attempts: the maximum number of delivery attempts that have to be done
+    :param graph_uris: list of the organization graphs to look in, None for any (see construct_graph_scope_statement())
+    :param bericht_uris: optional list of bericht URIs to restrict the results to
     :returns: string containing SPARQL query
     """
+    bound_bericht_statement = ""
+    if bericht_uris:
+        bound_bericht_statement = "VALUES ?bericht {{ {0} }}".format(" ".join("<{}>".format(uri)
+                                                                          for uri in bericht_uris))
     q = """
         PREFIX schema: <http://schema.org/>
         PREFIX ext: <http://mu.semte.ch/vocabularies/ext/>
 
         SELECT DISTINCT ?referentieABB ?dossieruri ?bericht ?betreft ?uuid ?van ?verzonden ?inhoud
         WHERE {{
+            {2}
+            {3}
             GRAPH ?g {{
                 ?conversatie a schema:Conversation;
                     schema:identifier ?referentieABB;
@@ -384,18 +461,19 @@ def construct_unsent_berichten_query(naar_uri, max_sending_attempts):
                 BIND(COALESCE(?attempts, ?default_attempts) AS ?result_attempts)
                 FILTER(?result_attempts < {1})
             }}
-
-            FILTER(REGEX(STR(?g), "http://mu.semte.ch/graphs/organizations/.*/LoketLB-berichtenGebruiker"))
         }}
-        """.format(naar_uri, max_sending_attempts)
+        """.format(naar_uri,
+                   max_sending_attempts,
+                   construct_graph_scope_statement(graph_uris, "LoketLB-berichtenGebruiker"),
+                   bound_bericht_statement)
     return q
 
 
-def construct_select_bijlagen_query(bericht_uri):
+def construct_select_berichten_bijlagen_query(bericht_uris):
     """
-    Construct a SPARQL query for retrieving all bijlages for a given bericht.
+    Construct a SPARQL query for retrieving all bijlages for a batch of berichten.
 
-    :param bericht_uri: URI of the bericht for which we want to retrieve bijlagen.
+    :param bericht_uris: list of URIs of the berichten for which we want to retrieve bijlagen.
     :returns: string containing SPARQL query
     """
     q = """
@@ -404,8 +482,9 @@ def construct_select_bijlagen_query(bericht_uri):
         PREFIX nie: <http://www.semanticdesktop.org/ontologies/2007/01/19/nie#>
         PREFIX dct: <http://purl.org/dc/terms/>
 
-        SELECT DISTINCT ?bijlagenaam ?file ?type WHERE {{
-            <{0}> a schema:Message;
+        SELECT DISTINCT ?bericht ?bijlagenaam ?file ?type WHERE {{
+            VALUES ?bericht {{ {0} }}
+            ?bericht a schema:Message;
                 nie:hasPart ?bijlage.
 
             ?bijlage a nfo:FileDataObject;
@@ -413,7 +492,7 @@ def construct_select_bijlagen_query(bericht_uri):
                 dct:format ?type.
             ?file nie:dataSource ?bijlage.
         }}
-        """.format(bericht_uri)
+        """.format(" ".join("<{}>".format(uri) for uri in bericht_uris))
     return q
 
 
@@ -479,295 +558,215 @@ def construct_bericht_sent_query(graph_uri, bericht_uri, verzonden):
     return q
 
 
-def construct_select_original_bericht_query(bericht_uri):
+def construct_select_original_berichten_query(bericht_uris):
     """
-    Construct a SPARQL query for selecting the first message in a conversation
+    Construct a SPARQL query for selecting the messages in the conversations of a batch of berichten,
+    ordered by dateSent per bericht: the first row of each bericht holds the first message in its conversation.
 
-    :param bericht_uri: URI of a bericht in a conversation
+    :param bericht_uris: list of URIs of berichten in a conversation
     :returns: string containing SPARQL query
     """
     q = """
         PREFIX schema: <http://schema.org/>
-        PREFIX ext: <http://mu.semte.ch/vocabularies/ext/>
 
-        SELECT DISTINCT ?origineelbericht ?dateSent WHERE {{
-          ?conversation a schema:Conversation;
-            schema:hasPart ?origineelbericht;
-            schema:hasPart <{0}>.
+        SELECT DISTINCT ?bericht ?origineelbericht ?dateSent WHERE {{
+            VALUES ?bericht {{ {0} }}
+            ?conversation a schema:Conversation;
+                schema:hasPart ?origineelbericht;
+                schema:hasPart ?bericht.
 
             ?origineelbericht schema:dateSent ?dateSent.
-         }}
-         ORDER BY ASC(?dateSent)
-         LIMIT 1
-       """.format(bericht_uri)
-
+        }}
+        ORDER BY ?bericht ASC(?dateSent)
+        """.format(" ".join("<{}>".format(uri) for uri in bericht_uris))
     return q
 
-def verify_eb_has_cb_exclusion_rule(submission):
-
-    ask_query_eb_has_cb = """
+EXCLUSION_RULE_PREFIXES = """
     PREFIX ere:         <http://data.lblod.info/vocabularies/erediensten/>
     PREFIX org:         <http://www.w3.org/ns/org#>
     PREFIX pav:         <http://purl.org/pav/>
     PREFIX meb:         <http://rdf.myexperiment.org/ontologies/base/>
     PREFIX dct:         <http://purl.org/dc/terms/>
+    PREFIX besluit:     <http://data.vlaanderen.be/ns/besluit#>
     PREFIX prov:        <http://www.w3.org/ns/prov#>
     PREFIX adms:        <http://www.w3.org/ns/adms#>
-    
-    ASK {{
+    PREFIX regorg:      <http://www.w3.org/ns/regorg#>
+"""
 
-        BIND(<{0}> AS ?submission)
+
+def exclusion_rule_pattern(decision_types, bestuurseenheid_pattern):
+    """
+    Construct the graph pattern of an inzendingen exclusion rule: a sent ?submission with one of the given
+    decision types, whose sender (?bestuurseenheid) matches the given pattern.
+
+    :param decision_types: list of decision type URIs, between angle brackets
+    :param bestuurseenheid_pattern: string containing the SPARQL pattern the ?bestuurseenheid has to match
+    :returns: string containing a SPARQL graph pattern
+    """
+    return """
         ?submission a meb:Submission ;
                    adms:status <http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c> ;
                    prov:generated ?formData ;
                    pav:createdBy ?bestuurseenheid .
         ?formData dct:type ?decisionType .
-        VALUES ?decisionType {{ {1} }}
+        VALUES ?decisionType {{ {0} }}
+
+        {1}
+    """.format(" ".join(decision_types), bestuurseenheid_pattern)
+
 
+# Inzendingen business rules: a submission matching any of these patterns isn't sent to Kalliope
+EXCLUSION_RULE_EB_HAS_CB = exclusion_rule_pattern(DECISION_TYPES_EB_HAS_CB, """
         ?bestuurseenheid a ere:BestuurVanDeEredienst.
 
         ?centraalBestuur a ere:CentraalBestuurVanDeEredienst ;
                          org:hasSubOrganization ?bestuurseenheid .
-    }}
-    """.format(submission, " ".join(DECISION_TYPES_EB_HAS_CB))
-
-    return ask_query_eb_has_cb
-
-def verify_eb_has_active_cb_exclusion_rule(submission):
-
-    ask_query_eb_has_active_cb = """
-    PREFIX ere:         <http://data.lblod.info/vocabularies/erediensten/>
-    PREFIX org:         <http://www.w3.org/ns/org#>
-    PREFIX pav:         <http://purl.org/pav/>
-    PREFIX meb:         <http://rdf.myexperiment.org/ontologies/base/>
-    PREFIX dct:         <http://purl.org/dc/terms/>
-    PREFIX prov:        <http://www.w3.org/ns/prov#>
-    PREFIX adms:        <http://www.w3.org/ns/adms#>
-    PREFIX regorg: <http://www.w3.org/ns/regorg#>
-
-    
-    ASK {{
-
-        BIND(<{0}> AS ?submission)
-        ?submission a meb:Submission ;
-                   adms:status <http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c> ;
-                   prov:generated ?formData ;
-                   pav:createdBy ?bestuurseenheid .
-        ?formData dct:type ?decisionType .
-        VALUES ?decisionType {{ {1} }}
+""")
 
+EXCLUSION_RULE_EB_HAS_ACTIVE_CB = exclusion_rule_pattern(DECISION_TYPES_EB_HAS_ACTIVE_CB, """
         ?bestuurseenheid a ere:BestuurVanDeEredienst.
 
         ?centraalBestuur a ere:CentraalBestuurVanDeEredienst ;
                          org:hasSubOrganization ?bestuurseenheid ;
                          regorg:orgStatus <http://lblod.data.gift/concepts/63cc561de9188d64ba5840a42ae8f0d6> .
-    }}
-    """.format(submission, " ".join(DECISION_TYPES_EB_HAS_ACTIVE_CB))
-
-    return ask_query_eb_has_active_cb
-
-def verify_eb_exclusion_rule(submission):
-
-    ask_query_eb = """
-    PREFIX ere:         <http://data.lblod.info/vocabularies/erediensten/>
-    PREFIX pav:         <http://purl.org/pav/>
-    PREFIX meb:         <http://rdf.myexperiment.org/ontologies/base/>
-    PREFIX dct:         <http://purl.org/dc/terms/>
-    PREFIX prov:        <http://www.w3.org/ns/prov#>
-    PREFIX adms:        <http://www.w3.org/ns/adms#>
-    
-    ASK {{
-
-        BIND(<{0}> AS ?submission)
-        ?submission a meb:Submission ;
-                   adms:status <http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c> ;
-                   prov:generated ?formData ;
-                   pav:createdBy ?bestuurseenheid .
-        ?formData dct:type ?decisionType .
-        VALUES ?decisionType {{ {1} }}
+""")
 
+EXCLUSION_RULE_EB = exclusion_rule_pattern(DECISION_TYPES_EB, """
         ?bestuurseenheid a ere:BestuurVanDeEredienst.
+""")
 
-    }}
-    """.format(submission, " ".join(DECISION_TYPES_EB))
-
-    return ask_query_eb
-
-def verify_cb_exclusion_rule(submission):
+EXCLUSION_RULE_CB = exclusion_rule_pattern(DECISION_TYPES_CB, """
+        ?bestuurseenheid a ere:CentraalBestuurVanDeEredienst .
+""")
 
-    ask_query_cb = """
-    PREFIX ere:         <http://data.lblod.info/vocabularies/erediensten/>
-    PREFIX org:         <http://www.w3.org/ns/org#>
-    PREFIX pav:         <http://purl.org/pav/>
-    PREFIX meb:         <http://rdf.myexperiment.org/ontologies/base/>
-    PREFIX dct:         <http://purl.org/dc/terms/>
-    PREFIX prov:        <http://www.w3.org/ns/prov#>
-    PREFIX adms:        <http://www.w3.org/ns/adms#>
-    
-    ASK {{
-        BIND(<{0}> AS ?submission)
-        ?submission a meb:Submission ;
-                   adms:status <http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c> ;
-                   prov:generated ?formData ;
-                   pav:createdBy ?bestuurseenheid .
-        ?formData dct:type ?decisionType .
-        VALUES ?decisionType {{ {1} }}
+EXCLUSION_RULE_RO = exclusion_rule_pattern(DECISION_TYPES_RO, """
+        ?bestuurseenheid a ere:RepresentatiefOrgaan .
+""")
 
-        ?bestuurseenheid a ere:CentraalBestuurVanDeEredienst .
-    }}
-    """.format(submission, " ".join(DECISION_TYPES_CB))
+EXCLUSION_RULE_GO = exclusion_rule_pattern(DECISION_TYPES_GO, """
+        ?bestuurseenheid besluit:classificatie <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/5ab0e9b8a3b2ca7c5e000001> .
+""")
 
-    return ask_query_cb
+EXCLUSION_RULE_PO = exclusion_rule_pattern(DECISION_TYPES_PO, """
+        ?bestuurseenheid besluit:classificatie <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/5ab0e9b8a3b2ca7c5e000000> .
+""")
 
-def verify_ro_exclusion_rule(submission):
+# Meerjarenplan exclusion if sender is a bestuur van de eredienst
+EXCLUSION_RULE_MP = exclusion_rule_pattern([
+    "<https://data.vlaanderen.be/id/concept/BesluitType/f56c645d-b8e1-4066-813d-e213f5bc529f>"
+], """
+        ?bestuurseenheid besluit:classificatie <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/66ec74fd-8cfc-4e16-99c6-350b35012e86> .
+""")
 
-    ask_query_ro = """
-    PREFIX ere:         <http://data.lblod.info/vocabularies/erediensten/>
-    PREFIX org:         <http://www.w3.org/ns/org#>
-    PREFIX pav:         <http://purl.org/pav/>
-    PREFIX meb:         <http://rdf.myexperiment.org/ontologies/base/>
-    PREFIX dct:         <http://purl.org/dc/terms/>
-    PREFIX prov:        <http://www.w3.org/ns/prov#>
-    PREFIX adms:        <http://www.w3.org/ns/adms#>
-    
-    ASK {{
-        BIND(<{0}> AS ?submission)
-        ?submission a meb:Submission ;
-                   adms:status <http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c> ;
-                   prov:generated ?formData ;
-                   pav:createdBy ?bestuurseenheid .
-        ?formData dct:type ?decisionType .
-        VALUES ?decisionType {{ {1} }}
+# Opstart beroepsprocedure naar aanleiding van een beslissing if its (centraal) bestuur van de eredienst, representatief orgaan, gemeente or provincie
+EXCLUSION_RULE_OPNAVB = exclusion_rule_pattern([
+    "<https://data.vlaanderen.be/id/concept/BesluitDocumentType/802a7e56-54f8-488d-b489-4816321fb9ae>"
+], """
+        ?bestuurseenheid besluit:classificatie ?bestuurseenheidType .
 
-        ?bestuurseenheid a ere:RepresentatiefOrgaan .
-    }}
-    """.format(submission, " ".join(DECISION_TYPES_RO))
+        VALUES ?bestuurseenheidType {
+            <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/66ec74fd-8cfc-4e16-99c6-350b35012e86>
+            <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/f9cac08a-13c1-49da-9bcb-f650b0604054>
+            <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/36372fad-0358-499c-a4e3-f412d2eae213>
+            <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/5ab0e9b8a3b2ca7c5e000001>
+            <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/5ab0e9b8a3b2ca7c5e000000>
+        }
+""")
+
+EXCLUSION_RULES = [
+    EXCLUSION_RULE_EB_HAS_CB,
+    EXCLUSION_RULE_EB_HAS_ACTIVE_CB,
+    EXCLUSION_RULE_EB,
+    EXCLUSION_RULE_CB,
+    EXCLUSION_RULE_RO,
+    EXCLUSION_RULE_GO,
+    EXCLUSION_RULE_PO,
+    EXCLUSION_RULE_MP,
+    EXCLUSION_RULE_OPNAVB,
+]
 
-    return ask_query_ro
 
-def verify_go_exclusion_rule(submission):
+def construct_exclusion_rule_ask_query(submission, exclusion_rule):
+    """
+    Construct a SPARQL query for asking if a submission matches an exclusion rule.
 
-    ask_query_go = """
-    PREFIX ere:         <http://data.lblod.info/vocabularies/erediensten/>
-    PREFIX org:         <http://www.w3.org/ns/org#>
-    PREFIX pav:         <http://purl.org/pav/>
-    PREFIX meb:         <http://rdf.myexperiment.org/ontologies/base/>
-    PREFIX dct:         <http://purl.org/dc/terms/>
-    PREFIX besluit:     <http://data.vlaanderen.be/ns/besluit#>
-    PREFIX prov:        <http://www.w3.org/ns/prov#>
-    PREFIX adms:        <http://www.w3.org/ns/adms#>
-    
+    :param submission: URI of the submission
+    :param exclusion_rule: one of EXCLUSION_RULES
+    :returns: string containing SPARQL query
+    """
+    q = EXCLUSION_RULE_PREFIXES + """
     ASK {{
         BIND(<{0}> AS ?submission)
-        ?submission a meb:Submission ;
-                   adms:status <http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c> ;
-                   prov:generated ?formData ;
-                   pav:createdBy ?bestuurseenheid .
-        ?formData dct:type ?decisionType .
-        VALUES ?decisionType {{ {1} }}
-
-        ?bestuurseenheid besluit:classificatie <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/5ab0e9b8a3b2ca7c5e000001> .
+        {1}
     }}
-    """.format(submission, " ".join(DECISION_TYPES_GO))
+    """.format(submission, exclusion_rule)
+    return q
 
-    return ask_query_go
 
-def verify_po_exclusion_rule(submission):
+def construct_excluded_submissions_query(submissions):
+    """
+    Construct a SPARQL query for selecting which of the given submissions match any of the exclusion rules.
 
-    ask_query_po = """
-    PREFIX ere:         <http://data.lblod.info/vocabularies/erediensten/>
-    PREFIX org:         <http://www.w3.org/ns/org#>
-    PREFIX pav:         <http://purl.org/pav/>
-    PREFIX meb:         <http://rdf.myexperiment.org/ontologies/base/>
-    PREFIX dct:         <http://purl.org/dc/terms/>
-    PREFIX besluit:     <http://data.vlaanderen.be/ns/besluit#>
-    PREFIX prov:        <http://www.w3.org/ns/prov#>
-    PREFIX adms:        <http://www.w3.org/ns/adms#>
-    
-    ASK {{
-        BIND(<{0}> AS ?submission)
-        ?submission a meb:Submission ;
-                   adms:status <http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c> ;
-                   prov:generated ?formData ;
-                   pav:createdBy ?bestuurseenheid .
-        ?formData dct:type ?decisionType .
-        VALUES ?decisionType {{ {1} }}
-        
-        ?bestuurseenheid besluit:classificatie <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/5ab0e9b8a3b2ca7c5e000000> .
+    :param submissions: list of submission URIs
+    :returns: string containing SPARQL query
+    """
+    q = EXCLUSION_RULE_PREFIXES + """
+    SELECT DISTINCT ?submission WHERE {{
+        VALUES ?submission {{ {0} }}
+        {{
+        {1}
+        }}
     }}
-    """.format(submission, " ".join(DECISION_TYPES_PO))
-
-    return ask_query_po
-
-def verify_mp_exclusion_rule(submission):
-    # Meerjarenplan exclusion if sender is a bestuur van de eredienst
-    ask_query_mp = """
-    PREFIX ere:     <http://data.lblod.info/vocabularies/erediensten/>
-    PREFIX pav:     <http://purl.org/pav/>
-    PREFIX meb:     <http://rdf.myexperiment.org/ontologies/base/>
-    PREFIX dct:     <http://purl.org/dc/terms/>
-    PREFIX prov:    <http://www.w3.org/ns/prov#>
-    PREFIX adms:    <http://www.w3.org/ns/adms#>
-    PREFIX besluit: <http://data.vlaanderen.be/ns/besluit#>
-    
-    ASK {{
-        BIND(<{0}> AS ?submission)
+    """.format(" ".join("<{}>".format(submission) for submission in submissions),
+               """
+        }
+        UNION
+        {
+        """.join(EXCLUSION_RULES))
+    return q
 
-        ?submission a meb:Submission ;
-                    adms:status <http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c> ;
-                    prov:generated ?formData ;
-                    pav:createdBy ?bestuurseenheid .
 
-        ?formData dct:type <https://data.vlaanderen.be/id/concept/BesluitType/f56c645d-b8e1-4066-813d-e213f5bc529f> .
+def verify_eb_has_cb_exclusion_rule(submission):
+    return construct_exclusion_rule_ask_query(submission, EXCLUSION_RULE_EB_HAS_CB)
 
-        ?bestuurseenheid besluit:classificatie <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/66ec74fd-8cfc-4e16-99c6-350b35012e86> .
-    }}
-    """.format(submission)
+def verify_eb_has_active_cb_exclusion_rule(submission):
+    return construct_exclusion_rule_ask_query(submission, EXCLUSION_RULE_EB_HAS_ACTIVE_CB)
 
-    return ask_query_mp
+def verify_eb_exclusion_rule(submission):
+    return construct_exclusion_rule_ask_query(submission, EXCLUSION_RULE_EB)
 
-def verify_opnavb_exclusion_rule(submission):
-    # Opstart beroepsprocedure naar aanleiding van een beslissing if its (centraal) bestuur van de eredienst, representatief orgaan, gemeente or provincie
-    ask_query_opnavb = """
-    PREFIX ere:     <http://data.lblod.info/vocabularies/erediensten/>
-    PREFIX pav:     <http://purl.org/pav/>
-    PREFIX meb:     <http://rdf.myexperiment.org/ontologies/base/>
-    PREFIX dct:     <http://purl.org/dc/terms/>
-    PREFIX prov:    <http://www.w3.org/ns/prov#>
-    PREFIX adms:    <http://www.w3.org/ns/adms#>
-    PREFIX besluit: <http://data.vlaanderen.be/ns/besluit#>
-    
-    ASK {{
-        BIND(<{0}> AS ?submission)
+def verify_cb_exclusion_rule(submission):
+    return construct_exclusion_rule_ask_query(submission, EXCLUSION_RULE_CB)
 
-        ?submission a meb:Submission ;
-                    adms:status <http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c> ;
-                    prov:generated ?formData ;
-                    pav:createdBy ?bestuurseenheid .
+def verify_ro_exclusion_rule(submission):
+    return construct_exclusion_rule_ask_query(submission, EXCLUSION_RULE_RO)
 
-        ?formData dct:type <https://data.vlaanderen.be/id/concept/BesluitDocumentType/802a7e56-54f8-488d-b489-4816321fb9ae> .
+def verify_go_exclusion_rule(submission):
+    return construct_exclusion_rule_ask_query(submission, EXCLUSION_RULE_GO)
 
-        ?bestuurseenheid besluit:classificatie ?bestuurseenheidType .
+def verify_po_exclusion_rule(submission):
+    return construct_exclusion_rule_ask_query(submission, EXCLUSION_RULE_PO)
 
-        VALUES ?bestuurseenheidType {{
-            <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/66ec74fd-8cfc-4e16-99c6-350b35012e86>
-            <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/f9cac08a-13c1-49da-9bcb-f650b0604054>
-            <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/36372fad-0358-499c-a4e3-f412d2eae213>
-            <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/5ab0e9b8a3b2ca7c5e000001>
-            <http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/5ab0e9b8a3b2ca7c5e000000>
-        }}
-    }}
-    """.format(submission)
+def verify_mp_exclusion_rule(submission):
+    return construct_exclusion_rule_ask_query(submission, EXCLUSION_RULE_MP)
 
-    return ask_query_opnavb
+def verify_opnavb_exclusion_rule(submission):
+    return construct_exclusion_rule_ask_query(submission, EXCLUSION_RULE_OPNAVB)
 
-def construct_unsent_inzendingen_query(max_sending_attempts):
+def construct_unsent_inzendingen_query(max_sending_attempts, graph_uris, inzending_uris=None):
     """
     Construct a SPARQL query for retrieving all messages for a given recipient that haven't been received yet by the other party.
 
     :param max_sending_attempts: the maximum number of delivery attempts that have to be done
+    :param graph_uris: list of the organization graphs to look in, None for any (see construct_graph_scope_statement())
+    :param inzending_uris: optional list of inzending URIs to restrict the results to
     :returns: string containing SPARQL query
     """
+    bound_inzending_statement = ""
+    if inzending_uris:
+        bound_inzending_statement = "VALUES ?inzending {{ {0} }}".format(" ".join("<{}>".format(uri)
+                                                                              for uri in inzending_uris))
+
     with open(CONFIG_FILE_PATH) as config_file:
         allowedDecisionTypesList = json.load(config_file)['allowedDecisionTypes'];
 
@@ -792,6 +791,8 @@ def construct_unsent_inzendingen_query(max_sending_attempts):
         SELECT DISTINCT ?inzending ?inzendingUuid ?bestuurseenheid ?decisionType ?sessionDate
                         ?decisionTypeLabel ?datumVanVerzenden ?boekjaar ?bestuurseenheidType
         WHERE {{
+            {2}
+            {3}
             GRAPH ?g {{
                 ?inzending a meb:Submission ;
                     adms:status <http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c> ;
@@ -819,10 +820,11 @@ def construct_unsent_inzendingen_query(max_sending_attempts):
             ?bestuurseenheid besluit:classificatie ?bestuurseenheidType .
 
             OPTIONAL {{ ?decisionType skos:prefLabel ?decisionTypeLabel }} .
-
-            FILTER(REGEX(STR(?g), "http://mu.semte.ch/graphs/organizations/.*/LoketLB-toezichtGebruiker"))
         }}
-        """.format(max_sending_attempts, separator.join(allowedDecisionTypesList))
+        """.format(max_sending_attempts,
+                   separator.join(allowedDecisionTypesList),
+                   construct_graph_scope_statement(graph_uris, "LoketLB-toezichtGebruiker"),
+                   bound_inzending_statement)
     return q
 
 
@@ -1008,10 +1010,11 @@ def construct_link_dossierbehandelaar_query(graph_uri, bericht):
     return q
 
 
-def construct_get_messages_by_status(status_uri, max_confirmation_attempts, bericht_uri=None):
+def construct_get_messages_by_status(status_uri, max_confirmation_attempts, graph_uris, bericht_uris=None):
     bound_bericht_statement = ""
-    if bericht_uri:
-        bound_bericht_statement = "BIND(<{0}> as ?bericht)".format(bericht_uri)
+    if bericht_uris:
+        bound_bericht_statement = "VALUES ?bericht {{ {0} }}".format(" ".join("<{}>".format(uri)
+                                                                          for uri in bericht_uris))
 
     query_str = """
         PREFIX schema: <http://schema.org/>
@@ -1031,6 +1034,7 @@ def construct_get_messages_by_status(status_uri, max_confirmation_attempts, beri
                         ?confirmationAttempts
                         ?g
         {{
+            {2}
             GRAPH ?g {{
                 BIND(<{0}> as ?status)
                 {1}
@@ -1048,14 +1052,21 @@ def construct_get_messages_by_status(status_uri, max_confirmation_attempts, beri
 
                 OPTIONAL {{ ?bericht ext:failedConfirmationAttempts ?confirmationAttempts. }}
             }}
-            FILTER( REGEX(STR(?g), "LoketLB-berichtenGebruiker"))
         }}
-    """.format(status_uri, bound_bericht_statement)
+    """.format(status_uri, bound_bericht_statement,
+               construct_graph_scope_statement(graph_uris, "LoketLB-berichtenGebruiker"))
 
     return query_str
 
 
-def construct_update_bericht_status(bericht_uri, status_uri):
+def construct_update_berichten_status_query(graph_bericht_uris, status_uri):
+    """
+    Construct a SPARQL query for setting the status of multiple berichten, each in its own graph.
+
+    :param graph_bericht_uris: list of tuples of the form (graph_uri, bericht_uri)
+    :param status_uri: URI of the new status
+    :returns: string containing SPARQL query
+    """
     query_str = """
         PREFIX schema: <http://schema.org/>
         PREFIX ext: <http://mu.semte.ch/vocabularies/ext/>
@@ -1072,24 +1083,26 @@ def construct_update_bericht_status(bericht_uri, status_uri):
           }}
         }}
         WHERE {{
-          BIND(<{0}> as ?bericht)
+          VALUES (?g ?bericht) {{ {0} }}
 
           GRAPH ?g {{
              ?bericht adms:status ?status.
           }}
         }}
-    """.format(bericht_uri, status_uri)
+    """.format(" ".join("(<{}> <{}>)".format(graph_uri, bericht_uri)
+                        for (graph_uri, bericht_uri) in graph_bericht_uris),
+               status_uri)
 
     return query_str
 
 
-def construct_increment_confirmation_attempts_query(graph_uri, poststuk_uri):
+def construct_increment_confirmation_attempts_query(graph_bericht_uris):
     """
     Construct a SPARQL query for incrementing (+1) the counter that keeps track of how many times
     the service attempted to send out a conformation for a certain message without succes.
+    Increments the counter of multiple berichten, each in its own graph.
 
-    :param graph_uri: string
-    :param poststuk_uri: URI of the bericht.
+    :param graph_bericht_uris: list of tuples of the form (graph_uri, bericht_uri)
     :returns: string containing SPARQL query
     """
 
@@ -1098,25 +1111,85 @@ def construct_increment_confirmation_attempts_query(graph_uri, poststuk_uri):
         PREFIX schema: <http://schema.org/>
 
         DELETE {{
-            GRAPH <{0}> {{
-                <{1}> ext:failedConfirmationAttempts ?result_attempts.
+            GRAPH ?g {{
+                ?bericht ext:failedConfirmationAttempts ?result_attempts.
             }}
         }}
         INSERT {{
-            GRAPH <{0}> {{
-                <{1}> ext:failedConfirmationAttempts ?incremented_attempts.
+            GRAPH ?g {{
+                ?bericht ext:failedConfirmationAttempts ?incremented_attempts.
             }}
         }}
         WHERE {{
-            GRAPH <{0}> {{
-                <{1}> a schema:Message.
+            VALUES (?g ?bericht) {{ {0} }}
+
+            GRAPH ?g {{
+                ?bericht a schema:Message.
 
-                OPTIONAL {{ <{1}> ext:failedConfirmationAttempts ?attempts. }}
+                OPTIONAL {{ ?bericht ext:failedConfirmationAttempts ?attempts. }}
                 BIND(0 AS ?default_attempts)
                 BIND(COALESCE(?attempts, ?default_attempts) AS ?result_attempts)
                 BIND((?result_attempts + 1) AS ?incremented_attempts)
             }}
         }}
-        """.format(graph_uri, poststuk_uri)
+        """.format(" ".join("(<{}> <{}>)".format(graph_uri, bericht_uri)
+                            for (graph_uri, bericht_uri) in graph_bericht_uris))
+
+    return q
+
 
+def construct_select_sync_cursor_query(graph_uri, cursor_uri):
+    """
+    Construct a SPARQL query for retrieving the state of a sync cursor.
+
+    :param graph_uri: string
+    :param cursor_uri: URI of the sync cursor
+    :returns: string containing SPARQL query
+    """
+    q = """
+        PREFIX ext: <http://mu.semte.ch/vocabularies/ext/>
+
+        SELECT DISTINCT ?processedUntil ?lastFullSweep
+        WHERE {{
+            GRAPH <{0}> {{
+                <{1}> a ext:KalliopeSyncCursor .
+                OPTIONAL {{ <{1}> ext:processedUntil ?processedUntil . }}
+                OPTIONAL {{ <{1}> ext:lastFullSweep ?lastFullSweep . }}
+            }}
+        }}
+        """.format(graph_uri, cursor_uri)
+    return q
+
+
+def construct_update_sync_cursor_query(graph_uri, cursor_uri, processed_until, last_full_sweep):
+    """
+    Construct a SPARQL query for (re)setting the state of a sync cursor.
+
+    :param graph_uri: string
+    :param cursor_uri: URI of the sync cursor
+    :param processed_until: ISO-string representation of the datetime up to which all poststukken were processed
+    :param last_full_sweep: ISO-string representation of the datetime of the last full-window sweep
+    :returns: string containing SPARQL query
+    """
+    q = """
+        PREFIX ext: <http://mu.semte.ch/vocabularies/ext/>
+
+        DELETE {{
+            GRAPH <{0}> {{
+                <{1}> ext:processedUntil ?processedUntil ;
+                    ext:lastFullSweep ?lastFullSweep .
+            }}
+        }}
+        INSERT {{
+            GRAPH <{0}> {{
+                <{1}> a ext:KalliopeSyncCursor ;
+                    ext:processedUntil "{2}"^^xsd:dateTime ;
+                    ext:lastFullSweep "{3}"^^xsd:dateTime .
+            }}
+        }}
+        WHERE {{
+            OPTIONAL {{ GRAPH <{0}> {{ <{1}> ext:processedUntil ?processedUntil . }} }}
+            OPTIONAL {{ GRAPH <{0}> {{ <{1}> ext:lastFullSweep ?lastFullSweep . }} }}
+        }}
+        """.format(graph_uri, cursor_uri, processed_until, last_full_sweep)
     return q
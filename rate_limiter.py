@@ -0,0 +1,224 @@
+import asyncio
+import collections
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from helpers import log
+
+MIN_POLL_INTERVAL = 0.005  # in seconds
+
+
+def parse_retry_after(value):
+    """
+    :param value: value of a Retry-After header, either a number of seconds or an HTTP date
+    :returns: the number of seconds to wait, None when the value can't be parsed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(tz=timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class Ticket:
+    def __init__(self, job):
+        self.job = job
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+class TokenBucket:
+    """
+    Token bucket of an endpoint or a host: rate tokens are added per second, up to burst.
+    Tokens are handed out round-robin over the jobs that are waiting, each job being served in FIFO order,
+    so a job firing many concurrent requests can't starve the others.
+    A bucket without a rate only holds the requests back while it's paused.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.waiting = collections.OrderedDict()  # job -> deque of tickets, in round-robin order
+        self.requests = 0
+        self.wait_time = 0.0
+
+    def grant(self, now):
+        if self.rate:
+            # No tokens are added while paused
+            elapsed = max(0.0, now - max(self.updated_at, self.paused_until))
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+        if now < self.paused_until:
+            return
+        while (self.tokens >= 1 or not self.rate) and self.waiting:
+            (job, tickets) = next(iter(self.waiting.items()))
+            tickets.popleft().granted = True
+            if self.rate:
+                self.tokens -= 1
+            del self.waiting[job]
+            if tickets:
+                self.waiting[job] = tickets  # Back of the line
+
+    def estimated_wait(self, ticket, now):
+        """
+        Time until the ticket is expected to be granted: every other waiting job is served at most
+        once for every ticket of the job that is ahead of it.
+        """
+        if not self.rate:
+            return max(MIN_POLL_INTERVAL, self.paused_until - now)
+        tickets = self.waiting[ticket.job]
+        position = tickets.index(ticket)
+        ahead = position + sum(min(len(others), position + 1)
+                               for (job, others) in self.waiting.items() if job != ticket.job)
+        wait = (ahead + 1 - self.tokens) / self.rate
+        return max(MIN_POLL_INTERVAL, wait, self.paused_until - now)
+
+
+class RateLimiter:
+    """
+    Rate limiter shared by all threads and the event loop, with a token bucket for the host and one per endpoint.
+    A request waits for a token of its endpoint, then for one of the host. A rate of 0 means no limit.
+    A throttled response (Retry-After) pauses the bucket of its endpoint, also when the endpoint has no rate.
+    """
+
+    def __init__(self, name, host_rate, rates=None, burst=1):
+        """
+        :param name: name of the remote service, used for logging
+        :param host_rate: requests per second over all endpoints, 0 for no limit
+        :param rates: optional dict of requests per second, keyed by endpoint
+        :param burst: number of requests that can be sent at once after a quiet period
+        """
+        self.name = name
+        self.rates = rates or {}
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.host_bucket = TokenBucket(host_rate, burst) if host_rate else None
+        self.buckets = {}
+        self.jobs = {}  # job -> {'requests', 'wait-time', 'max-wait-time'}
+
+    def bucket(self, endpoint):
+        if endpoint not in self.buckets:
+            self.buckets[endpoint] = TokenBucket(self.rates.get(endpoint, 0), self.burst)
+        return self.buckets[endpoint]
+
+    def request_buckets(self, endpoint):
+        """
+        :returns: the buckets a request to the endpoint has to get a token of, in order
+        """
+        with self.lock:
+            return [bucket for bucket in (self.bucket(endpoint), self.host_bucket) if bucket is not None]
+
+    def enqueue(self, bucket, job):
+        with self.lock:
+            ticket = Ticket(job)
+            bucket.waiting.setdefault(job, collections.deque()).append(ticket)
+            return ticket
+
+    def poll(self, bucket, ticket):
+        """
+        :returns: 0 when the ticket was granted, otherwise the time to wait before polling again
+        """
+        with self.lock:
+            now = time.monotonic()
+            bucket.grant(now)
+            if ticket.granted:
+                bucket.requests += 1
+                bucket.wait_time += now - ticket.enqueued_at
+                return 0
+            return bucket.estimated_wait(ticket, now)
+
+    def cancel(self, bucket, ticket):
+        with self.lock:
+            tickets = bucket.waiting.get(ticket.job)
+            if tickets and ticket in tickets:
+                tickets.remove(ticket)
+                if not tickets:
+                    del bucket.waiting[ticket.job]
+
+    def record_wait(self, job, wait):
+        with self.lock:
+            job_stats = self.jobs.setdefault(job, {'requests': 0, 'wait-time': 0.0, 'max-wait-time': 0.0})
+            job_stats['requests'] += 1
+            job_stats['wait-time'] += wait
+            job_stats['max-wait-time'] = max(job_stats['max-wait-time'], wait)
+
+    def acquire(self, endpoint, job=None):
+        """
+        Wait (blocking the calling thread) until a request to the endpoint may be sent.
+
+        :param endpoint: name of the endpoint
+        :param job: name of the job on behalf of which the request is sent
+        """
+        started_at = time.monotonic()
+        for bucket in self.request_buckets(endpoint):
+            ticket = self.enqueue(bucket, job)
+            try:
+                while True:
+                    wait = self.poll(bucket, ticket)
+                    if not wait:
+                        break
+                    time.sleep(wait)
+            except BaseException as e:
+                self.cancel(bucket, ticket)
+                raise e
+        self.record_wait(job, time.monotonic() - started_at)
+
+    async def acquire_async(self, endpoint, job=None):
+        """
+        Wait (without blocking the event loop) until a request to the endpoint may be sent, see acquire().
+        """
+        started_at = time.monotonic()
+        for bucket in self.request_buckets(endpoint):
+            ticket = self.enqueue(bucket, job)
+            try:
+                while True:
+                    wait = self.poll(bucket, ticket)
+                    if not wait:
+                        break
+                    await asyncio.sleep(wait)
+            except BaseException as e:  # e.g. the task was cancelled, don't hand it a token anymore
+                self.cancel(bucket, ticket)
+                raise e
+        self.record_wait(job, time.monotonic() - started_at)
+
+    def pause(self, endpoint, seconds):
+        """
+        Stop handing out tokens for the endpoint during the given number of seconds, e.g. as asked by Retry-After.
+        """
+        with self.lock:
+            bucket = self.bucket(endpoint)
+            paused_until = time.monotonic() + seconds
+            if paused_until > bucket.paused_until:
+                bucket.paused_until = paused_until
+                bucket.tokens = 0  # No burst once the pause is over
+                log("Requests to {} {} paused for {:.1f}s".format(self.name, endpoint, seconds))
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            endpoints = {endpoint: bucket_stats(bucket, now) for (endpoint, bucket) in self.buckets.items()}
+            host = bucket_stats(self.host_bucket, now) if self.host_bucket else {'rate': None}
+            jobs = {(job or 'other'): dict(job_stats,
+                                           **{'average-wait-time': job_stats['wait-time'] / job_stats['requests']})
+                    for (job, job_stats) in self.jobs.items()}
+        return {'host': host, 'endpoints': endpoints, 'jobs': jobs}
+
+
+def bucket_stats(bucket, now):
+    return {
+        'rate': bucket.rate or None,
+        'burst': bucket.burst,
+        'waiting': sum(len(tickets) for tickets in bucket.waiting.values()),
+        'paused-for': max(0.0, bucket.paused_until - now),
+        'requests': bucket.requests,
+        'average-wait-time': bucket.wait_time / bucket.requests if bucket.requests else None,
+    }
@@ -1,26 +1,69 @@
 import os
-from SPARQLWrapper import SPARQLWrapper, JSON
+import re
+import requests
+from requests.adapters import HTTPAdapter
 from helpers import log
 
-sparqlQuery = SPARQLWrapper(os.environ.get('MU_SPARQL_ENDPOINT'), returnFormat=JSON)
-sparqlQuery.addCustomHttpHeader('mu-auth-sudo', 'true')
-sparqlUpdate = SPARQLWrapper(os.environ.get('MU_SPARQL_UPDATEPOINT'), returnFormat=JSON)
-sparqlUpdate.method = 'POST'
-sparqlUpdate.addCustomHttpHeader('mu-auth-sudo', 'true')
+SPARQL_QUERY_ENDPOINT = os.environ.get('MU_SPARQL_ENDPOINT')
+SPARQL_UPDATE_ENDPOINT = os.environ.get('MU_SPARQL_UPDATEPOINT')
+SPARQL_POOL_SIZE = int(os.environ.get('SPARQL_POOL_SIZE', 10))
+SPARQL_CONNECT_TIMEOUT = float(os.environ.get('SPARQL_CONNECT_TIMEOUT', 10))  # in seconds
+SPARQL_READ_TIMEOUT = float(os.environ.get('SPARQL_READ_TIMEOUT', 300))  # in seconds
 
+SPARQL_RESULTS_JSON = 'application/sparql-results+json'
+UPDATE_OPERATIONS = {'INSERT', 'DELETE', 'WITH', 'LOAD', 'CLEAR', 'CREATE', 'DROP', 'COPY', 'MOVE', 'ADD'}
+# Skips the prologue (PREFIX/BASE declarations) and comments, captures the first keyword of the query
+FIRST_KEYWORD = re.compile(r'^(?:\s+|#[^\n]*|PREFIX\s+[\w.-]*:\s*<[^>]*>|BASE\s*<[^>]*>)*(\w+)', re.IGNORECASE)
 
-def query(the_query):
+
+def open_sparql_session():
+    """
+    Open a session towards the triple store. The session keeps a pool of keep-alive connections and can be shared
+    by multiple threads.
+    """
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=SPARQL_POOL_SIZE)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    s.headers.update({
+        'mu-auth-sudo': 'true',
+        'Accept': SPARQL_RESULTS_JSON,
+        'Accept-Encoding': 'gzip',
+    })
+    return s
+
+
+sparql_session = open_sparql_session()
+
+
+def is_update_query(the_query):
+    match = FIRST_KEYWORD.match(the_query)
+    return bool(match) and match.group(1).upper() in UPDATE_OPERATIONS
+
+
+def query(the_query, timeout=None):
     """Execute the given SPARQL query (select/ask/construct)on the triple store and returns the results
-    in the given returnFormat (JSON by default)."""
+    in the SPARQL JSON results format.
+
+    :param timeout: optional (connect, read) timeout in seconds, SPARQL_CONNECT_TIMEOUT/SPARQL_READ_TIMEOUT by default
+    """
     log("execute query: \n" + the_query)
-    sparqlQuery.setQuery(the_query)
-    return sparqlQuery.query().convert()
+    r = sparql_session.post(SPARQL_QUERY_ENDPOINT,
+                            data={'query': the_query},
+                            timeout=timeout or (SPARQL_CONNECT_TIMEOUT, SPARQL_READ_TIMEOUT))
+    r.raise_for_status()
+    return r.json()
 
 
-def update(the_query):
+def update(the_query, timeout=None):
     """Execute the given update SPARQL query on the triple store,
-    if the given query is no update query, nothing happens."""
-    sparqlUpdate.setQuery(the_query)
-    if sparqlUpdate.isSparqlUpdateRequest():
+    if the given query is no update query, nothing happens.
+
+    :param timeout: optional (connect, read) timeout in seconds, SPARQL_CONNECT_TIMEOUT/SPARQL_READ_TIMEOUT by default
+    """
+    if is_update_query(the_query):
         log("execute query: \n" + the_query)
-        sparqlUpdate.query()
+        r = sparql_session.post(SPARQL_UPDATE_ENDPOINT,
+                                data={'update': the_query},
+                                timeout=timeout or (SPARQL_CONNECT_TIMEOUT, SPARQL_READ_TIMEOUT))
+        r.raise_for_status()
@@ -0,0 +1,212 @@
+import math
+import os
+import threading
+import time
+from datetime import timedelta
+from dateutil import parser
+
+import helpers
+from helpers import log
+from .kalliope_adapter import open_kalliope_api_session
+from .task_process_berichten_in import import_window
+from .task_process_berichten_in import BIJLAGEN_DOWNLOAD_CONCURRENCY
+from .work_queue import work_queue_db, db_lock
+from .job_scheduler import current_job, job_executor
+
+BACKFILL_CONCURRENCY = int(os.environ.get('BACKFILL_CONCURRENCY', 4))
+BACKFILL_WINDOW = float(os.environ.get('BACKFILL_WINDOW', 6))  # in hours
+MIN_BACKFILL_WINDOW = 0.25  # in hours
+MAX_BACKFILL_WINDOWS = 10000
+
+WINDOW_PENDING = "pending"
+WINDOW_RUNNING = "running"
+WINDOW_DONE = "done"
+WINDOW_FAILED = "failed"
+
+running_backfills = set()
+running_backfills_lock = threading.Lock()
+schema_created = False
+
+
+def backfills_db():
+    """
+    Open the work queue database, creating the backfill tables on first use. Only to be used while holding db_lock.
+    """
+    global schema_created
+    db = work_queue_db()
+    if not schema_created:
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS backfills (
+                id TEXT PRIMARY KEY,
+                vanaf TEXT NOT NULL,
+                tot TEXT NOT NULL,
+                window_hours REAL NOT NULL,
+                elapsed REAL NOT NULL DEFAULT 0
+            )""")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS backfill_windows (
+                backfill TEXT NOT NULL,
+                vanaf TEXT NOT NULL,
+                tot TEXT NOT NULL,
+                status TEXT NOT NULL,
+                poststukken INTEGER,
+                failed INTEGER,
+                duration REAL,
+                error TEXT,
+                PRIMARY KEY (backfill, vanaf)
+            )""")
+        schema_created = True
+    return db
+
+
+def execute(sql, params=()):
+    with db_lock:
+        return backfills_db().execute(sql, params).fetchall()
+
+
+def execute_in_transaction(statements):
+    """
+    :param statements: list of tuples of the form (sql, params_list), all executed in a single transaction
+    """
+    with db_lock:
+        db = backfills_db()
+        db.execute("BEGIN")
+        try:
+            for (sql, params_list) in statements:
+                db.executemany(sql, params_list)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+
+def create_backfill(vanaf, tot, window_hours=BACKFILL_WINDOW):
+    """
+    Split the range [vanaf, tot) into time windows of window_hours, to be imported by run_backfill().
+    The windows are kept in the work queue database, so an interrupted backfill can be resumed.
+
+    :param vanaf: datetime, start of the range
+    :param tot: datetime, end of the range
+    :param window_hours: size of a window (in hours), at least MIN_BACKFILL_WINDOW
+    :returns: id of the backfill
+    :raises ValueError: when the range or the window size is invalid, or the range would need more than
+                        MAX_BACKFILL_WINDOWS windows
+    """
+    if tot <= vanaf:
+        raise ValueError("The end of the backfill range ({}) must be after its start ({})".format(tot, vanaf))
+    if not (math.isfinite(window_hours) and window_hours >= MIN_BACKFILL_WINDOW):
+        raise ValueError("The backfill windows must be at least {} hours, not {}".format(MIN_BACKFILL_WINDOW,
+                                                                                        window_hours))
+    window_count = math.ceil((tot - vanaf) / timedelta(hours=window_hours))
+    if window_count > MAX_BACKFILL_WINDOWS:
+        raise ValueError("A backfill of {} windows of {} hours exceeds the maximum of {} windows".format(
+            window_count, window_hours, MAX_BACKFILL_WINDOWS))
+    backfill_id = helpers.generate_uuid()
+    windows = []
+    window_start = vanaf
+    while window_start < tot:
+        window_end = min(window_start + timedelta(hours=window_hours), tot)
+        windows.append((backfill_id, window_start.isoformat(), window_end.isoformat(), WINDOW_PENDING))
+        window_start = window_end
+    execute_in_transaction([
+        ("INSERT INTO backfills (id, vanaf, tot, window_hours) VALUES (?, ?, ?, ?)",
+         [(backfill_id, vanaf.isoformat(), tot.isoformat(), window_hours)]),
+        ("INSERT INTO backfill_windows (backfill, vanaf, tot, status) VALUES (?, ?, ?, ?)", windows)
+    ])
+    log("Created backfill {} for {} - {}".format(backfill_id, vanaf.isoformat(), tot.isoformat()))
+    return backfill_id
+
+
+def start_backfill(backfill_id):
+    """
+    Run a backfill in the background, unless it's already running.
+
+    :returns: False when the backfill was already running
+    """
+    with running_backfills_lock:
+        if backfill_id in running_backfills:
+            return False
+        running_backfills.add(backfill_id)
+
+    def run():
+        current_job.set("backfill")  # Shares the Kalliope rate limits fairly with the scheduled jobs
+        try:
+            run_backfill(backfill_id)
+        except Exception as e:
+            log("Backfill {} stopped: {}".format(backfill_id, e))
+        finally:
+            with running_backfills_lock:
+                running_backfills.discard(backfill_id)
+
+    threading.Thread(target=run, name="backfill-{}".format(backfill_id), daemon=True).start()
+    return True
+
+
+def run_backfill(backfill_id):
+    """
+    Import all windows of a backfill that aren't done yet, BACKFILL_CONCURRENCY windows at a time.
+    Windows of which a poststuk failed to be imported are marked as failed and are retried when the backfill is resumed.
+
+    :param backfill_id: id as returned by create_backfill()
+    :returns: None
+    """
+    windows = execute("SELECT vanaf, tot FROM backfill_windows WHERE backfill = ? AND status != ? ORDER BY vanaf",
+                      (backfill_id, WINDOW_DONE))
+    log("Backfill {}: importing {} windows".format(backfill_id, len(windows)))
+    started_at = time.monotonic()
+    with open_kalliope_api_session() as session, \
+            job_executor(BACKFILL_CONCURRENCY) as window_executor, \
+            job_executor(BACKFILL_CONCURRENCY * BIJLAGEN_DOWNLOAD_CONCURRENCY) as bijlagen_executor:
+        for (vanaf, tot) in windows:
+            window_executor.submit(backfill_window, backfill_id, vanaf, tot, session, bijlagen_executor)
+    elapsed = time.monotonic() - started_at
+    execute("UPDATE backfills SET elapsed = elapsed + ? WHERE id = ?", (elapsed, backfill_id))
+    status = backfill_status(backfill_id)
+    log("Backfill {} finished a run in {:.0f}s: {} poststukken ({:.1f}/s), windows: {}".format(
+        backfill_id, elapsed, status['poststukken'], status['poststukken-per-second'] or 0, status['windows']))
+
+
+def backfill_window(backfill_id, vanaf, tot, session, bijlagen_executor):
+    execute("UPDATE backfill_windows SET status = ? WHERE backfill = ? AND vanaf = ?",
+            (WINDOW_RUNNING, backfill_id, vanaf))
+    started_at = time.monotonic()
+    try:
+        (count, failed_poststukken) = import_window(session, bijlagen_executor, parser.isoparse(vanaf), parser.isoparse(tot))
+        (status, error) = (WINDOW_FAILED if failed_poststukken else WINDOW_DONE, None)
+    except Exception as e:
+        (count, failed_poststukken, status, error) = (None, [], WINDOW_FAILED, str(e))
+        log("Backfill {}: window {} - {} failed: {}".format(backfill_id, vanaf, tot, e))
+    duration = time.monotonic() - started_at
+    execute("""UPDATE backfill_windows SET status = ?, poststukken = ?, failed = ?, duration = ?, error = ?
+               WHERE backfill = ? AND vanaf = ?""",
+            (status, count, len(failed_poststukken), duration, error, backfill_id, vanaf))
+    log("Backfill {}: window {} - {} {} with {} poststukken in {:.1f}s".format(backfill_id, vanaf, tot, status,
+                                                                              count, duration))
+
+
+def backfill_status(backfill_id):
+    """
+    :returns: dict describing the progress and throughput of a backfill, None when it doesn't exist
+    """
+    backfills = execute("SELECT vanaf, tot, window_hours, elapsed FROM backfills WHERE id = ?", (backfill_id,))
+    if not backfills:
+        return None
+    (vanaf, tot, window_hours, elapsed) = backfills[0]
+    windows = dict(execute("SELECT status, COUNT(*) FROM backfill_windows WHERE backfill = ? GROUP BY status",
+                           (backfill_id,)))
+    (poststukken, failed) = execute("""SELECT COALESCE(SUM(poststukken), 0), COALESCE(SUM(failed), 0)
+                                       FROM backfill_windows WHERE backfill = ?""", (backfill_id,))[0]
+    with running_backfills_lock:
+        running = backfill_id in running_backfills
+    return {
+        'id': backfill_id,
+        'vanaf': vanaf,
+        'tot': tot,
+        'window-hours': window_hours,
+        'running': running,
+        'windows': windows,
+        'poststukken': poststukken,
+        'failed-poststukken': failed,
+        'elapsed': elapsed,
+        'poststukken-per-second': poststukken / elapsed if elapsed else None,
+    }
@@ -1,6 +1,8 @@
 import os
+import threading
 from datetime import datetime, timedelta
 from pytz import timezone
+from dateutil import parser
 
 import requests.exceptions
 
@@ -8,12 +10,23 @@ import helpers
 from helpers import log
 from .sudo_query_helpers import query, update
 from .kalliope_adapter import parse_kalliope_poststuk_uit
+from .kalliope_adapter import KalliopeParseError
+from .kalliope_adapter import new_bijlage
 from .kalliope_adapter import parse_kalliope_bijlage
+from .kalliope_adapter import discard_kalliope_bijlagen
 from .kalliope_adapter import open_kalliope_api_session
-from .kalliope_adapter import get_kalliope_poststukken_uit
-from .kalliope_adapter import BIJLAGEN_FOLDER_PATH
-from .queries import construct_bestuurseenheid_exists_query
-from .queries import construct_bericht_exists_query
+from .circuit_breaker import CircuitOpenError
+from .kalliope_adapter import get_kalliope_poststukken_uit_pages
+from .kalliope_adapter import parse_kalliope_timestamp
+from .bestuurseenheden_cache import bestuurseenheden_cache
+from .bestuurseenheden_cache import organization_graph
+from .bestuurseenheden_cache import BERICHTEN_GEBRUIKER
+from .bijlagen_store import stored_file_name
+from .bijlagen_store import find_stored_bijlage
+from .bijlagen_store import store_bijlage
+from .bijlagen_store import remove_stored_bijlage
+from .bijlagen_store import remove_stale_downloads
+from .queries import construct_existing_berichten_query
 from .queries import construct_conversatie_exists_query
 from .queries import construct_insert_bijlage_query
 from .queries import construct_insert_conversatie_query
@@ -24,179 +37,516 @@ from .queries import construct_create_kalliope_sync_error_query
 from .queries import construct_dossierbehandelaar_exists_query
 from .queries import construct_insert_dossierbehandelaar_query
 from .queries import construct_link_dossierbehandelaar_query
+from .queries import construct_combined_update_query
+from .queries import construct_select_sync_cursor_query
+from .queries import construct_update_sync_cursor_query
 from .update_with_supressed_fail import update_with_suppressed_fail
+from .job_scheduler import job_executor
 
-from .task_process_berichten_in_confirmation import process_confirmations
+from .task_process_berichten_in_confirmation import enqueue_confirmation
 
 TIMEZONE = timezone('Europe/Brussels')
 PUBLIC_GRAPH = "http://mu.semte.ch/graphs/public"
 PS_UIT_PATH = os.environ.get('KALLIOPE_PS_UIT_ENDPOINT')
 MAX_MESSAGE_AGE = int(os.environ.get('MAX_MESSAGE_AGE'))  # in days
+SYNC_CURSOR_URI = "http://data.lblod.info/id/kalliope-sync-cursors/poststukken-uit"
+SYNC_CURSOR_OVERLAP = int(os.environ.get('SYNC_CURSOR_OVERLAP', 60))  # in minutes
+FULL_SWEEP_INTERVAL = int(os.environ.get('FULL_SWEEP_INTERVAL', 24))  # in hours
+BIJLAGEN_DOWNLOAD_CONCURRENCY = int(os.environ.get('BIJLAGEN_DOWNLOAD_CONCURRENCY', 4))
+BIJLAGEN_PREFETCH_POSTSTUKKEN = int(os.environ.get('BIJLAGEN_PREFETCH_POSTSTUKKEN', 2))
 
 class UnknownBestuurseenheidError(Exception):
     """Raised when the bestuurseenheid we received in unknown in our system."""
     pass
 
+# Errors that will occur again on every run for the same poststuk. They don't hold back the sync cursor,
+# the periodic full sweep picks these poststukken up again. Anything else (e.g. a truncated response) is retried.
+PERSISTENT_ERRORS = (UnknownBestuurseenheidError, KalliopeParseError)
+
+importing_berichten = set()  # URIs of the berichten being imported, by any thread
+importing_berichten_lock = threading.Lock()
+
 def process_berichten_in():
     """
     Fetch Berichten from the Kalliope-api, parse them, and if needed, import them into the triple store.
 
+    Only the poststukken made available since the last processed run (minus SYNC_CURSOR_OVERLAP) are requested,
+    except for a full sweep over MAX_MESSAGE_AGE every FULL_SWEEP_INTERVAL.
+
     :returns: None
     """
-    vanaf = datetime.now(tz=TIMEZONE) - timedelta(days=MAX_MESSAGE_AGE)
-    log("Pulling poststukken from kalliope API for period {} - now".format(vanaf.isoformat()))
-    with open_kalliope_api_session() as session:
+    remove_stale_downloads()
+    started_at = datetime.now(tz=TIMEZONE)
+    (vanaf, last_full_sweep) = determine_sync_window(started_at, *get_sync_cursor())
+    with open_kalliope_api_session() as session, \
+            job_executor(BIJLAGEN_DOWNLOAD_CONCURRENCY) as bijlagen_executor:
 
         try:
-            poststukken = get_kalliope_poststukken_uit(PS_UIT_PATH, session, vanaf)
-            log('Retrieved {} poststukken uit from Kalliope'.format(len(poststukken)))
+            (_, failed_poststukken) = import_window(session, bijlagen_executor, vanaf)
 
         except requests.exceptions.RequestException as e:
-            message = "Something went wrong while accessing the Kalliope API. Aborting: {}".format(e)
-            update_with_suppressed_fail(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, e))
-            log(message)
+            report_aborted_run(e)
             return
 
-        for poststuk in poststukken:
-            try:
-                (conversatie, bericht) = parse_kalliope_poststuk_uit(poststuk, session)
+    update_sync_cursor(determine_processed_until(started_at, vanaf, failed_poststukken), last_full_sweep)
+
+
+def determine_sync_window(started_at, processed_until, last_full_sweep):
+    """
+    Determine from when the poststukken are requested: since the last processed run (minus SYNC_CURSOR_OVERLAP),
+    or over MAX_MESSAGE_AGE for a full sweep.
+
+    :param started_at: datetime at which the run started
+    :param processed_until: datetime as returned by get_sync_cursor()
+    :param last_full_sweep: datetime as returned by get_sync_cursor()
+    :returns: tuple of the form (vanaf, last_full_sweep), last_full_sweep being started_at for a full sweep
+    """
+    full_window_start = started_at - timedelta(days=MAX_MESSAGE_AGE)
+    full_sweep = processed_until is None or last_full_sweep is None or \
+        last_full_sweep < started_at - timedelta(hours=FULL_SWEEP_INTERVAL)
+    if full_sweep:
+        vanaf = full_window_start
+        last_full_sweep = started_at
+    else:
+        vanaf = max(processed_until - timedelta(minutes=SYNC_CURSOR_OVERLAP), full_window_start)
+    log("Pulling poststukken from kalliope API for period {} - now{}".format(vanaf.isoformat(),
+                                                                          " (full sweep)" if full_sweep else ""))
+    return (vanaf, last_full_sweep)
+
+
+def report_aborted_run(e):
+    message = "Something went wrong while accessing the Kalliope API. Aborting: {}".format(e)
+    update_with_suppressed_fail(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, e))
+    log(message)
+
+
+def import_window(session, bijlagen_executor, vanaf, tot=None):
+    """
+    Fetch the poststukken made available within a time window from the Kalliope API, page by page,
+    and import those that are new into the triple store.
+
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param bijlagen_executor: executor on which the bijlagen get downloaded
+    :param vanaf: start of the time window
+    :param tot: optional end of the time window
+    :returns: tuple of the form (number of poststukken retrieved, poststukken that failed and should be retried)
+    """
+    count = 0
+    failed_poststukken = []
+    for poststukken in get_kalliope_poststukken_uit_pages(PS_UIT_PATH, session, vanaf, tot):
+        log('Retrieved a page of {} poststukken uit from Kalliope'.format(len(poststukken)))
+        count += len(poststukken)
+        (new_poststukken, failed) = select_new_poststukken(poststukken, session)
+        failed_poststukken += failed
+        failed_poststukken += import_poststukken(new_poststukken, session, bijlagen_executor)
+    return (count, failed_poststukken)
+
+
+def select_new_poststukken(poststukken, session):
+    """
+    Parse a page of poststukken and select those that still have to be imported into the triple store.
+    Already imported berichten are looked up for the whole page at once, bestuurseenheden in the
+    bestuurseenheden cache.
+
+    :param poststukken: list of poststuk uit deserialized JSON
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :returns: tuple of the form (new_poststukken, failed_poststukken), where new_poststukken is a list of tuples
+              of the form (poststuk, conversatie, bericht, graph)
+    """
+    (parsed_poststukken, failed_poststukken) = parse_poststukken(poststukken, session)
+    if not parsed_poststukken:
+        return ([], failed_poststukken)
+
+    try:
+        known_poststukken = select_known_poststukken(parsed_poststukken)
+        if not known_poststukken:
+            return ([], failed_poststukken)
+
+        q_berichten = construct_existing_berichten_query([(graph, bericht['uri'])
+                                                          for (_, _, bericht, graph) in known_poststukken])
+        existing_berichten = query(q_berichten)['results']['bindings']
+    except Exception as e:
+        return ([], failed_poststukken + report_poststukken_error(parsed_poststukken, e))
+
+    return (exclude_existing_poststukken(known_poststukken, existing_berichten), failed_poststukken)
+
+
+def parse_poststukken(poststukken, session=None):
+    """
+    :param poststukken: list of poststuk uit deserialized JSON
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :returns: tuple of the form (parsed_poststukken, failed_poststukken), where parsed_poststukken is a list of tuples
+              of the form (poststuk, conversatie, bericht)
+    """
+    failed_poststukken = []
+    parsed_poststukken = []
+    for poststuk in poststukken:
+        try:
+            (conversatie, bericht) = parse_kalliope_poststuk_uit(poststuk, session)
+            parsed_poststukken.append((poststuk, conversatie, bericht))
+        except Exception as e:
+            if not report_poststuk_error(poststuk, e):
+                failed_poststukken.append(poststuk)
+    return (parsed_poststukken, failed_poststukken)
+
+
+def select_known_poststukken(parsed_poststukken):
+    """
+    Select the poststukken addressed to a known bestuurseenheid, the others are reported.
+
+    :param parsed_poststukken: list of tuples as returned by parse_poststukken()
+    :returns: list of tuples of the form (poststuk, conversatie, bericht, graph)
+    """
+    known_poststukken = []
+    for (poststuk, conversatie, bericht) in parsed_poststukken:
+        bestuurseeheid_uri = bericht['naar']
+        if not bestuurseenheden_cache.is_known(bestuurseeheid_uri):
+            message = "Bestuurseenheid with uri {} not found in our database".format(bestuurseeheid_uri)
+            log(message)
+            report_poststuk_error(poststuk, UnknownBestuurseenheidError(message))
+        else:
+            graph = organization_graph(bestuurseeheid_uri, BERICHTEN_GEBRUIKER)
+            known_poststukken.append((poststuk, conversatie, bericht, graph))
+    return known_poststukken
+
+
+def exclude_existing_poststukken(known_poststukken, existing_berichten):
+    """
+    :param known_poststukken: list of tuples as returned by select_known_poststukken()
+    :param existing_berichten: rows as returned by construct_existing_berichten_query()
+    :returns: the tuples of the poststukken of which the bericht is not in our DB yet
+    """
+    existing_berichten = set((binding['g']['value'], binding['bericht']['value']) for binding in existing_berichten)
+    new_poststukken = []
+    for (poststuk, conversatie, bericht, graph) in known_poststukken:
+        if (graph, bericht['uri']) not in existing_berichten:  # Bericht is not in our DB yet. We should insert it.
+            log("Bericht '{}' - {} is not in DB yet.".format(conversatie['betreft'], bericht['verzonden']))
+            new_poststukken.append((poststuk, conversatie, bericht, graph))
+        else:  # bericht already exists in our DB
+            log("Bericht '{}' - {} already exists in our DB, skipping ...".format(conversatie['betreft'],
+                                                                                  bericht['verzonden']))
+    return new_poststukken
+
+
+def import_poststukken(new_poststukken, session, bijlagen_executor):
+    """
+    Import new poststukken into the triple store. The bijlagen of a poststuk are downloaded concurrently,
+    together with those of the next BIJLAGEN_PREFETCH_POSTSTUKKEN poststukken.
+    A bericht is only imported by the run that claimed it, and only if it still doesn't exist once claimed.
+
+    :param new_poststukken: list of tuples as returned by select_new_poststukken()
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param bijlagen_executor: executor on which the bijlagen get downloaded
+    :returns: list of poststukken that failed to be imported and should be retried
+    """
+    failed_poststukken = []
+    downloads = {}
+    for i, (poststuk, conversatie, bericht, graph) in enumerate(new_poststukken):
+        for j in range(i, min(i + 1 + BIJLAGEN_PREFETCH_POSTSTUKKEN, len(new_poststukken))):
+            if j not in downloads:
+                bijlagen_refs = new_poststukken[j][2]['bijlagen_refs']
+                downloads[j] = [bijlagen_executor.submit(fetch_bijlage, ps_bijlage, session)
+                                for ps_bijlage in bijlagen_refs]
+        bijlagen_downloads = downloads.pop(i)
+        if not claim_bericht(bericht['uri']):  # Being imported by a concurrent run (e.g. a backfill), retry it later
+            discard_kalliope_bijlagen(bijlagen_downloads)
+            failed_poststukken.append(poststuk)
+            continue
+        try:
+            # A concurrent run may have imported it since select_new_poststukken() checked
+            if query(construct_existing_berichten_query([(graph, bericht['uri'])]))['results']['bindings']:
+                log("Bericht {} was imported meanwhile, skipping ...".format(bericht['uri']))
+                discard_kalliope_bijlagen(bijlagen_downloads)
+                continue
+            insert_message_in_db(conversatie, bericht, poststuk, bijlagen_downloads, graph)
+            enqueue_confirmation(graph, bericht['uri'])
+        except Exception as e:
+            discard_kalliope_bijlagen(bijlagen_downloads)
+            if isinstance(e, CircuitOpenError):
+                # Kalliope is unavailable, abort the run instead of reporting an error for every poststuk
+                for prefetched_downloads in downloads.values():
+                    discard_kalliope_bijlagen(prefetched_downloads)
+                raise e
+            if not report_poststuk_error(poststuk, e):
+                failed_poststukken.append(poststuk)
+        finally:
+            release_bericht(bericht['uri'])
+    return failed_poststukken
+
+
+def claim_bericht(bericht_uri):
+    """
+    Claim the import of a bericht, so concurrent runs don't import it at the same time.
+
+    :returns: False when it's claimed already
+    """
+    with importing_berichten_lock:
+        claimed = bericht_uri not in importing_berichten
+        importing_berichten.add(bericht_uri)
+    return claimed
+
+
+def release_bericht(bericht_uri):
+    with importing_berichten_lock:
+        importing_berichten.discard(bericht_uri)
+
+
+def fetch_bijlage(ps_bijlage, session):
+    """
+    Fetch a bijlage from the Kalliope API, unless it was already downloaded before.
+
+    :param ps_bijlage: The bijlage deserialized JSON, as found in a poststuk
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :returns: a dict of bijlage properties, see parse_kalliope_bijlage()
+    """
+    return find_downloaded_bijlage(ps_bijlage) or parse_kalliope_bijlage(ps_bijlage, session)
+
+
+def find_downloaded_bijlage(ps_bijlage):
+    """
+    :param ps_bijlage: The bijlage deserialized JSON, as found in a poststuk
+    :returns: a dict of bijlage properties when it was already downloaded before, None otherwise
+    """
+    bijlage = new_bijlage(ps_bijlage)
+    stored_bijlage = find_stored_bijlage(stored_file_name(bijlage))
+    if stored_bijlage:
+        log("Bijlage {} was already downloaded, skipping download".format(bijlage['url']))
+        bijlage['mimetype'] = stored_bijlage['mimetype']
+        bijlage['size'] = stored_bijlage['size']
+        return bijlage
+    return None
+
+
+def report_poststuk_error(poststuk, e):
+    """
+    Report an error that occured while processing a poststuk.
+
+    :returns: True when the error will occur on every run for this poststuk, False when it should be retried
+    """
+    message = """
+            General error while trying to process message {}.
+                Error: {}
+            """.format(poststuk['uri'], e)
+    error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, poststuk['uri'], message, e)
+    update_with_suppressed_fail(error_query)
+    log(message)
+    return isinstance(e, PERSISTENT_ERRORS)
+
+
+def report_poststukken_error(poststukken, e):
+    """
+    Report an error that occured while processing a batch of poststukken.
 
-                bestuurseeheid_uri = bericht['naar']
-                bestuurseenheid_uuid = bestuurseeheid_uri.split('/')[-1]
-                bestuurseenheid_in_db = is_bestuurseenheid_in_db(bestuurseeheid_uri)
+    :param poststukken: list of tuples of which the first element is the poststuk
+    :returns: list of poststukken that should be retried
+    """
+    return [poststuk for (poststuk, *_) in poststukken if not report_poststuk_error(poststuk, e)]
+
+
+def get_sync_cursor():
+    """
+    Retrieve the sync cursor of the poststukken-uit polling.
 
-                if not bestuurseenheid_in_db:
-                    message = "Bestuurseenheid with uri {} not found in our database".format(bestuurseeheid_uri)
-                    log(message)
-                    raise UnknownBestuurseenheidError(message)
+    :returns: tuple (processed_until, last_full_sweep) of datetimes, (None, None) when no (usable) cursor is known
+    """
+    try:
+        bindings = query(construct_select_sync_cursor_query(PUBLIC_GRAPH, SYNC_CURSOR_URI))['results']['bindings']
+    except Exception as e:
+        log("Failed to retrieve the sync cursor, falling back to a full sweep: {}".format(e))
+        return (None, None)
+    return parse_sync_cursor(bindings)
 
-                else:
-                    log("Bestuurseeneheid {} found, proceeding with processing the message".format(bestuurseeheid_uri))
-                    graph =\
-                        "http://mu.semte.ch/graphs/organizations/{}/LoketLB-berichtenGebruiker".format(bestuurseenheid_uuid)
-                    message_in_db = is_message_in_db(bericht, graph)
 
-                    if not message_in_db:  # Bericht is not in our DB yet. We should insert it.
-                        log("Bericht '{}' - {} is not in DB yet.".format(conversatie['betreft'], bericht['verzonden']))
-                        insert_message_in_db(conversatie, bericht, poststuk, session, graph)
-                        process_confirmations(bericht['uri'])
+def parse_sync_cursor(bindings):
+    """
+    :param bindings: rows as returned by construct_select_sync_cursor_query()
+    :returns: tuple (processed_until, last_full_sweep) of datetimes, (None, None) when no (usable) cursor is known
+    """
+    def to_datetime(binding, key):
+        if key not in binding:
+            return None
+        value = parser.isoparse(binding[key]['value'])
+        return value if value.tzinfo else TIMEZONE.localize(value)
 
-                    else:  # bericht already exists in our DB
-                        log("Bericht '{}' - {} already exists in our DB, skipping ...".format(conversatie['betreft'],
-                                                                                              bericht['verzonden']))
+    if not bindings:
+        return (None, None)
+    return (to_datetime(bindings[0], 'processedUntil'), to_datetime(bindings[0], 'lastFullSweep'))
 
-            except Exception as e:
-                message = """
-                        General error while trying to process message {}.
-                            Error: {}
-                        """.format(poststuk['uri'], e)
-                error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, poststuk['uri'], message, e)
-                update_with_suppressed_fail(error_query)
-                log(message)
 
+def update_sync_cursor(processed_until, last_full_sweep):
+    q = construct_update_sync_cursor_query(PUBLIC_GRAPH,
+                                           SYNC_CURSOR_URI,
+                                           processed_until.replace(microsecond=0).isoformat(),
+                                           last_full_sweep.replace(microsecond=0).isoformat())
+    update_with_suppressed_fail(q)
+    log("Sync cursor set to {}".format(processed_until.isoformat()))
 
-def is_bestuurseenheid_in_db(bestuurseeheid_uri):
-    q = construct_bestuurseenheid_exists_query(bestuurseeheid_uri)
-    query_result = query(q)['boolean']
-    return query_result
 
+def determine_processed_until(started_at, vanaf, failed_poststukken):
+    """
+    Determine up to which moment all poststukken were processed. The earliest failed poststuk holds the cursor back,
+    so it is requested again on the next run.
 
-def is_message_in_db(bericht, graph):
-    q = construct_bericht_exists_query(graph, bericht['uri'])
-    query_result = query(q)['results']['bindings']
-    return False if not query_result else True
+    :param started_at: datetime at which the poststukken were requested
+    :param vanaf: datetime from which the poststukken were requested
+    :param failed_poststukken: poststukken that failed to be processed and should be retried
+    :returns: datetime
+    """
+    processed_until = started_at
+    for poststuk in failed_poststukken:
+        try:
+            beschikbaar = parse_kalliope_timestamp(poststuk['datumBeschikbaar'])
+        except Exception:
+            beschikbaar = vanaf
+        processed_until = min(processed_until, beschikbaar)
+    return processed_until
 
 
-def insert_message_in_db(conversatie, bericht, poststuk, session, graph):
-    # Fetch attachments & parse
+def insert_message_in_db(conversatie, bericht, poststuk, bijlagen_downloads, graph):
+    # Wait for the attachments, as fetched & parsed by fetch_bijlage()
     bericht['bijlagen'] = []
     try:
-        for ps_bijlage in bericht['bijlagen_refs']:
-            bijlage = parse_kalliope_bijlage(ps_bijlage, session)
-            bericht['bijlagen'].append(bijlage)
+        for download in bijlagen_downloads:
+            bericht['bijlagen'].append(download.result())
     except Exception as e:
-        message = "Something went wrong while parsing a bijlage for bericht {} sent @ {}".format(conversatie['betreft'],
-                                                                                                 bericht['verzonden'])
-        update(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, poststuk['uri'], message, e))
-        helpers.log(message)
+        report_bijlage_error(conversatie, bericht, poststuk, e)
         raise e
 
     delivery_timestamp = datetime.now(tz=TIMEZONE).replace(microsecond=0).isoformat()
 
+    # All writes for this bericht are combined into a single update request, saving the round trips. The triple store
+    # (through mu-auth) doesn't guarantee it's applied atomically.
     q2 = construct_conversatie_exists_query(graph, conversatie['referentieABB'])
-    query_result2 = query(q2)['results']['bindings']
-    if query_result2:  # The conversatie to which the bericht is linked exists.
-        conversatie['uri'] = query_result2[0]['conversatie']['value']
+    updates = prepare_conversatie(graph, conversatie, bericht, query(q2)['results']['bindings'], delivery_timestamp)
+
+    try:
+        # The files are stored first, they are removed again when the update below fails
+        updates += save_bijlagen(graph, bericht, bericht['bijlagen'])
+        updates.append(construct_update_last_bericht_query(conversatie['uri']))
+        updates += prepare_dossierbehandelaar(graph, bericht)
+        update(construct_combined_update_query(updates))
+    except Exception as e:
+        report_insert_error(graph, bericht, poststuk, e)
+        raise e
+
+
+def report_bijlage_error(conversatie, bericht, poststuk, e):
+    message = "Something went wrong while parsing a bijlage for bericht {} sent @ {}".format(conversatie['betreft'],
+                                                                                             bericht['verzonden'])
+    update(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, poststuk['uri'], message, e))
+    helpers.log(message)
+
+
+def prepare_conversatie(graph, conversatie, bericht, existing_conversaties, delivery_timestamp):
+    """
+    Construct the queries for inserting the bericht into its (possibly new) conversatie.
+
+    :param existing_conversaties: rows as returned by construct_conversatie_exists_query()
+    :returns: list of strings containing SPARQL queries
+    """
+    updates = []
+    if existing_conversaties:  # The conversatie to which the bericht is linked exists.
+        conversatie['uri'] = existing_conversaties[0]['conversatie']['value']
 
         log("Existing conversation '{}' inserting new message sent @ {}".format(conversatie['betreft'],
                                                                                 bericht['verzonden']))
 
-        q_bericht = construct_insert_bericht_query(graph, bericht, conversatie['uri'], delivery_timestamp)
-
-        try:
-            update(q_bericht)
-            q_type_communicatie =\
-                construct_update_conversatie_type_query(graph, conversatie['uri'], bericht['type_communicatie'])
-            update(q_type_communicatie)
-            # TODO: perhaps later first save bijlagen and the meta-data
-            save_bijlagen(graph, bericht, bericht['bijlagen'])
-        except Exception as e:
-            message = "Something went wrong inserting new message or conversation"
-            update(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, poststuk['uri'], message, e))
-            log("{}, skipping: {}\n{}".format(message, poststuk, e))
-            raise e
+        updates.append(construct_insert_bericht_query(graph, bericht, conversatie['uri'], delivery_timestamp))
+        updates.append(construct_update_conversatie_type_query(graph,
+                                                               conversatie['uri'],
+                                                               bericht['type_communicatie']))
 
     else:  # The conversatie to which the bericht is linked does not exist yet.
         log("Non-existing conversation '{}' inserting new conversation + message sent @ {}".
             format(conversatie['betreft'], bericht['verzonden']))
 
         conversatie['uri'] = "http://data.lblod.info/id/conversaties/{}".format(conversatie['uuid'])
-        q_conversatie = construct_insert_conversatie_query(graph, conversatie, bericht, delivery_timestamp)
-        try:
-            update(q_conversatie)
-            save_bijlagen(graph, bericht, bericht['bijlagen'])
-        except Exception as e:
-            message = "Something went wrong inserting new message"
-            update(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, poststuk['uri'], message, e))
-            log("{}, skipping: {}\n{}".format(message, poststuk, e))
-            raise e
+        updates.append(construct_insert_conversatie_query(graph, conversatie, bericht, delivery_timestamp))
+    return updates
+
+
+def report_insert_error(graph, bericht, poststuk, e):
+    """
+    Report that a bericht failed to be inserted, its stored files are removed unless it made it after all.
+    """
+    if not bericht_exists(graph, bericht['uri']):
+        discard_stored_bijlagen(bericht['bijlagen'])
+    message = "Something went wrong inserting new message or conversation"
+    update(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, poststuk['uri'], message, e))
+    log("{}, skipping: {}\n{}".format(message, poststuk, e))
 
-    try:
-        update(construct_update_last_bericht_query(conversatie['uri']))
-        insert_dossierbehandelaar_in_db(graph, bericht)
-    except Exception as e:
-        message = "Something went wrong updating conversation and dossierbehandelaar"
-        update(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, poststuk['uri'], message, e))
-        log("{}, skipping: {}\n{}".format(message, poststuk, e))
-        raise e
 
 def save_bijlagen(bericht_graph_uri, bericht, bijlagen):
+    """
+    Store the files of the bijlagen and construct the queries for inserting their meta-data.
+
+    :returns: list of strings containing SPARQL queries
+    """
+    q_bijlagen = []
     for bijlage in bijlagen:
         bijlage['uri'] = "http://mu.semte.ch/services/file-service/files/{}".format(bijlage['id'])
         file = {
             'id': bijlage['id'],
             'uuid': helpers.generate_uuid(),
-            'name': bijlage['id'] + "." + bijlage['extension'],
-            'uri': "share://" + bijlage['id'] + "." + bijlage['extension'],
+            'name': stored_file_name(bijlage),
+            'uri': "share://" + stored_file_name(bijlage),
         }
-        filepath = os.path.join(BIJLAGEN_FOLDER_PATH, file['name'])
-        f = open(filepath, 'wb')
-        f.write(bijlage['buffer'])
-        q_bijlage = construct_insert_bijlage_query(bericht_graph_uri,
-                                                   bericht['uri'],
-                                                   bijlage,
-                                                   file)  # TEMP: bijlage in public graph
-        update(q_bijlage)
+        if 'tmp_filepath' in bijlage:  # Not downloaded before, see fetch_bijlage()
+            store_bijlage(bijlage['tmp_filepath'], bijlage['sha256'], file['name'])
+            bijlage['stored_file_name'] = file['name']
+        q_bijlagen.append(construct_insert_bijlage_query(bericht_graph_uri,
+                                                         bericht['uri'],
+                                                         bijlage,
+                                                         file))  # TEMP: bijlage in public graph
+    return q_bijlagen
+
 
+def bericht_exists(graph, bericht_uri):
+    """
+    Check if a bericht made it into the triple store after all, e.g. after its update timed out.
 
-def insert_dossierbehandelaar_in_db(graph, bericht):
+    :returns: True when it exists, or when that can't be determined
+    """
+    try:
+        return bool(query(construct_existing_berichten_query([(graph, bericht_uri)]))['results']['bindings'])
+    except Exception as e:
+        log("Failed to check if bericht {} exists, keeping its files: {}".format(bericht_uri, e))
+        return True
+
+
+def discard_stored_bijlagen(bijlagen):
+    """
+    Remove the files stored by save_bijlagen() for a bericht that failed to be imported, so they aren't left behind
+    unreferenced. The bijlagen are downloaded again when the import is retried.
+    """
+    for bijlage in bijlagen:
+        if 'stored_file_name' in bijlage:
+            try:
+                remove_stored_bijlage(bijlage['sha256'], bijlage.pop('stored_file_name'))
+            except OSError as e:
+                log("Failed to remove stored bijlage {}: {}".format(bijlage['url'], e))
+
+
+def prepare_dossierbehandelaar(graph, bericht):
+    """
+    Construct the queries for linking the bericht to its (possibly new) dossierbehandelaar.
+
+    :returns: list of strings containing SPARQL queries
+    """
     q_dossierbehandelaar_exists = construct_dossierbehandelaar_exists_query(graph, bericht['dossierbehandelaar'])
-    query_result_dossierbehandelaar_exists = query(q_dossierbehandelaar_exists)['results']['bindings']
+    return link_dossierbehandelaar(graph, bericht, query(q_dossierbehandelaar_exists)['results']['bindings'])
+
+
+def link_dossierbehandelaar(graph, bericht, query_result_dossierbehandelaar_exists):
+    """
+    :param query_result_dossierbehandelaar_exists: rows as returned by construct_dossierbehandelaar_exists_query()
+    :returns: list of strings containing SPARQL queries
+    """
+    q_dossierbehandelaar = []
     if not query_result_dossierbehandelaar_exists:
-        q_dossierbehandelaar = construct_insert_dossierbehandelaar_query(graph, bericht)
-        update(q_dossierbehandelaar)
+        q_dossierbehandelaar.append(construct_insert_dossierbehandelaar_query(graph, bericht))
     else:
         bericht['dossierbehandelaar']['uri'] = query_result_dossierbehandelaar_exists[0]['dossierbehandelaar']['value']
 
-    q_link_dossierbehandelaar_bericht = construct_link_dossierbehandelaar_query(graph, bericht)
-    update(q_link_dossierbehandelaar_bericht)
+    q_dossierbehandelaar.append(construct_link_dossierbehandelaar_query(graph, bericht))
+    return q_dossierbehandelaar
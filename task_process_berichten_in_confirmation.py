@@ -1,4 +1,5 @@
 import os
+import threading
 from pytz import timezone
 from helpers import log
 
@@ -6,62 +7,206 @@ from .sudo_query_helpers import query, update
 from .update_with_supressed_fail import update_with_suppressed_fail
 
 from .queries import STATUS_DELIVERED_CONFIRMED, STATUS_DELIVERED_UNCONFIRMED, STATUS_DELIVERED_CONFIRMATION_FAILED
-from .queries import construct_get_messages_by_status, construct_update_bericht_status
+from .queries import construct_get_messages_by_status, construct_update_berichten_status_query
 from .queries import construct_create_kalliope_sync_error_query
 from .queries import construct_increment_confirmation_attempts_query
 
 from .kalliope_adapter import post_kalliope_poststuk_uit_confirmation
 from .kalliope_adapter import open_kalliope_api_session
+from .kalliope_adapter import kalliope_circuit
+from .circuit_breaker import CircuitOpenError
+from .work_queue import WorkQueue
+from .job_scheduler import job_executor
+from .bestuurseenheden_cache import bestuurseenheden_cache
+from .bestuurseenheden_cache import BERICHTEN_GEBRUIKER
 
 TIMEZONE = timezone('Europe/Brussels')
 MAX_CONFIRMATION_ATTEMPTS = int(os.environ.get('MAX_CONFIRMATION_ATTEMPTS'))
 PS_UIT_CONFIRMATION_PATH = os.environ.get('KALLIOPE_PS_UIT_CONFIRMATION_ENDPOINT')
 PUBLIC_GRAPH = "http://mu.semte.ch/graphs/public"
+CONFIRMATIONS_CONCURRENCY = int(os.environ.get('CONFIRMATIONS_CONCURRENCY', 4))
+CONFIRMATION_UPDATE_BATCH_SIZE = 100
+CONFIRMATION_ATTEMPT_FAILED = "attempt-failed"
+CONFIRMATION_SHORT_CIRCUITED = "short-circuited"
+WORK_QUEUE_BATCH_SIZE = 50
 
+confirmations_lock = threading.Lock()
+confirmations_queue = WorkQueue('confirmations', MAX_CONFIRMATION_ATTEMPTS)
 
-def process_confirmations(bericht_uri=None):
+
+def process_confirmations():
+    """
+    Send the confirmations of all delivered berichten that aren't confirmed yet.
+    Catches up on the berichten that didn't pass through the confirmations queue,
+    except for those waiting for their next attempt in the queue.
+
+    :returns: None
+    """
     try:
         log("Checking for new delivery confirmations to process")
+        with open_kalliope_api_session() as session:
+            confirm_berichten(session)
 
-        query_string = construct_get_messages_by_status(STATUS_DELIVERED_UNCONFIRMED, MAX_CONFIRMATION_ATTEMPTS, bericht_uri)
-        berichten = query(query_string).get('results', {}).get('bindings', [])
+    except Exception as e:
+        report_confirmations_error(e)
 
-        log("Found {} confirmations that need to be sent to the Kalliope API".format(len(berichten)))
 
-        if len(berichten) == 0:
-            log("No confirmations need to be sent, I am going to get a coffee")
-        else:
-            with open_kalliope_api_session() as session:
-                for bericht in berichten:
-                    process_confirmation(session, bericht)
+def enqueue_confirmation(graph, bericht_uri):
+    """
+    Schedule the confirmation of a newly delivered bericht, to be sent by the next dispatch_confirmations() run.
+
+    :param graph: the organization graph the bericht was delivered in
+    :param bericht_uri: URI of the delivered bericht
+    :returns: None
+    """
+    confirmations_queue.push([[graph, bericht_uri]])
 
+
+def dispatch_confirmations():
+    """
+    Send the confirmations in the confirmations queue of which the next attempt is due.
+    Nothing is attempted while the Kalliope circuit is open.
+
+    :returns: None
+    """
+    if kalliope_circuit.is_open():
+        return
+    graph_bericht_uris = confirmations_queue.due(WORK_QUEUE_BATCH_SIZE)
+    if not graph_bericht_uris:
+        return
+    try:
+        with open_kalliope_api_session() as session:
+            confirm_berichten(session, graph_bericht_uris)
     except Exception as e:
+        report_confirmations_error(e, graph_bericht_uris)
+
+
+def report_confirmations_error(e, graph_bericht_uris=None):
+    """
+    Report an error that aborted a run of the confirmations.
+
+    :param graph_bericht_uris: the dispatched confirmations, None for the cron job
+    """
+    if graph_bericht_uris is None:
         message = """
                 General error while trying to run the process confirmations job.
                     Error: {}
                 """.format(e)
-        # TODO: this PUBLIC_GRAPH should really be another graph!!!! (now done for consistency)
-        error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, e)
-        update_with_suppressed_fail(error_query)
+    else:
+        message = """
+                General error while trying to process the confirmations of messages {}.
+                    Error: {}
+                """.format(", ".join(bericht_uri for (_, bericht_uri) in graph_bericht_uris), e)
+    # TODO: this PUBLIC_GRAPH should really be another graph!!!! (now done for consistency)
+    error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, e)
+    update_with_suppressed_fail(error_query)
+    log(message)
+
+
+def confirm_berichten(session, graph_bericht_uris=None):
+    """
+    Send the confirmations of the unconfirmed berichten, save the outcomes and record them in the confirmations queue:
+    a failed confirmation is retried with backoff, a bericht that reached a final status leaves the queue.
+    The cron job and the queue dispatcher never confirm at the same time, so a bericht can't be handled twice at once.
+
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param graph_bericht_uris: optional list of pairs of the form [graph_uri, bericht_uri]
+                               to restrict the confirmations to
+    :returns: None
+    """
+    (graph_batches, bericht_uris) = confirmation_graph_batches(graph_bericht_uris)
+    with confirmations_lock:
+        berichten = []
+        for graph_uris in graph_batches:
+            query_string = construct_get_messages_by_status(STATUS_DELIVERED_UNCONFIRMED,
+                                                            MAX_CONFIRMATION_ATTEMPTS,
+                                                            graph_uris,
+                                                            bericht_uris)
+            berichten.extend(query(query_string).get('results', {}).get('bindings', []))
+
+        berichten = select_due_confirmations(berichten, graph_bericht_uris)
+        if len(berichten) == 0:
+            log("No confirmations need to be sent, I am going to get a coffee")
+        else:
+            with job_executor(CONFIRMATIONS_CONCURRENCY) as executor:
+                outcomes = list(executor.map(lambda bericht: process_confirmation(session, bericht), berichten))
+            unsaved = save_confirmation_outcomes(berichten, outcomes)
+            record_confirmation_outcomes(berichten, outcomes, unsaved)
+
+
+def confirmation_graph_batches(graph_bericht_uris):
+    """
+    :param graph_bericht_uris: the dispatched confirmations, None for the cron job
+    :returns: tuple of the form (graph_batches, bericht_uris): the batches of organization graphs to look up the
+              unconfirmed berichten in, and the bericht URIs to restrict them to (None for all)
+    """
+    if graph_bericht_uris:
+        return ([sorted({graph_uri for (graph_uri, _) in graph_bericht_uris})],
+                [bericht_uri for (_, bericht_uri) in graph_bericht_uris])
+    return (bestuurseenheden_cache.organization_graph_batches(BERICHTEN_GEBRUIKER), None)
+
+
+def select_due_confirmations(berichten, graph_bericht_uris):
+    """
+    Select the unconfirmed berichten of which the confirmation has to be sent now. The cron job leaves out those
+    waiting for their next attempt in the confirmations queue, the dispatched confirmations that aren't unconfirmed
+    anymore leave the queue.
+
+    :param berichten: rows as returned by construct_get_messages_by_status()
+    :param graph_bericht_uris: the dispatched confirmations, None for the cron job
+    :returns: the rows of the confirmations to send
+    """
+    unconfirmed = [[bericht["g"]["value"], bericht["bericht"]["value"]] for bericht in berichten]
+    if graph_bericht_uris:
+        confirmations_queue.succeeded([item for item in graph_bericht_uris if item not in unconfirmed])
+    else:
+        # Dead-lettered confirmations are left in, process_confirmation() gives them their final status
+        deferred = confirmations_queue.deferred(unconfirmed, include_dead=False)
+        berichten = [bericht for (bericht, item) in zip(berichten, unconfirmed) if item not in deferred]
+    log("Found {} confirmations that need to be sent to the Kalliope API".format(len(berichten)))
+    return berichten
+
+
+def record_confirmation_outcomes(berichten, outcomes, unsaved):
+    """
+    Record the outcomes of a run in the confirmations queue: a failed confirmation is retried with backoff,
+    a bericht that reached a final status leaves the queue.
+
+    :param berichten: rows as returned by construct_get_messages_by_status()
+    :param outcomes: the results of process_confirmation(), in the same order as berichten
+    :param unsaved: as returned by save_confirmation_outcomes()
+    """
+    for (bericht, outcome) in zip(berichten, outcomes):
+        item = [bericht["g"]["value"], bericht["bericht"]["value"]]
+        if item in unsaved:  # Its status wasn't written, retry it
+            confirmations_queue.failed([item])
+        elif outcome in (STATUS_DELIVERED_CONFIRMED, STATUS_DELIVERED_CONFIRMATION_FAILED):
+            confirmations_queue.succeeded([item])
+        elif outcome != CONFIRMATION_SHORT_CIRCUITED:  # Not an attempt, the confirmation stays due
+            confirmations_queue.failed([item])
+    short_circuited = outcomes.count(CONFIRMATION_SHORT_CIRCUITED)
+    if short_circuited:
+        message = "The Kalliope API is unavailable, {} confirmations were not sent".format(short_circuited)
+        update_with_suppressed_fail(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, message))
         log(message)
 
 
 def process_confirmation(session, bericht):
+    """
+    Send the confirmation of a single bericht to Kalliope. Runs on one of the CONFIRMATIONS_CONCURRENCY workers,
+    the resulting status changes are written by save_confirmation_outcomes().
+
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param bericht: row as returned by construct_get_messages_by_status()
+    :returns: the new status of the bericht, CONFIRMATION_ATTEMPT_FAILED when the attempt failed,
+              CONFIRMATION_SHORT_CIRCUITED when it wasn't attempted because Kalliope is unavailable
+              or None when nothing changed
+    """
     try:
-        attempt = bericht["confirmationAttempts"]["value"] if "confirmationAttempts" in bericht.keys() else 0
-        log("Attempt to confirm {} number {}".format(bericht["bericht"]["value"], attempt))
-
-        if (int(attempt) >= int(MAX_CONFIRMATION_ATTEMPTS)):
-            log('Maximum number of attempts reached. Setting status of {} to {}'.
-                format(bericht["bericht"]["value"], STATUS_DELIVERED_CONFIRMATION_FAILED))
-            failed_q = construct_update_bericht_status(bericht["bericht"]["value"], STATUS_DELIVERED_CONFIRMATION_FAILED)
-            update(failed_q)
+        poststuk_uit_confirmation = new_confirmation(bericht)
+        if poststuk_uit_confirmation is None:
+            return STATUS_DELIVERED_CONFIRMATION_FAILED
         else:
-            poststuk_uit_confirmation = {
-                'uriPoststukUit': bericht["bericht"]["value"],
-                'datumBeschikbaarheid': bericht["deliveredAt"]["value"]
-            }
-
             post_result = post_kalliope_poststuk_uit_confirmation(PS_UIT_CONFIRMATION_PATH,
                                                                   session,
                                                                   poststuk_uit_confirmation)
@@ -69,22 +214,102 @@ def process_confirmation(session, bericht):
             if post_result:
                 # TODO: note, the implicit assumption here is that in some cases,
                 # the same confirmation might be sent twice.
-                # (i.e. when confirmation to K. was ok, but next statement fails)
+                # (i.e. when confirmation to K. was ok, but the status update fails)
                 # Anyway, there is no way around this, if you need robust confirmation...
-                confirmation_q = construct_update_bericht_status(bericht["bericht"]["value"],
-                                                                 STATUS_DELIVERED_CONFIRMED)
                 log("successfully sent confirmation to Kalliope for message {}".format(bericht["bericht"]["value"]))
-                update(confirmation_q)
+                return STATUS_DELIVERED_CONFIRMED
+            return None
 
+    except CircuitOpenError:
+        return CONFIRMATION_SHORT_CIRCUITED
     except Exception as e:
-        message = """
-                General error while trying to process the confirmation for message {}.
-                    Error: {}
-                """.format(bericht["bericht"]["value"], e)
-        # TODO: this PUBLIC_GRAPH should really be another graph!!!! (now done for consistency)
-        error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, bericht["bericht"]["value"], message, e)
-        update_with_suppressed_fail(error_query)
-        confirmation_query = construct_increment_confirmation_attempts_query(bericht["g"]["value"],
-                                                                             bericht["bericht"]["value"])
-        update_with_suppressed_fail(confirmation_query)
-        log(message)
+        report_confirmation_error(bericht, e)
+        return CONFIRMATION_ATTEMPT_FAILED
+
+
+def new_confirmation(bericht):
+    """
+    :param bericht: row as returned by construct_get_messages_by_status()
+    :returns: the confirmation to send to Kalliope, None when the maximum number of attempts was reached
+    """
+    attempt = bericht["confirmationAttempts"]["value"] if "confirmationAttempts" in bericht.keys() else 0
+    log("Attempt to confirm {} number {}".format(bericht["bericht"]["value"], attempt))
+
+    if (int(attempt) >= int(MAX_CONFIRMATION_ATTEMPTS)):
+        log('Maximum number of attempts reached. Setting status of {} to {}'.
+            format(bericht["bericht"]["value"], STATUS_DELIVERED_CONFIRMATION_FAILED))
+        return None
+    return {
+        'uriPoststukUit': bericht["bericht"]["value"],
+        'datumBeschikbaarheid': bericht["deliveredAt"]["value"]
+    }
+
+
+def report_confirmation_error(bericht, e):
+    message = """
+            General error while trying to process the confirmation for message {}.
+                Error: {}
+            """.format(bericht["bericht"]["value"], e)
+    # TODO: this PUBLIC_GRAPH should really be another graph!!!! (now done for consistency)
+    error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, bericht["bericht"]["value"], message, e)
+    update_with_suppressed_fail(error_query)
+    log(message)
+
+
+def save_confirmation_outcomes(berichten, outcomes):
+    """
+    Write the outcomes of a run back to the triple store: one graph-scoped update per kind of outcome,
+    for CONFIRMATION_UPDATE_BATCH_SIZE berichten at a time. A batch that fails to be written is reported,
+    the remaining batches are still written.
+
+    :param berichten: rows as returned by construct_get_messages_by_status()
+    :param outcomes: the results of process_confirmation(), in the same order as berichten
+    :returns: list of pairs of the form [graph_uri, bericht_uri] of which the new status failed to be written
+    """
+    unsaved = []
+    for (outcome, batch) in confirmation_outcome_batches(berichten, outcomes):
+        if outcome == CONFIRMATION_ATTEMPT_FAILED:
+            update_with_suppressed_fail(construct_increment_confirmation_attempts_query(batch))
+            continue
+        try:
+            update(construct_update_berichten_status_query(batch, outcome))
+        except Exception as e:
+            unsaved.extend(report_unsaved_outcomes(batch, outcome, e))
+    return unsaved
+
+
+def confirmation_outcome_batches(berichten, outcomes):
+    """
+    Group the outcomes to write by kind, in batches of CONFIRMATION_UPDATE_BATCH_SIZE berichten.
+
+    :param berichten: rows as returned by construct_get_messages_by_status()
+    :param outcomes: the results of process_confirmation(), in the same order as berichten
+    :returns: list of tuples of the form (outcome, batch), batch being a list of (graph_uri, bericht_uri) tuples
+    """
+    graph_bericht_uris = {STATUS_DELIVERED_CONFIRMED: [],
+                          STATUS_DELIVERED_CONFIRMATION_FAILED: [],
+                          CONFIRMATION_ATTEMPT_FAILED: []}
+    for (bericht, outcome) in zip(berichten, outcomes):
+        if outcome in graph_bericht_uris:
+            graph_bericht_uris[outcome].append((bericht["g"]["value"], bericht["bericht"]["value"]))
+    log("Confirmed {} messages, {} confirmations failed, {} reached the maximum number of attempts".format(
+        len(graph_bericht_uris[STATUS_DELIVERED_CONFIRMED]),
+        len(graph_bericht_uris[CONFIRMATION_ATTEMPT_FAILED]),
+        len(graph_bericht_uris[STATUS_DELIVERED_CONFIRMATION_FAILED])))
+    return [(outcome, uris[i:i + CONFIRMATION_UPDATE_BATCH_SIZE])
+            for (outcome, uris) in graph_bericht_uris.items()
+            for i in range(0, len(uris), CONFIRMATION_UPDATE_BATCH_SIZE)]
+
+
+def report_unsaved_outcomes(batch, outcome, e):
+    """
+    :returns: list of pairs of the form [graph_uri, bericht_uri] of the batch, of which the status wasn't written
+    """
+    message = """
+            Failed to set the status of messages {} to {}.
+                Error: {}
+            """.format(", ".join(bericht_uri for (_, bericht_uri) in batch), outcome, e)
+    update_with_suppressed_fail(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, e))
+    log(message)
+    return [[graph_uri, bericht_uri] for (graph_uri, bericht_uri) in batch]
+
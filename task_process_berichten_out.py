@@ -1,4 +1,5 @@
 import os
+import threading
 from pytz import timezone
 from datetime import datetime
 
@@ -9,13 +10,20 @@ from .sudo_query_helpers import query, update
 from .kalliope_adapter import construct_kalliope_poststuk_in
 from .kalliope_adapter import open_kalliope_api_session
 from .kalliope_adapter import post_kalliope_poststuk_in
+from .kalliope_adapter import kalliope_circuit
+from .circuit_breaker import CircuitOpenError
+from .bestuurseenheden_cache import bestuurseenheden_cache
+from .bestuurseenheden_cache import organization_graph
+from .bestuurseenheden_cache import BERICHTEN_GEBRUIKER
 from .queries import construct_unsent_berichten_query
-from .queries import construct_select_bijlagen_query
+from .queries import construct_select_berichten_bijlagen_query
 from .queries import construct_increment_bericht_attempts_query
 from .queries import construct_bericht_sent_query
-from .queries import construct_select_original_bericht_query
+from .queries import construct_select_original_berichten_query
 from .queries import construct_create_kalliope_sync_error_query
 from .update_with_supressed_fail import update_with_suppressed_fail
+from .work_queue import WorkQueue
+from .job_scheduler import job_executor
 
 
 TIMEZONE = timezone('Europe/Brussels')
@@ -24,59 +32,252 @@ PUBLIC_GRAPH = "http://mu.semte.ch/graphs/public"
 MAX_SENDING_ATTEMPTS = int(os.environ.get('MAX_SENDING_ATTEMPTS'))
 INZENDING_BASE_URL = os.environ.get('INZENDING_BASE_URL')
 PS_IN_PATH = os.environ.get('KALLIOPE_PS_IN_ENDPOINT')
+BERICHTEN_OUT_CONCURRENCY = int(os.environ.get('BERICHTEN_OUT_CONCURRENCY', 4))
+INCOMPLETE_BERICHT_RETRIES = int(os.environ.get('INCOMPLETE_BERICHT_RETRIES', 6))
+INCOMPLETE_BERICHT_RETRY_DELAY = float(os.environ.get('INCOMPLETE_BERICHT_RETRY_DELAY', 10))  # in seconds
+ENRICHMENT_BATCH_SIZE = 50
+WORK_QUEUE_BATCH_SIZE = 50
+
+berichten_out_lock = threading.Lock()
+berichten_out_queue = WorkQueue('berichten-out', MAX_SENDING_ATTEMPTS)
 
 
 def process_berichten_out():
     """
     Fetch Berichten that have to be sent to Kalliope from the triple store,
     convert them to the correct format for the Kalliope API, post them and finally mark them as sent.
+    Sweeps up all berichten that weren't sent through the berichten out queue,
+    except for those waiting for their next attempt in the queue.
 
     :returns: None
     """
-    q = construct_unsent_berichten_query(ABB_URI, MAX_SENDING_ATTEMPTS)
-    berichten = query(q)['results']['bindings']
-    log("Found {} berichten that need to be sent to the Kalliope API".format(len(berichten)))
-    if len(berichten) == 0:
-        return
     with open_kalliope_api_session() as session:
-        for bericht_res in berichten:
-            try:
-                (bericht, conversatie, bijlagen) = prepare_message_and_conversation(bericht_res)
-                poststuk_in = construct_kalliope_poststuk_in(conversatie, bericht)
-                bestuurseenheid_uuid =\
-                    bericht['van'].split('/')[-1]  # NOTE: Add graph as argument to query because Virtuoso
-                graph =\
-                    "http://mu.semte.ch/graphs/organizations/{}/LoketLB-berichtenGebruiker".format(bestuurseenheid_uuid)
-                log("Posting bericht <{}>. Payload: {}".format(bericht['uri'], poststuk_in))
-
-                post_result = send_message(session, poststuk_in, bericht, bijlagen, graph)
-                if post_result:
-                    set_message_as_sent(bericht, bijlagen, graph)
-
-            except Exception as e:
-                message = """
-                            General error while trying to send bericht {}.
-                            Error: {}
-                          """.format(bericht['uri'] if 'bericht' in locals() else "[No message defined]", e)
-                error_query =\
-                    construct_create_kalliope_sync_error_query(PUBLIC_GRAPH,
-                                                               bericht['uri'] if 'bericht' in locals() else None,
-                                                               message,
-                                                               e)
-                update_with_suppressed_fail(error_query)
-                log(message)
-    pass
-
-
-def prepare_message_and_conversation(bericht_res):
+        send_berichten_out(session)
+
+
+def enqueue_bericht_out(bericht_uri):
+    """
+    Schedule a bericht to be sent to Kalliope, as soon as possible rather than on the next cron tick.
+
+    :param bericht_uri: URI of a bericht that might have to be sent
+    :returns: None
+    """
+    berichten_out_queue.push([bericht_uri])
+
+
+def dispatch_berichten_out():
+    """
+    Send the berichten in the berichten out queue of which the next attempt is due.
+    Nothing is attempted while the Kalliope circuit is open.
+
+    :returns: None
+    """
+    if kalliope_circuit.is_open():
+        return
+    bericht_uris = berichten_out_queue.due(WORK_QUEUE_BATCH_SIZE)
+    if bericht_uris:
+        with open_kalliope_api_session() as session:
+            send_berichten_out(session, bericht_uris)
+
+
+def send_berichten_out(session, bericht_uris=None):
+    """
+    Send the unsent berichten to Kalliope and record the outcomes in the berichten out queue: a failed bericht is
+    retried with backoff, a bericht that was sent (or doesn't have to be sent anymore) leaves the queue.
+    The cron job and the queue dispatcher never send at the same time, so a bericht can't be sent twice at once.
+
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param bericht_uris: optional list of bericht URIs to restrict the berichten to
+    :returns: None
+    """
+    # Queued berichten are looked up in any organization graph, so those of an organization that isn't cached yet
+    # are found as well
+    graph_batches = [None] if bericht_uris else bestuurseenheden_cache.organization_graph_batches(BERICHTEN_GEBRUIKER)
+    with berichten_out_lock:
+        berichten = []
+        try:
+            for graph_uris in graph_batches:
+                q = construct_unsent_berichten_query(ABB_URI, MAX_SENDING_ATTEMPTS, graph_uris, bericht_uris)
+                berichten.extend(query(q)['results']['bindings'])
+        except Exception as e:
+            report_berichten_out_selection_error(bericht_uris, e)
+            return
+        berichten = select_due_berichten_out(berichten, bericht_uris)
+        if len(berichten) == 0:
+            return
+        uris = [bericht_res['bericht']['value'] for bericht_res in berichten]
+        try:
+            (origineel_bericht_uris, bijlagen) = get_berichten_enrichment(uris)
+        except Exception as e:
+            report_enrichment_error(uris, bericht_uris, e)
+            return
+
+        with job_executor(BERICHTEN_OUT_CONCURRENCY) as executor:
+            futures = [executor.submit(process_bericht_out,
+                                       session,
+                                       bericht_res,
+                                       origineel_bericht_uris.get(uri),
+                                       bijlagen.get(uri, []))
+                       for (uri, bericht_res) in zip(uris, berichten)]
+        record_berichten_out_outcomes(uris, [future.result() for future in futures])
+
+
+def select_due_berichten_out(berichten, bericht_uris):
+    """
+    Select the unsent berichten that have to be sent now, one row per bericht. The cron job leaves out those waiting
+    for their next attempt in the berichten out queue. A dispatched bericht that isn't found may not be complete
+    yet (its conversatie is often written in a later request), it's looked up again after
+    INCOMPLETE_BERICHT_RETRY_DELAY and leaves the queue after INCOMPLETE_BERICHT_RETRIES.
+
+    :param berichten: rows as returned by construct_unsent_berichten_query()
+    :param bericht_uris: the dispatched bericht URIs, None for the cron job
+    :returns: the rows of the berichten to send
+    """
+    # Rows of the same bericht would otherwise be sent concurrently
+    berichten = list({bericht_res['bericht']['value']: bericht_res for bericht_res in berichten}.values())
+    if bericht_uris is None:
+        deferred = set(berichten_out_queue.deferred([bericht_res['bericht']['value'] for bericht_res in berichten]))
+        berichten = [bericht_res for bericht_res in berichten if bericht_res['bericht']['value'] not in deferred]
+    else:
+        unsent = {bericht_res['bericht']['value'] for bericht_res in berichten}
+        berichten_out_queue.missing([bericht_uri for bericht_uri in bericht_uris if bericht_uri not in unsent],
+                                    INCOMPLETE_BERICHT_RETRY_DELAY, INCOMPLETE_BERICHT_RETRIES)
+    log("Found {} berichten that need to be sent to the Kalliope API".format(len(berichten)))
+    return berichten
+
+
+def report_berichten_out_selection_error(bericht_uris, e):
+    """
+    Report that the unsent berichten couldn't be retrieved, a dispatched run is retried with backoff.
+
+    :param bericht_uris: the dispatched bericht URIs, None for the cron job
+    """
+    message = "Something went wrong while retrieving the unsent berichten. Aborting: {}".format(e)
+    update_with_suppressed_fail(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, e))
+    log(message)
+    if bericht_uris is not None:
+        berichten_out_queue.failed(bericht_uris, e)
+
+
+def report_enrichment_error(uris, bericht_uris, e):
+    """
+    Report that the berichten of a run couldn't be enriched, a dispatched run is retried with backoff.
+
+    :param uris: the URIs of the berichten to send
+    :param bericht_uris: the dispatched bericht URIs, None for the cron job
+    """
+    message = "Something went wrong while retrieving the original berichten and bijlagen. Aborting: {}".format(e)
+    update_with_suppressed_fail(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, e))
+    log(message)
+    if bericht_uris is not None:
+        berichten_out_queue.failed(uris, e)
+
+
+def record_berichten_out_outcomes(uris, errors):
+    """
+    Record the outcomes of a run in the berichten out queue: a failed bericht is retried with backoff,
+    a bericht that was sent leaves the queue. A short-circuited bericht wasn't attempted, it stays due.
+
+    :param uris: the URIs of the berichten that were sent
+    :param errors: the results of process_bericht_out(), in the same order as uris
+    """
+    short_circuited = []
+    for (bericht_uri, error) in zip(uris, errors):
+        if error is None:
+            berichten_out_queue.succeeded([bericht_uri])
+        elif isinstance(error, CircuitOpenError):
+            short_circuited.append(error)  # Not an attempt, the bericht stays due
+        else:
+            berichten_out_queue.failed([bericht_uri], error)
+    if short_circuited:
+        e = short_circuited[-1]
+        message = "The Kalliope API is unavailable, {} berichten were not sent: {}".format(len(short_circuited), e)
+        update_with_suppressed_fail(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, e))
+        log(message)
+
+
+def get_berichten_enrichment(bericht_uris):
+    """
+    Retrieve the original bericht of the conversation and the bijlagen for a batch of berichten,
+    with a constant number of queries per ENRICHMENT_BATCH_SIZE berichten.
+
+    :param bericht_uris: list of bericht URIs
+    :returns: tuple of the form (origineel_bericht_uris, bijlagen), dicts keyed by bericht URI.
+              bijlagen contains rows as returned by construct_select_berichten_bijlagen_query()
+    """
+    origineel_bericht_uris = {}
+    bijlagen = {}
+    for i in range(0, len(bericht_uris), ENRICHMENT_BATCH_SIZE):
+        batch = bericht_uris[i:i + ENRICHMENT_BATCH_SIZE]
+        originelen = query(construct_select_original_berichten_query(batch))
+        batch_bijlagen = query(construct_select_berichten_bijlagen_query(batch))
+        collect_enrichment(originelen, batch_bijlagen, origineel_bericht_uris, bijlagen)
+    return (origineel_bericht_uris, bijlagen)
+
+
+def collect_enrichment(originelen, batch_bijlagen, origineel_bericht_uris, bijlagen):
+    """
+    Add the results of the enrichment queries of a batch to origineel_bericht_uris and bijlagen,
+    see get_berichten_enrichment().
+    """
+    # Ordered by dateSent per bericht, the first row holds the original bericht
+    for binding in originelen['results']['bindings']:
+        origineel_bericht_uris.setdefault(binding['bericht']['value'], binding['origineelbericht']['value'])
+    for binding in batch_bijlagen['results']['bindings']:
+        bijlagen.setdefault(binding['bericht']['value'], []).append(binding)
+
+
+def process_bericht_out(session, bericht_res, origineel_bericht_uri, bijlagen):
+    """
+    Convert a single bericht to the format of the Kalliope API, post it and mark it as sent.
+    Runs on one of the BERICHTEN_OUT_CONCURRENCY workers.
+
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param bericht_res: row as returned by construct_unsent_berichten_query()
+    :param origineel_bericht_uri: URI of the first bericht in the conversation
+    :param bijlagen: rows as returned by construct_select_berichten_bijlagen_query() for this bericht
+    :returns: None when the bericht was sent, the error otherwise
+    """
+    try:
+        (bericht, conversatie, bijlagen) = prepare_message_and_conversation(bericht_res, origineel_bericht_uri, bijlagen)
+        poststuk_in = construct_kalliope_poststuk_in(conversatie, bericht)
+        # NOTE: Add graph as argument to query because Virtuoso
+        graph = organization_graph(bericht['van'], BERICHTEN_GEBRUIKER)
+        log("Posting bericht <{}>. Payload: {}".format(bericht['uri'], poststuk_in))
+
+        post_result = send_message(session, poststuk_in, bericht, bijlagen, graph)
+        if post_result:
+            set_message_as_sent(bericht, bijlagen, graph)
+            return None
+        return ValueError("Kalliope didn't return a result for bericht {}".format(bericht['uri']))
+
+    except CircuitOpenError as e:
+        return e  # Reported once for the whole run
+    except Exception as e:
+        report_bericht_out_error(bericht_res, e)
+        return e
+
+
+def report_bericht_out_error(bericht_res, e):
+    bericht_uri = bericht_res['bericht']['value']
+    message = """
+                General error while trying to send bericht {}.
+                Error: {}
+              """.format(bericht_uri, e)
+    error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, bericht_uri, message, e)
+    update_with_suppressed_fail(error_query)
+    log(message)
+
+
+def prepare_message_and_conversation(bericht_res, origineel_bericht_uri, bijlagen):
     bericht = {
         'uri': bericht_res['bericht']['value'],
         'van': bericht_res['van']['value'],
         'verzonden': bericht_res['verzonden']['value'],
         'inhoud': bericht_res['inhoud']['value'],
     }
-
-    origineel_bericht_uri = get_initial_message_uri(bericht)
+    if not origineel_bericht_uri:
+        raise ValueError("No original message found in the conversation of bericht {}".format(bericht['uri']))
 
     REPLY_SUBJECT_PREFIX = "Reactie op "
     betreft = REPLY_SUBJECT_PREFIX + bericht_res['betreft']['value']
@@ -87,8 +288,6 @@ def prepare_message_and_conversation(bericht_res):
     }
     if 'dossieruri' in bericht_res:
         conversatie['dossierUri'] = bericht_res['dossieruri']['value']
-    q_bijlagen = construct_select_bijlagen_query(bericht['uri'])
-    bijlagen = query(q_bijlagen)['results']['bindings']
     bericht['bijlagen'] = []
     for bijlage_res in bijlagen:
         bijlage = {
@@ -101,23 +300,27 @@ def prepare_message_and_conversation(bericht_res):
     return bericht, conversatie, bijlagen
 
 
-def get_initial_message_uri(bericht):
-    q_origineel = construct_select_original_bericht_query(bericht['uri'])
-    return query(q_origineel)['results']['bindings'][0]['origineelbericht']['value']
-
-
 def send_message(session, poststuk_in, bericht, bijlagen, graph):
     try:
         return post_kalliope_poststuk_in(PS_IN_PATH, session, poststuk_in)
+    except CircuitOpenError as e:
+        raise e  # The bericht wasn't sent, so this isn't a failed attempt
     except Exception as e:
-        message = "Something went wrong while posting following poststuk in, skipping: {}\n{}".format(poststuk_in,
-                                                                                                      e)
-        update(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, bericht['uri'], message, e))
-        update(construct_increment_bericht_attempts_query(graph, bericht['uri']))
-        log(message)
+        report_failed_attempt(poststuk_in, bericht, graph, e)
         raise e
 
 
+def report_failed_attempt(poststuk_in, bericht, graph, e):
+    """
+    Report that posting a bericht failed and count the attempt.
+    """
+    message = "Something went wrong while posting following poststuk in, skipping: {}\n{}".format(poststuk_in,
+                                                                                                  e)
+    update(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, bericht['uri'], message, e))
+    update(construct_increment_bericht_attempts_query(graph, bericht['uri']))
+    log(message)
+
+
 def set_message_as_sent(bericht, bijlagen, graph):
     # We consider the moment when the api-call succeeded the 'ontvangen'-time
     ontvangen = datetime.now(tz=TIMEZONE).\
@@ -126,3 +329,4 @@ def set_message_as_sent(bericht, bijlagen, graph):
     update(q_sent)
     log("successfully sent bericht {} with {} bijlagen to Kalliope".format(bericht['uri'],
                                                                            len(bijlagen)))
+
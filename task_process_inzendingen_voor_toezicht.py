@@ -1,24 +1,23 @@
 import os
+import threading
 from pytz import timezone
 from datetime import datetime
 from helpers import log
 from .sudo_query_helpers import query, update
 from .kalliope_adapter import post_kalliope_inzending_in
 from .kalliope_adapter import open_kalliope_api_session
+from .kalliope_adapter import kalliope_circuit
+from .circuit_breaker import CircuitOpenError
+from .bestuurseenheden_cache import bestuurseenheden_cache
+from .bestuurseenheden_cache import organization_graph
+from .bestuurseenheden_cache import TOEZICHT_GEBRUIKER
 from .queries import construct_unsent_inzendingen_query
 from .queries import construct_increment_inzending_attempts_query
 from .queries import construct_inzending_sent_query
 from .queries import construct_create_kalliope_sync_error_query
-from .queries import verify_eb_has_active_cb_exclusion_rule
-from .queries import verify_eb_has_cb_exclusion_rule
-from .queries import verify_eb_exclusion_rule
-from .queries import verify_cb_exclusion_rule
-from .queries import verify_ro_exclusion_rule
-from .queries import verify_go_exclusion_rule
-from .queries import verify_po_exclusion_rule
-from .queries import verify_mp_exclusion_rule
-from .queries import verify_opnavb_exclusion_rule
+from .queries import construct_excluded_submissions_query
 from .update_with_supressed_fail import update_with_suppressed_fail
+from .work_queue import WorkQueue
 from dateutil import parser
 
 
@@ -29,21 +28,186 @@ INZENDING_IN_PATH = os.environ.get('KALLIOPE_PS_IN_ENDPOINT')
 MAX_SENDING_ATTEMPTS = int(os.environ.get('MAX_SENDING_ATTEMPTS'))
 INZENDING_BASE_URL = os.environ.get('INZENDING_BASE_URL')
 EREDIENSTEN_BASE_URL = os.environ.get('EREDIENSTEN_BASE_URL')
+EXCLUSION_RULES_BATCH_SIZE = 50
+WORK_QUEUE_BATCH_SIZE = 50
+
+inzendingen_lock = threading.Lock()
+inzendingen_queue = WorkQueue('inzendingen', MAX_SENDING_ATTEMPTS)
 
 
 def process_inzendingen():
     """
     Fetch submissions that have to be sent to Kalliope from the triple store,
         convert them to the correct format for the Kalliope API, post them and finally mark them as sent.
+        Sweeps up all submissions that weren't sent through the inzendingen queue,
+        except for those waiting for their next attempt in the queue.
     :returns: None
     """
-    q = construct_unsent_inzendingen_query(MAX_SENDING_ATTEMPTS)
-    inzendingen = query(q)['results']['bindings']
+    with open_kalliope_api_session() as session:
+        send_inzendingen(session)
+
+
+def enqueue_inzending(inzending_uri):
+    """
+    Schedule a submission to be sent to Kalliope, as soon as possible rather than on the next cron tick.
+
+    :param inzending_uri: URI of a submission that might have to be sent
+    :returns: None
+    """
+    inzendingen_queue.push([inzending_uri])
+
+
+def dispatch_inzendingen():
+    """
+    Send the submissions in the inzendingen queue of which the next attempt is due.
+    Nothing is attempted while the Kalliope circuit is open.
+
+    :returns: None
+    """
+    if kalliope_circuit.is_open():
+        return
+    inzending_uris = inzendingen_queue.due(WORK_QUEUE_BATCH_SIZE)
+    if inzending_uris:
+        with open_kalliope_api_session() as session:
+            send_inzendingen(session, inzending_uris)
+
+
+def send_inzendingen(session, inzending_uris=None):
+    """
+    Send the unsent submissions to Kalliope and record the outcomes in the inzendingen queue: a failed submission is
+    retried with backoff, a submission that was sent (or doesn't have to be sent anymore) leaves the queue.
+    The cron job and the queue dispatcher never send at the same time, so a submission can't be sent twice at once.
+
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param inzending_uris: optional list of submission URIs to restrict the submissions to
+    :returns: None
+    """
+    # Queued submissions are looked up in any organization graph, so those of an organization that isn't cached yet
+    # are found as well
+    graph_batches = [None] if inzending_uris else bestuurseenheden_cache.organization_graph_batches(TOEZICHT_GEBRUIKER)
+    with inzendingen_lock:
+        inzendingen = []
+        try:
+            for graph_uris in graph_batches:
+                q = construct_unsent_inzendingen_query(MAX_SENDING_ATTEMPTS, graph_uris, inzending_uris)
+                inzendingen.extend(query(q)['results']['bindings'])
+        except Exception as e:
+            report_inzendingen_selection_error(inzending_uris, inzending_uris, e)
+            return
+        inzendingen = select_due_inzendingen(inzendingen, inzending_uris)
+        try:
+            # Here we remove inzendingen that matches exclusion criteria from business rules
+            included = exclude_inzendingen_from_rules(inzendingen)
+        except Exception as e:
+            uris = [inzending['inzending']['value'] for inzending in inzendingen]
+            report_inzendingen_selection_error(uris, inzending_uris, e)
+            return
+        errors = send_unsent_inzendingen(session, included)
+        record_inzendingen_outcomes(inzendingen, errors)
+
+
+def select_due_inzendingen(inzendingen, inzending_uris):
+    """
+    Select the unsent submissions that have to be sent now. The cron job leaves out those waiting for their next
+    attempt in the inzendingen queue, the dispatched submissions that don't have to be sent anymore leave the queue.
+
+    :param inzendingen: rows as returned by construct_unsent_inzendingen_query()
+    :param inzending_uris: the dispatched submission URIs, None for the cron job
+    :returns: the rows of the submissions to send
+    """
+    if inzending_uris is None:
+        deferred = set(inzendingen_queue.deferred([inzending['inzending']['value'] for inzending in inzendingen]))
+        return [inzending for inzending in inzendingen if inzending['inzending']['value'] not in deferred]
+    unsent = {inzending['inzending']['value'] for inzending in inzendingen}
+    inzendingen_queue.succeeded([uri for uri in inzending_uris if uri not in unsent])
+    return inzendingen
+
+
+def report_inzendingen_selection_error(uris, inzending_uris, e):
+    """
+    Report that the submissions to send couldn't be selected, a dispatched run is retried with backoff.
+
+    :param uris: the URIs of the submissions that were being selected
+    :param inzending_uris: the dispatched submission URIs, None for the cron job
+    """
+    message = "Something went wrong while selecting the submissions to send. Aborting: {}".format(e)
+    update_with_suppressed_fail(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, e))
+    log(message)
+    if inzending_uris is not None:
+        inzendingen_queue.failed(list(dict.fromkeys(uris)), e)
+
+
+def record_inzendingen_outcomes(inzendingen, errors):
+    """
+    Record the outcomes of a run in the inzendingen queue: a failed submission is retried with backoff, a submission
+    that was sent (or is excluded) leaves the queue. A short-circuited submission wasn't attempted, it stays due.
+
+    :param inzendingen: rows as returned by select_due_inzendingen()
+    :param errors: as returned by send_unsent_inzendingen()
+    """
+    short_circuited = []
+    for (inzending_uri, error) in errors.items():
+        if isinstance(error, CircuitOpenError):
+            short_circuited.append(error)  # The submission stays due
+        else:
+            inzendingen_queue.failed([inzending_uri], error)
+    if short_circuited:
+        e = short_circuited[-1]
+        message = "The Kalliope API is unavailable, {} submissions were not sent: {}".format(len(short_circuited), e)
+        update_with_suppressed_fail(construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, None, message, e))
+        log(message)
+    inzendingen_queue.succeeded(list({inzending['inzending']['value'] for inzending in inzendingen
+                                      if inzending['inzending']['value'] not in errors}))
 
-    # Here we remove inzendingen that matches exclusion criteria from business rules
-    filtered_inzendingen = exclude_inzendingen_from_rules(inzendingen)
 
-    inzendingen = [parse_inzending_sparql_response(inzending_res) for inzending_res in filtered_inzendingen]
+def send_unsent_inzendingen(session, inzendingen):
+    """
+    :param session: a Kalliope session, as returned by open_kalliope_api_session()
+    :param inzendingen: rows as returned by construct_unsent_inzendingen_query(), without the excluded submissions
+    :returns: dict of the errors of the submissions that failed to be sent, keyed by submission URI
+    """
+    errors = {}
+    inzendingen = prepare_inzendingen(inzendingen)
+    if len(inzendingen) == 0:
+        return errors
+
+    for inzending in inzendingen:
+        try:
+            #  NOTE: Add graph as argument to query because Virtuoso
+            graph = organization_graph(inzending['afzenderUri'], TOEZICHT_GEBRUIKER)
+            try:
+                post_result = post_kalliope_inzending_in(INZENDING_IN_PATH, session, inzending)
+            except CircuitOpenError as e:
+                errors[inzending['uri']] = e  # Not sent, so not a failed attempt. Reported once for the whole run
+                continue
+            except Exception as e:
+                report_failed_inzending_attempt(inzending, graph, e)
+                errors[inzending['uri']] = e
+
+                continue
+
+            if post_result:
+                #  We consider the moment when the api-call succeeded the 'ontvangen'-time
+                ontvangen = datetime.now(tz=TIMEZONE).replace(microsecond=0).isoformat()
+                q_sent = construct_inzending_sent_query(graph, inzending['uri'], ontvangen)
+                update(q_sent)
+                log("successfully sent submission {} to Kalliope".format(inzending['uri']))
+            else:
+                errors[inzending['uri']] = ValueError("Kalliope didn't return a result for submission {}"
+                                                      .format(inzending['uri']))
+
+        except Exception as e:
+            report_inzending_error(inzending, e)
+            errors[inzending.get('uri')] = e
+    return errors
+
+
+def prepare_inzendingen(inzendingen):
+    """
+    :param inzendingen: rows as returned by construct_unsent_inzendingen_query()
+    :returns: the submissions to send, in the format of the Kalliope API, one per submission URI
+    """
+    inzendingen = [parse_inzending_sparql_response(inzending_res) for inzending_res in inzendingen]
 
     # Ensure the inzending to be sent are unique.
     # This is currently a workaround since there are problems in the data, and previous queries sometimes
@@ -51,51 +215,36 @@ def process_inzendingen():
     inzendingen = list({inzending['uri']: inzending for inzending in inzendingen}.values())
 
     log("Found {} submissions that need to be sent to the Kalliope API".format(len(inzendingen)))
-    if len(inzendingen) == 0:
-        return
+    return inzendingen
 
-    with open_kalliope_api_session() as session:
-        for inzending in inzendingen:
-            try:
-                #  NOTE: Add graph as argument to query because Virtuoso
-                bestuurseenheid_uuid = inzending['afzenderUri'].split('/')[-1]
-                graph = \
-                    "http://mu.semte.ch/graphs/organizations/{}/LoketLB-toezichtGebruiker".format(bestuurseenheid_uuid)
-                try:
-                    post_result = post_kalliope_inzending_in(INZENDING_IN_PATH, session, inzending)
-                except Exception as e:
-                    message = """
-                              Something went wrong while posting following inzending in, skipping: {}\n{}
-                              """.format(inzending, e)
-
-                    error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, inzending['uri'], message, e)
-                    update(error_query)
-                    attempt_query = construct_increment_inzending_attempts_query(graph, inzending['uri'])
-                    update(attempt_query)
-                    log(message)
-
-                    continue
-
-                if post_result:
-                    #  We consider the moment when the api-call succeeded the 'ontvangen'-time
-                    ontvangen = datetime.now(tz=TIMEZONE).replace(microsecond=0).isoformat()
-                    q_sent = construct_inzending_sent_query(graph, inzending['uri'], ontvangen)
-                    update(q_sent)
-                    log("successfully sent submission {} to Kalliope".format(inzending['uri']))
 
-            except Exception as e:
-                inzending_uri = inzending.get('uri')
-                message = """
-                           General error while trying to process inzending {}.
-                            Error: {}
-                          """.format(inzending_uri, e)
-                error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, inzending_uri, message, e)
-                update_with_suppressed_fail(error_query)
-                # TODO: graph here should be re-thought...
-                # attempt_query = construct_increment_inzending_attempts_query(graph, inzending_uri)
-                # update_with_suppressed_fail(attempt_query)
-                log(message)
-    pass
+def report_failed_inzending_attempt(inzending, graph, e):
+    """
+    Report that posting a submission failed and count the attempt.
+    """
+    message = """
+              Something went wrong while posting following inzending in, skipping: {}\n{}
+              """.format(inzending, e)
+
+    error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, inzending['uri'], message, e)
+    update(error_query)
+    attempt_query = construct_increment_inzending_attempts_query(graph, inzending['uri'])
+    update(attempt_query)
+    log(message)
+
+
+def report_inzending_error(inzending, e):
+    inzending_uri = inzending.get('uri')
+    message = """
+               General error while trying to process inzending {}.
+                Error: {}
+              """.format(inzending_uri, e)
+    error_query = construct_create_kalliope_sync_error_query(PUBLIC_GRAPH, inzending_uri, message, e)
+    update_with_suppressed_fail(error_query)
+    # TODO: graph here should be re-thought...
+    # attempt_query = construct_increment_inzending_attempts_query(graph, inzending_uri)
+    # update_with_suppressed_fail(attempt_query)
+    log(message)
 
 def determine_url(inzending_res):
     """
@@ -175,28 +324,34 @@ def parse_inzending_sparql_response(inzending_res):
 
 def exclude_inzendingen_from_rules(inzendingen):
     """
-    This takes an individual submission to run ASK queries to check if it matches the pattern from business rules (a submission's formData who has a specific decisionType and sender needs to be excluded when they match a certain criteria in the list);
+    This checks the submissions against the patterns from business rules (a submission's formData who has a specific decisionType and sender needs to be excluded when they match a certain criteria in the list);
     It will then sort them out from the inzendingen.
+    The rules are evaluated in bulk, for EXCLUSION_RULES_BATCH_SIZE submissions per query.
     see: Leesrechtenlogica Databank Erediensten
     """
-    filtered_inzendingen = []
-
-    for inzending in inzendingen:
+    excluded_submissions = set()
+    for q in excluded_submissions_queries(inzendingen):
+        excluded_submissions.update(binding['submission']['value'] for binding in query(q)['results']['bindings'])
+    return without_excluded_submissions(inzendingen, excluded_submissions)
 
-        submission = inzending['inzending']['value']
 
-        eb_has_cb = query(verify_eb_has_cb_exclusion_rule(submission))['boolean']
-        eb_has_active_cb = query(verify_eb_has_active_cb_exclusion_rule(submission))['boolean']
-        eb = query(verify_eb_exclusion_rule(submission))['boolean']
-        cb = query(verify_cb_exclusion_rule(submission))['boolean']
-        ro = query(verify_ro_exclusion_rule(submission))['boolean']
-        go = query(verify_go_exclusion_rule(submission))['boolean']
-        po = query(verify_po_exclusion_rule(submission))['boolean']
-        mp = query(verify_mp_exclusion_rule(submission))['boolean'] 
-        opnavb = query(verify_opnavb_exclusion_rule(submission))['boolean'] 
+def excluded_submissions_queries(inzendingen):
+    """
+    :param inzendingen: rows as returned by construct_unsent_inzendingen_query()
+    :returns: the queries selecting the excluded submissions, one per EXCLUSION_RULES_BATCH_SIZE submissions
+    """
+    submissions = list(dict.fromkeys(inzending['inzending']['value'] for inzending in inzendingen))
+    return [construct_excluded_submissions_query(submissions[i:i + EXCLUSION_RULES_BATCH_SIZE])
+            for i in range(0, len(submissions), EXCLUSION_RULES_BATCH_SIZE)]
 
-        if not (eb_has_cb or eb_has_active_cb or eb or cb or ro or go or po or mp or opnavb):
-            filtered_inzendingen.append(inzending)
 
-    return filtered_inzendingen
+def without_excluded_submissions(inzendingen, excluded_submissions):
+    """
+    :param inzendingen: rows as returned by construct_unsent_inzendingen_query()
+    :param excluded_submissions: set of the URIs of the submissions that match an exclusion rule
+    :returns: the rows of the submissions that don't match an exclusion rule
+    """
+    submissions = set(inzending['inzending']['value'] for inzending in inzendingen)
+    log("{} of {} submissions match an exclusion rule".format(len(excluded_submissions), len(submissions)))
+    return [inzending for inzending in inzendingen if inzending['inzending']['value'] not in excluded_submissions]
 
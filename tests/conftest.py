@@ -0,0 +1,28 @@
+import os
+import sys
+import types
+
+import pytest
+
+# The service modules use relative imports, they're loaded as a package the way the mu-python-template does.
+# helpers and escape_helpers are provided by the template.
+SERVICE_PACKAGE = "service"
+SERVICE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if SERVICE_PACKAGE not in sys.modules:
+    package = types.ModuleType(SERVICE_PACKAGE)
+    package.__path__ = [SERVICE_PATH]
+    sys.modules[SERVICE_PACKAGE] = package
+
+
+@pytest.fixture
+def queue_db(tmp_path, monkeypatch):
+    """
+    Keep the work queues in a fresh SQLite database.
+    """
+    from service import work_queue
+    monkeypatch.setattr(work_queue, 'WORK_QUEUE_DB_PATH', str(tmp_path / 'work-queue.sqlite'))
+    monkeypatch.setattr(work_queue, 'db', None)
+    yield
+    if work_queue.db is not None:
+        work_queue.db.close()
@@ -0,0 +1,27 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("magic")
+pytest.importorskip("requests")
+
+from service import bijlagen_store
+from service.bijlagen_store import remove_stale_downloads
+
+
+def touch(path, age):
+    with open(path, 'wb') as f:
+        f.write(b'%PDF')
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def test_only_stale_downloads_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(bijlagen_store, 'BIJLAGEN_FOLDER_PATH', str(tmp_path))
+    monkeypatch.setattr(bijlagen_store, 'STALE_DOWNLOAD_MAX_AGE', 24)
+    touch(tmp_path / ".download-stale", 25 * 3600)
+    touch(tmp_path / ".download-busy", 60)
+    touch(tmp_path / "1234.pdf", 25 * 3600)
+    assert remove_stale_downloads() == 1
+    assert sorted(os.listdir(tmp_path)) == [".download-busy", "1234.pdf"]
@@ -0,0 +1,83 @@
+import pytest
+
+pytest.importorskip("requests")
+
+from service import circuit_breaker
+from service.circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker, 'time', clock)
+    return clock
+
+
+def test_the_circuit_opens_after_the_failure_threshold(clock):
+    circuit = CircuitBreaker('Kalliope API', 3, 60)
+    for _ in range(2):
+        circuit.before_request()
+        circuit.record_failure()
+    assert circuit.state == CLOSED
+    circuit.record_failure()
+    assert circuit.state == OPEN
+    assert circuit.is_open()
+    with pytest.raises(CircuitOpenError):
+        circuit.before_request()
+
+
+def test_a_success_resets_the_consecutive_failures(clock):
+    circuit = CircuitBreaker('Kalliope API', 3, 60)
+    circuit.record_failure()
+    circuit.record_failure()
+    circuit.record_success()
+    circuit.record_failure()
+    circuit.record_failure()
+    assert circuit.state == CLOSED
+
+
+def test_a_succeeding_probe_closes_the_circuit(clock):
+    circuit = CircuitBreaker('Kalliope API', 1, 60)
+    circuit.record_failure()
+    clock.now += 60
+    assert not circuit.is_open()
+    circuit.before_request()
+    assert circuit.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):  # A single probe at a time
+        circuit.before_request()
+    circuit.record_success()
+    assert circuit.state == CLOSED
+    circuit.before_request()
+
+
+def test_a_failing_probe_keeps_the_circuit_open_for_another_reset_timeout(clock):
+    circuit = CircuitBreaker('Kalliope API', 1, 60)
+    circuit.record_failure()
+    clock.now += 60
+    circuit.before_request()
+    circuit.record_failure()
+    assert circuit.state == OPEN
+    clock.now += 59
+    with pytest.raises(CircuitOpenError):
+        circuit.before_request()
+    clock.now += 1
+    circuit.before_request()
+    assert circuit.state == HALF_OPEN
+
+
+def test_a_probe_that_never_reports_back_is_replaced(clock):
+    circuit = CircuitBreaker('Kalliope API', 1, 60)
+    circuit.record_failure()
+    clock.now += 60
+    circuit.before_request()
+    clock.now += 60
+    circuit.before_request()
+    assert circuit.state == HALF_OPEN
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("pytz")
+
+os.environ.setdefault('MAX_SENDING_ATTEMPTS', '3')
+
+from service import task_process_berichten_out
+from service.delta_notifications import extract_outbound_subjects
+from service.task_process_berichten_out import berichten_out_queue, enqueue_bericht_out, select_due_berichten_out
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+SCHEMA = "http://schema.org/"
+BERICHT = "http://data.lblod.info/id/berichten/1"
+CONVERSATIE = "http://data.lblod.info/id/conversaties/1"
+
+pytestmark = pytest.mark.usefixtures('queue_db')
+
+
+def triple(subject, predicate, obj, obj_type='uri'):
+    return {'subject': {'type': 'uri', 'value': subject},
+            'predicate': {'type': 'uri', 'value': predicate},
+            'object': {'type': obj_type, 'value': obj}}
+
+
+def receive_delta(changesets):
+    (bericht_uris, _) = extract_outbound_subjects(changesets)
+    for bericht_uri in bericht_uris:
+        enqueue_bericht_out(bericht_uri)
+
+
+def dispatch(unsent_berichten):
+    """
+    What a dispatcher run selects, given the rows the unsent berichten query returns.
+    """
+    return select_due_berichten_out(unsent_berichten, berichten_out_queue.due(50))
+
+
+def test_a_bericht_linked_to_its_conversatie_later_is_sent_on_the_second_delta():
+    receive_delta([{'inserts': [triple(BERICHT, RDF_TYPE, SCHEMA + "Message"),
+                                triple(BERICHT, SCHEMA + "text", "Antwoord", 'literal')],
+                    'deletes': []}])
+    assert dispatch([]) == []  # Not part of a conversatie yet, the unsent berichten query doesn't find it
+    assert berichten_out_queue.stats()['pending'] == 1
+    assert berichten_out_queue.due(50) == []
+
+    receive_delta([{'inserts': [triple(CONVERSATIE, SCHEMA + "hasPart", BERICHT)], 'deletes': []}])
+    row = {'bericht': {'type': 'uri', 'value': BERICHT}}
+    assert dispatch([row]) == [row]
+
+
+def test_a_bericht_that_is_never_found_leaves_the_queue(monkeypatch):
+    monkeypatch.setattr(task_process_berichten_out, 'INCOMPLETE_BERICHT_RETRY_DELAY', 0)
+    receive_delta([{'inserts': [triple(BERICHT, RDF_TYPE, SCHEMA + "Message")], 'deletes': []}])
+    for _ in range(task_process_berichten_out.INCOMPLETE_BERICHT_RETRIES):
+        assert berichten_out_queue.stats()['pending'] == 1
+        assert dispatch([]) == []
+    assert berichten_out_queue.stats()['pending'] == 0
@@ -0,0 +1,122 @@
+import pytest
+
+from service import queries
+
+rdflib = pytest.importorskip("rdflib")
+
+SENT = "http://lblod.data.gift/concepts/9bd8d86d-bb10-4456-a84e-91e9507c374c"
+ACTIVE = "http://lblod.data.gift/concepts/63cc561de9188d64ba5840a42ae8f0d6"
+CLASSIFICATIE = "http://data.vlaanderen.be/id/concept/BestuurseenheidClassificatieCode/"
+GEMEENTE = CLASSIFICATIE + "5ab0e9b8a3b2ca7c5e000001"
+PROVINCIE = CLASSIFICATIE + "5ab0e9b8a3b2ca7c5e000000"
+EREDIENST = CLASSIFICATIE + "66ec74fd-8cfc-4e16-99c6-350b35012e86"
+OCMW = CLASSIFICATIE + "5ab0e9b8a3b2ca7c5e000002"
+
+GECOORDINEERDE_INZENDING = "https://data.vlaanderen.be/id/concept/BesluitDocumentType/2c9ada23-1229-4c7e-a53e-acddc9014e4e"
+JAARREKENING = "https://data.vlaanderen.be/id/concept/BesluitType/e44c535d-4339-4d15-bdbf-d4be6046de2c"
+MEERJARENPLAN = "https://data.vlaanderen.be/id/concept/BesluitType/f56c645d-b8e1-4066-813d-e213f5bc529f"
+BUDGET_RO = "https://data.vlaanderen.be/id/concept/BesluitDocumentType/18833df2-8c9e-4edd-87fd-b5c252337349"
+ADVIES_BUDGET = "https://data.vlaanderen.be/id/concept/BesluitType/2b12630f-8c4e-40a4-8a61-a0c45621a1e6"
+BESLUIT_BUDGET = "https://data.vlaanderen.be/id/concept/BesluitType/df261490-cc74-4f80-b783-41c35e720b46"
+BEROEPSPROCEDURE = "https://data.vlaanderen.be/id/concept/BesluitDocumentType/802a7e56-54f8-488d-b489-4816321fb9ae"
+NOTULEN = "https://data.vlaanderen.be/id/concept/BesluitDocumentType/8e791b27-7600-4577-b24e-c7c29e0eb773"
+
+ERE = "http://data.lblod.info/vocabularies/erediensten/"
+BESTUUR = "http://data.lblod.info/id/bestuurseenheden/"
+SUBMISSION = "http://data.lblod.info/submissions/"
+
+FIXTURE = """
+    @prefix ere: <{ere}> .
+    @prefix org: <http://www.w3.org/ns/org#> .
+    @prefix regorg: <http://www.w3.org/ns/regorg#> .
+    @prefix besluit: <http://data.vlaanderen.be/ns/besluit#> .
+
+    <{bestuur}eb-with-cb> a ere:BestuurVanDeEredienst ; besluit:classificatie <{eredienst}> .
+    <{bestuur}eb-with-active-cb> a ere:BestuurVanDeEredienst ; besluit:classificatie <{eredienst}> .
+    <{bestuur}eb-alone> a ere:BestuurVanDeEredienst ; besluit:classificatie <{eredienst}> .
+    <{bestuur}cb> a ere:CentraalBestuurVanDeEredienst ; org:hasSubOrganization <{bestuur}eb-with-cb> .
+    <{bestuur}active-cb> a ere:CentraalBestuurVanDeEredienst ;
+        org:hasSubOrganization <{bestuur}eb-with-active-cb> ;
+        regorg:orgStatus <{active}> .
+    <{bestuur}ro> a ere:RepresentatiefOrgaan .
+    <{bestuur}gemeente> besluit:classificatie <{gemeente}> .
+    <{bestuur}provincie> besluit:classificatie <{provincie}> .
+    <{bestuur}ocmw> besluit:classificatie <{ocmw}> .
+""".format(ere=ERE, bestuur=BESTUUR, active=ACTIVE, eredienst=EREDIENST, gemeente=GEMEENTE,
+           provincie=PROVINCIE, ocmw=OCMW)
+
+# submission id: (sender, decision type, sent, expected to be excluded)
+SUBMISSIONS = {
+    "eb-has-cb": ("eb-with-cb", GECOORDINEERDE_INZENDING, True, True),
+    "eb-without-cb": ("eb-alone", GECOORDINEERDE_INZENDING, True, False),
+    "eb-has-active-cb": ("eb-with-active-cb", JAARREKENING, True, True),
+    "eb-has-inactive-cb": ("eb-with-cb", JAARREKENING, True, False),
+    "eb-meerjarenplan": ("eb-alone", MEERJARENPLAN, True, True),
+    "cb-budget": ("cb", BUDGET_RO, True, True),
+    "ro-advies": ("ro", ADVIES_BUDGET, True, True),
+    "ro-budget": ("ro", BUDGET_RO, True, False),
+    "gemeente-besluit": ("gemeente", BESLUIT_BUDGET, True, True),
+    "provincie-besluit": ("provincie", BESLUIT_BUDGET, True, True),
+    "ocmw-besluit": ("ocmw", BESLUIT_BUDGET, True, False),
+    "gemeente-beroep": ("gemeente", BEROEPSPROCEDURE, True, True),
+    "ocmw-beroep": ("ocmw", BEROEPSPROCEDURE, True, False),
+    "gemeente-notulen": ("gemeente", NOTULEN, True, False),
+    "not-sent": ("eb-alone", MEERJARENPLAN, False, False),
+}
+
+VERIFY_FUNCTIONS = [
+    queries.verify_eb_has_cb_exclusion_rule,
+    queries.verify_eb_has_active_cb_exclusion_rule,
+    queries.verify_eb_exclusion_rule,
+    queries.verify_cb_exclusion_rule,
+    queries.verify_ro_exclusion_rule,
+    queries.verify_go_exclusion_rule,
+    queries.verify_po_exclusion_rule,
+    queries.verify_mp_exclusion_rule,
+    queries.verify_opnavb_exclusion_rule,
+]
+
+
+@pytest.fixture(scope="module")
+def store():
+    graph = rdflib.Graph()
+    graph.parse(data=FIXTURE, format="turtle")
+    ns = {prefix: rdflib.Namespace(uri) for (prefix, uri) in [
+        ("meb", "http://rdf.myexperiment.org/ontologies/base/"),
+        ("adms", "http://www.w3.org/ns/adms#"),
+        ("prov", "http://www.w3.org/ns/prov#"),
+        ("pav", "http://purl.org/pav/"),
+        ("dct", "http://purl.org/dc/terms/"),
+    ]}
+    for (submission_id, (sender, decision_type, sent, _)) in SUBMISSIONS.items():
+        submission = rdflib.URIRef(SUBMISSION + submission_id)
+        form_data = rdflib.URIRef(SUBMISSION + submission_id + "/form-data")
+        graph.add((submission, rdflib.RDF.type, ns["meb"].Submission))
+        if sent:
+            graph.add((submission, ns["adms"].status, rdflib.URIRef(SENT)))
+        graph.add((submission, ns["prov"].generated, form_data))
+        graph.add((submission, ns["pav"].createdBy, rdflib.URIRef(BESTUUR + sender)))
+        graph.add((form_data, ns["dct"].type, rdflib.URIRef(decision_type)))
+    return graph
+
+
+def test_both_query_forms_are_built_from_the_exclusion_rules():
+    submission = SUBMISSION + "eb-has-cb"
+    bulk_query = queries.construct_excluded_submissions_query([submission])
+    assert len(VERIFY_FUNCTIONS) == len(queries.EXCLUSION_RULES)
+    for (verify, rule) in zip(VERIFY_FUNCTIONS, queries.EXCLUSION_RULES):
+        assert verify(submission) == queries.construct_exclusion_rule_ask_query(submission, rule)
+        assert rule in bulk_query
+    assert bulk_query.count("UNION") == len(queries.EXCLUSION_RULES) - 1
+
+
+def test_bulk_query_selects_the_submissions_matched_by_the_ask_queries(store):
+    submissions = [SUBMISSION + submission_id for submission_id in SUBMISSIONS]
+
+    asked = {submission for submission in submissions
+             if any(store.query(verify(submission)).askAnswer for verify in VERIFY_FUNCTIONS)}
+    selected = {str(row.submission) for row in store.query(queries.construct_excluded_submissions_query(submissions))}
+
+    expected = {SUBMISSION + submission_id for (submission_id, (_, _, _, excluded)) in SUBMISSIONS.items() if excluded}
+    assert asked == expected
+    assert selected == asked
@@ -0,0 +1,66 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip("requests")
+
+from service import kalliope_adapter
+from service.circuit_breaker import CircuitBreaker
+from service.page_sizer import PageSizer
+
+PAGE_TIMEOUT = 0.2  # in seconds
+SLOW_PAGE_SIZE = 100  # pages of at least this size take longer than PAGE_TIMEOUT
+
+
+class SlowPagesHandler(BaseHTTPRequestHandler):
+    requested_sizes = []
+
+    def do_GET(self):
+        size = int(parse_qs(urlparse(self.path).query)['aantal'][0])
+        self.requested_sizes.append(size)
+        if size >= SLOW_PAGE_SIZE:
+            time.sleep(PAGE_TIMEOUT * 5)
+        body = json.dumps({'poststukken': [], 'volgende': None}).encode()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:  # The client gave up on the page
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def kalliope_url():
+    SlowPagesHandler.requested_sizes = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowPagesHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}/api/poststuk-uit".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_a_timed_out_page_shrinks_the_page_size(kalliope_url, monkeypatch):
+    page_sizer = PageSizer(10, 200, 10)
+    monkeypatch.setattr(kalliope_adapter, 'page_sizer', page_sizer)
+    monkeypatch.setattr(kalliope_adapter, 'kalliope_circuit', CircuitBreaker('Kalliope API', 5, 120))
+    monkeypatch.setattr(kalliope_adapter, 'KALLIOPE_PAGE_TIMEOUT', PAGE_TIMEOUT)
+    session = kalliope_adapter.new_kalliope_api_session(False)
+
+    (poststukken, volgende, size) = kalliope_adapter.get_kalliope_poststukken_uit_page(
+        kalliope_url + "?vanaf=2024-03-01T00%3A00%3A00%2B01%3A00", session)
+
+    assert (poststukken, volgende) == ([], None)
+    assert SlowPagesHandler.requested_sizes == [200, 100, 50]
+    assert size == 50
+    assert [page['failed'] for page in page_sizer.stats()['pages']] == [True, True, False]
+    assert page_sizer.size() < 200
@@ -0,0 +1,92 @@
+import pytest
+
+from service import rate_limiter
+from service.rate_limiter import RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter, 'time', clock)
+    return clock
+
+
+def acquire_times(limiter, clock, endpoints):
+    """
+    :returns: the time (relative to the start) at which each request to the endpoints could be sent
+    """
+    started_at = clock.now
+    times = []
+    for endpoint in endpoints:
+        limiter.acquire(endpoint)
+        times.append(clock.now - started_at)
+    return times
+
+
+def at(*times):
+    return pytest.approx(list(times), abs=2 * rate_limiter.MIN_POLL_INTERVAL)
+
+
+def test_jobs_sharing_a_bucket_are_granted_in_turns(clock):
+    limiter = RateLimiter('Kalliope API', 0, {'bijlagen': 1})
+    bucket = limiter.bucket('bijlagen')
+    tickets = [limiter.enqueue(bucket, job) for job in ['busy', 'busy', 'busy', 'other', 'other']]
+    granted = []
+    for _ in range(len(tickets)):
+        for ticket in tickets:
+            if not ticket.granted:
+                limiter.poll(bucket, ticket)  # A poll grants whichever ticket is next
+        granted += [ticket for ticket in tickets if ticket.granted and ticket not in granted]
+        clock.now += 1
+    granted = [ticket.job for ticket in granted]
+    assert granted == ['busy', 'other', 'busy', 'other', 'busy']
+
+
+def test_the_rate_of_an_endpoint_applies(clock):
+    limiter = RateLimiter('Kalliope API', 0, {'poststuk-in': 2})
+    assert acquire_times(limiter, clock, ['poststuk-in'] * 3) == at(0, 0.5, 1)
+    assert acquire_times(limiter, clock, ['bijlagen'] * 3) == at(0, 0, 0)
+
+
+def test_the_host_rate_applies_over_all_endpoints(clock):
+    limiter = RateLimiter('Kalliope API', 4)
+    assert acquire_times(limiter, clock, ['poststuk-in', 'bijlagen', 'confirmations']) == at(0, 0.25, 0.5)
+
+
+def test_a_request_waits_for_its_endpoint_then_for_the_host(clock):
+    limiter = RateLimiter('Kalliope API', 4, {'poststuk-in': 1})
+    assert acquire_times(limiter, clock, ['poststuk-in', 'poststuk-in', 'bijlagen']) == at(0, 1, 1.25)
+    stats = limiter.stats()
+    assert stats['host']['requests'] == 3
+    assert stats['endpoints']['poststuk-in']['requests'] == 2
+
+
+def test_a_pause_blocks_the_endpoint_then_resumes_without_a_burst(clock):
+    limiter = RateLimiter('Kalliope API', 0, {'poststuk-in': 10}, burst=5)
+    limiter.pause('poststuk-in', 2)
+    assert acquire_times(limiter, clock, ['bijlagen']) == at(0)
+    assert acquire_times(limiter, clock, ['poststuk-in'] * 3) == at(2.1, 2.2, 2.3)
+
+
+def test_a_pause_applies_to_an_endpoint_without_a_rate(clock):
+    limiter = RateLimiter('Kalliope API', 0)
+    limiter.pause('confirmations', 3)
+    assert acquire_times(limiter, clock, ['confirmations', 'confirmations']) == at(3, 3)
+
+
+def test_a_shorter_pause_doesnt_shorten_the_current_one(clock):
+    limiter = RateLimiter('Kalliope API', 0)
+    limiter.pause('confirmations', 3)
+    limiter.pause('confirmations', 1)
+    assert acquire_times(limiter, clock, ['confirmations']) == at(3)
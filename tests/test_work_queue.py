@@ -0,0 +1,75 @@
+import pytest
+
+from service import work_queue
+from service.work_queue import WorkQueue
+
+BACKOFF_BASE = 60
+BACKOFF_MAX = 600
+
+pytestmark = pytest.mark.usefixtures('queue_db')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(work_queue, 'time', clock)
+    monkeypatch.setattr(work_queue, 'WORK_QUEUE_BACKOFF_BASE', BACKOFF_BASE)
+    monkeypatch.setattr(work_queue, 'WORK_QUEUE_BACKOFF_MAX', BACKOFF_MAX)
+    return clock
+
+
+def test_the_backoff_doubles_up_to_the_maximum_with_jitter(clock):
+    for attempts in range(1, 10):
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+        assert delay / 2 <= work_queue.backoff(attempts) <= delay
+
+
+def test_a_failed_item_is_retried_after_its_backoff(clock):
+    queue = WorkQueue('test', 3)
+    queue.push(['a', 'b'])
+    assert queue.due(10) == ['a', 'b']
+    queue.failed(['a'], ValueError("boom"))
+    assert queue.due(10) == ['b']
+    assert queue.deferred(['a', 'b']) == ['a']
+    clock.now += BACKOFF_BASE / 2 - 1
+    assert queue.due(10) == ['b']
+    clock.now += BACKOFF_BASE / 2 + 1
+    assert queue.due(10) == ['b', 'a']  # The longest waiting first
+
+
+def test_an_item_is_dead_lettered_at_max_attempts(clock):
+    queue = WorkQueue('test', 3)
+    queue.push(['a'])
+    for attempt in range(3):
+        assert queue.dead_letters() == []
+        queue.failed(['a'], ValueError("attempt {}".format(attempt + 1)))
+        clock.now += BACKOFF_MAX
+    assert queue.due(10) == []
+    assert queue.dead_letters() == [{'item': 'a', 'attempts': 3, 'last-error': "attempt 3"}]
+    assert queue.deferred(['a']) == ['a']
+    assert queue.deferred(['a'], include_dead=False) == []
+    assert queue.stats() == {'pending': 0, 'due': 0, 'dead': 1}
+
+
+def test_a_succeeded_item_leaves_the_queue(clock):
+    queue = WorkQueue('test', 3)
+    queue.push(['a'])
+    queue.failed(['a'])
+    queue.succeeded(['a'])
+    assert queue.stats() == {'pending': 0, 'due': 0, 'dead': 0}
+
+
+def test_pushing_a_queued_item_keeps_its_schedule(clock):
+    queue = WorkQueue('test', 3)
+    queue.push(['a'])
+    queue.failed(['a'])
+    queue.push(['a'])
+    assert queue.due(10) == []
@@ -1,34 +1,158 @@
 import os
-from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from dateutil import parser
+from flask import jsonify, request
 from helpers import log
-from .task_process_inzendingen_voor_toezicht import process_inzendingen
-from .task_process_berichten_in import process_berichten_in
+from .job_scheduler import JobScheduler
+from .kalliope_adapter import page_sizer, kalliope_rate_limiter
+from .delta_notifications import extract_outbound_subjects
+from .task_process_inzendingen_voor_toezicht import process_inzendingen, enqueue_inzending
+from .task_process_inzendingen_voor_toezicht import dispatch_inzendingen, inzendingen_queue
+from .task_process_berichten_in import process_berichten_in, TIMEZONE
+from .task_backfill_berichten_in import create_backfill, start_backfill, backfill_status, BACKFILL_WINDOW
 from .task_process_berichten_in_confirmation import process_confirmations
-from .task_process_berichten_out import process_berichten_out
+from .task_process_berichten_in_confirmation import dispatch_confirmations, confirmations_queue
+from .task_process_berichten_out import process_berichten_out, enqueue_bericht_out
+from .task_process_berichten_out import dispatch_berichten_out, berichten_out_queue
+from .async_tasks import async_process_inzendingen, async_process_berichten_in
+from .async_tasks import async_process_berichten_out, async_process_confirmations
+from .async_tasks import async_dispatch_berichten_out, async_dispatch_inzendingen, async_dispatch_confirmations
+from .event_loop import in_event_loop
 
 BERICHTEN_CRON_PATTERN = os.environ.get('BERICHTEN_CRON_PATTERN')
 INZENDINGEN_CRON_PATTERN = os.environ.get('INZENDINGEN_CRON_PATTERN')
 BERICHTEN_IN_CONFIRMATION_CRON_PATTERN = os.environ.get('BERICHTEN_IN_CONFIRMATION_CRON_PATTERN')
+WORK_QUEUE_POLL_INTERVAL = float(os.environ.get('WORK_QUEUE_POLL_INTERVAL', 5))  # in seconds
+ASYNC_TASKS = os.environ.get('ASYNC_TASKS', 'false').lower() == 'true'
 
-scheduler = BackgroundScheduler()
+WORK_QUEUES = [berichten_out_queue, inzendingen_queue, confirmations_queue]
 
-scheduler.add_job(process_inzendingen, CronTrigger.from_crontab(INZENDINGEN_CRON_PATTERN))
+# Job name -> (function, async counterpart). The name is the same in both modes, e.g. for GET /jobs.
+JOBS = {
+    'process_inzendingen': (process_inzendingen, async_process_inzendingen),
+    'process_berichten_in': (process_berichten_in, async_process_berichten_in),
+    'process_berichten_out': (process_berichten_out, async_process_berichten_out),
+    'process_confirmations': (process_confirmations, async_process_confirmations),
+    'dispatch_berichten_out': (dispatch_berichten_out, async_dispatch_berichten_out),
+    'dispatch_inzendingen': (dispatch_inzendingen, async_dispatch_inzendingen),
+    'dispatch_confirmations': (dispatch_confirmations, async_dispatch_confirmations),
+}
+
+if ASYNC_TASKS:
+    # The jobs wait on Kalliope and the triple store on a single event loop instead of on threads
+    log("Running the jobs as async tasks")
+
+# Every job runs on its own executor: a slow run of one job can't delay the others,
+# and a job that is still busy when it's due again skips that tick instead of running twice.
+scheduler = JobScheduler()
+
+
+def schedule(name, trigger):
+    (func, coroutine_function) = JOBS[name]
+    scheduler.add_job(in_event_loop(coroutine_function) if ASYNC_TASKS else func, trigger, name=name)
+
+
+schedule('process_inzendingen', CronTrigger.from_crontab(INZENDINGEN_CRON_PATTERN))
 log("Registered a task for fetching and processing inzendingen to Kalliope following pattern {}"
     .format(INZENDINGEN_CRON_PATTERN))
 
-scheduler.add_job(process_berichten_in, CronTrigger.from_crontab(BERICHTEN_CRON_PATTERN))
+schedule('process_berichten_in', CronTrigger.from_crontab(BERICHTEN_CRON_PATTERN))
 log("Registered a task for fetching and processing messages from Kalliope following pattern {}"
     .format(BERICHTEN_CRON_PATTERN))
 
-scheduler.add_job(process_berichten_out, CronTrigger.from_crontab(BERICHTEN_CRON_PATTERN))
+schedule('process_berichten_out', CronTrigger.from_crontab(BERICHTEN_CRON_PATTERN))
 log("Registered a task for fetching and processing messages to Kalliope following pattern {}"
     .format(BERICHTEN_CRON_PATTERN))
 
-scheduler.add_job(process_confirmations, CronTrigger.from_crontab(BERICHTEN_IN_CONFIRMATION_CRON_PATTERN))
+schedule('process_confirmations', CronTrigger.from_crontab(BERICHTEN_IN_CONFIRMATION_CRON_PATTERN))
 log("Registered a task for fetching and processing messages to Kalliope following pattern {}"
     .format(BERICHTEN_IN_CONFIRMATION_CRON_PATTERN))
 
+# The dispatchers only send the queued items of which the next attempt is due
+for dispatch in ['dispatch_berichten_out', 'dispatch_inzendingen', 'dispatch_confirmations']:
+    schedule(dispatch, IntervalTrigger(seconds=WORK_QUEUE_POLL_INTERVAL))
+log("Registered the work queue dispatchers, polling every {} seconds".format(WORK_QUEUE_POLL_INTERVAL))
+
 # Note : while running this service in development mode, you might notice that the jobs are executed twice
 # It's related to the debug mode of Flask, which does not apply to the built version.
 scheduler.start()
+
+
+@app.route('/jobs', methods=['GET'])
+def get_jobs():
+    """
+    Run statistics (number of runs, skipped ticks, durations) of the scheduled jobs.
+    """
+    return jsonify(scheduler.job_stats())
+
+
+@app.route('/work-queues', methods=['GET'])
+def get_work_queues():
+    """
+    Number of pending, due and dead-lettered items per work queue, with the dead-lettered items.
+    """
+    return jsonify({work_queue.name: dict(work_queue.stats(), **{'dead-letters': work_queue.dead_letters()})
+                    for work_queue in WORK_QUEUES})
+
+
+@app.route('/kalliope-stats', methods=['GET'])
+def get_kalliope_stats():
+    """
+    Current page size of the Kalliope list calls, with the size and latency of the most recent pages,
+    and the rate limits of the host and per endpoint with the time spent waiting for them per job.
+    """
+    return jsonify({'pages': page_sizer.stats(), 'rate-limits': kalliope_rate_limiter.stats()})
+
+
+@app.route('/delta', methods=['POST'])
+def delta():
+    """
+    Receive delta notifications: berichten and inzendingen that might have to be sent are queued to be sent right away.
+    The cron jobs keep sweeping up everything that wasn't sent through the queues.
+    """
+    (bericht_uris, inzending_uris) = extract_outbound_subjects(request.get_json(force=True) or [])
+    for bericht_uri in bericht_uris:
+        enqueue_bericht_out(bericht_uri)
+    for inzending_uri in inzending_uris:
+        enqueue_inzending(inzending_uri)
+    log("Queued {} berichten and {} inzendingen from a delta notification".format(len(bericht_uris),
+                                                                                 len(inzending_uris)))
+    return '', 204
+
+
+@app.route('/backfills', methods=['POST'])
+def post_backfill():
+    """
+    Start a backfill of the poststukken uit made available between 'vanaf' and 'tot' (ISO 8601, Europe/Brussels if
+    no offset is given), imported in parallel time windows of 'windowHours' (optional).
+    """
+    body = request.get_json(force=True) or {}
+    try:
+        (vanaf, tot) = [parser.isoparse(body[key]) for key in ('vanaf', 'tot')]
+        (vanaf, tot) = [TIMEZONE.localize(t) if t.tzinfo is None else t for t in (vanaf, tot)]
+        backfill_id = create_backfill(vanaf, tot, float(body.get('windowHours', BACKFILL_WINDOW)))
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': "A backfill needs a valid 'vanaf', 'tot' and 'windowHours': {}".format(e)}), 400
+    start_backfill(backfill_id)
+    return jsonify(backfill_status(backfill_id)), 202
+
+
+@app.route('/backfills/<backfill_id>', methods=['GET'])
+def get_backfill(backfill_id):
+    status = backfill_status(backfill_id)
+    if status is None:
+        return jsonify({'error': "Backfill {} not found".format(backfill_id)}), 404
+    return jsonify(status)
+
+
+@app.route('/backfills/<backfill_id>/resume', methods=['POST'])
+def resume_backfill(backfill_id):
+    """
+    Resume an interrupted backfill: the windows that aren't done yet are imported again.
+    """
+    if backfill_status(backfill_id) is None:
+        return jsonify({'error': "Backfill {} not found".format(backfill_id)}), 404
+    if not start_backfill(backfill_id):
+        return jsonify({'error': "Backfill {} is already running".format(backfill_id)}), 409
+    return jsonify(backfill_status(backfill_id)), 202
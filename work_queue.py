@@ -0,0 +1,172 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from helpers import log
+
+WORK_QUEUE_DB_PATH = os.environ.get('WORK_QUEUE_DB_PATH', '/data/queue/work-queue.sqlite')
+WORK_QUEUE_BACKOFF_BASE = float(os.environ.get('WORK_QUEUE_BACKOFF_BASE', 60))  # in seconds
+WORK_QUEUE_BACKOFF_MAX = float(os.environ.get('WORK_QUEUE_BACKOFF_MAX', 6 * 3600))  # in seconds
+
+db = None
+db_lock = threading.Lock()
+
+
+def work_queue_db():
+    """
+    Open (once) the SQLite database backing the work queues, shared by all threads.
+    """
+    global db
+    if db is None:
+        os.makedirs(os.path.dirname(WORK_QUEUE_DB_PATH), exist_ok=True)
+        db = sqlite3.connect(WORK_QUEUE_DB_PATH, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS work_items (
+                queue TEXT NOT NULL,
+                item TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                dead INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                misses INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (queue, item)
+            )""")
+        if 'misses' not in [column[1] for column in db.execute("PRAGMA table_info(work_items)")]:
+            db.execute("ALTER TABLE work_items ADD COLUMN misses INTEGER NOT NULL DEFAULT 0")
+        db.execute("CREATE INDEX IF NOT EXISTS work_items_due ON work_items (queue, dead, next_attempt_at)")
+    return db
+
+
+def backoff(attempts):
+    """
+    Exponential backoff with jitter: the delay doubles with every failed attempt up to WORK_QUEUE_BACKOFF_MAX,
+    of which a random 50 to 100% is taken so failing items don't get retried in lockstep.
+
+    :param attempts: number of failed attempts so far
+    :returns: delay in seconds
+    """
+    delay = min(WORK_QUEUE_BACKOFF_MAX, WORK_QUEUE_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+class WorkQueue:
+    """
+    Durable queue of work items (JSON-serializable, e.g. URIs), kept in a local SQLite database so it survives restarts.
+    An item is due as soon as it's pushed. A failed item is rescheduled with exponential backoff and
+    dead-lettered after max_attempts, a succeeded item is removed. An item that wasn't found (yet) is retried
+    shortly, a few times.
+    """
+
+    def __init__(self, name, max_attempts):
+        self.name = name
+        self.max_attempts = max_attempts
+
+    def execute(self, sql, params=()):
+        with db_lock:
+            return work_queue_db().execute(sql, params).fetchall()
+
+    def execute_many(self, sql, params):
+        with db_lock:
+            connection = work_queue_db()
+            connection.execute("BEGIN")
+            try:
+                connection.executemany(sql, params)
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+    def push(self, items):
+        """
+        Add items to the queue. An item that is already queued keeps its schedule, unless it wasn't found before:
+        then it's due again right away.
+        """
+        now = time.time()
+        self.execute_many("""INSERT INTO work_items (queue, item, next_attempt_at) VALUES (?, ?, ?)
+                             ON CONFLICT (queue, item) DO UPDATE SET next_attempt_at = excluded.next_attempt_at
+                             WHERE dead = 0 AND misses > 0""",
+                          [(self.name, json.dumps(item), now) for item in items])
+
+    def due(self, limit):
+        """
+        :returns: list of at most limit items of which the next attempt is due, the longest waiting first
+        """
+        rows = self.execute("""SELECT item FROM work_items
+                               WHERE queue = ? AND dead = 0 AND next_attempt_at <= ?
+                               ORDER BY next_attempt_at LIMIT ?""", (self.name, time.time(), limit))
+        return [json.loads(item) for (item,) in rows]
+
+    def deferred(self, items, include_dead=True):
+        """
+        :param include_dead: False to leave out the dead-lettered items
+        :returns: the given items that are waiting for their next attempt or are dead-lettered,
+                  i.e. the items that shouldn't be attempted now
+        """
+        keys = {json.dumps(item): item for item in items}
+        rows = []
+        keys_list = list(keys)
+        for i in range(0, len(keys_list), 500):  # Stay below the max number of SQLite variables
+            batch = keys_list[i:i + 500]
+            rows.extend(self.execute("""SELECT item FROM work_items
+                                        WHERE queue = ? AND ((dead = 1 AND ?) OR (dead = 0 AND next_attempt_at > ?))
+                                        AND item IN ({})""".format(", ".join("?" * len(batch))),
+                                     [self.name, int(include_dead), time.time()] + batch))
+        return [keys[item] for (item,) in rows]
+
+    def succeeded(self, items):
+        self.execute_many("DELETE FROM work_items WHERE queue = ? AND item = ?",
+                          [(self.name, json.dumps(item)) for item in items])
+
+    def failed(self, items, error=None):
+        """
+        Reschedule failed items (queueing them if they weren't yet), dead-letter those that reached max_attempts.
+        """
+        now = time.time()
+        for item in items:
+            key = json.dumps(item)
+            rows = self.execute("SELECT attempts FROM work_items WHERE queue = ? AND item = ?", (self.name, key))
+            attempts = (rows[0][0] if rows else 0) + 1
+            dead = attempts >= self.max_attempts
+            self.execute("""INSERT OR REPLACE INTO work_items (queue, item, attempts, next_attempt_at, dead, last_error)
+                            VALUES (?, ?, ?, ?, ?, ?)""",
+                         (self.name, key, attempts, now + backoff(attempts), int(dead), str(error) if error else None))
+            if dead:
+                log("Giving up on {} from the {} queue after {} attempts".format(item, self.name, attempts))
+
+    def missing(self, items, delay, max_misses):
+        """
+        Retry queued items that weren't found after delay seconds, e.g. a resource of which not all triples are
+        written yet. This isn't a failed attempt. An item that was missing max_misses times leaves the queue.
+        """
+        now = time.time()
+        for item in items:
+            key = json.dumps(item)
+            rows = self.execute("SELECT misses FROM work_items WHERE queue = ? AND item = ?", (self.name, key))
+            if not rows:
+                continue
+            misses = rows[0][0] + 1
+            if misses >= max_misses:
+                self.execute("DELETE FROM work_items WHERE queue = ? AND item = ?", (self.name, key))
+            else:
+                self.execute("UPDATE work_items SET misses = ?, next_attempt_at = ? WHERE queue = ? AND item = ?",
+                             (misses, now + delay, self.name, key))
+
+    def dead_letters(self):
+        """
+        :returns: list of dicts describing the dead-lettered items
+        """
+        rows = self.execute("SELECT item, attempts, last_error FROM work_items WHERE queue = ? AND dead = 1",
+                            (self.name,))
+        return [{'item': json.loads(item), 'attempts': attempts, 'last-error': last_error}
+                for (item, attempts, last_error) in rows]
+
+    def stats(self):
+        now = time.time()
+        (pending, due, dead) = self.execute("""SELECT COUNT(*),
+                                                      COALESCE(SUM(dead = 0 AND next_attempt_at <= ?), 0),
+                                                      COALESCE(SUM(dead), 0)
+                                               FROM work_items WHERE queue = ?""", (now, self.name))[0]
+        return {'pending': pending - dead, 'due': due, 'dead': dead}